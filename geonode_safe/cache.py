@@ -0,0 +1,265 @@
+"""Cache of downloaded layers shared by all calculations on this host
+
+Downloads written to disk are kept in SAFE_CACHE_DIR, one directory per
+download, keyed by the layer, its version and the parameters of the
+request. A packed spatial index of the features of a cached vector layer
+is stored with it once it has been built (see get_spatial_index), so
+repeated calculations on the same layer need neither download it again
+nor index it again.
+
+Entries are written to a temporary directory and moved in place so that
+other processes never see partial entries. When the cache exceeds
+SAFE_CACHE_MAX_SIZE bytes the least recently used entries are removed.
+"""
+
+import os
+import time
+import glob
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import numpy
+
+from geonode_safe.hotlayers import layer_version
+from geonode_safe.utilities import get_feature_envelopes, build_str_tree
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Directory holding cached downloads (None means no caching)
+CACHE_DIR = getattr(settings, 'SAFE_CACHE_DIR', None)
+
+# Maximal number of bytes in the cache or None for no limit
+CACHE_MAX_SIZE = getattr(settings, 'SAFE_CACHE_MAX_SIZE', None)
+
+# Entries used within this number of seconds are never evicted so that
+# they are not removed while being read
+CACHE_MIN_AGE = 60
+
+# Name of spatial index file in entries of vector layers
+INDEX_FILENAME = 'spatial_index.npz'
+
+
+def cache_key(server_url, layer_name, metadata, **kwargs):
+    """Get key of cache entry for download of layer
+
+    Input
+        server_url, layer_name: Layer as given to download
+        metadata: Layer metadata as returned by get_metadata
+        kwargs: Parameters of the download affecting the result,
+                e.g. bbox and resolution
+
+    Output
+        key: MD5 hex digest identifying the download
+    """
+
+    items = [server_url, layer_name, layer_version(metadata),
+             sorted(kwargs.items())]
+
+    return hashlib.md5(repr(items)).hexdigest()
+
+
+def get_cached_file(key):
+    """Get file of cache entry
+
+    Input
+        key: Key of entry as obtained from cache_key
+
+    Output
+        filename: Name of cached raster or vector file or None if the
+                  download is not in the cache
+    """
+
+    if CACHE_DIR is None:
+        return None
+
+    dirname = os.path.join(CACHE_DIR, key)
+    filenames = (glob.glob(os.path.join(dirname, '*.tif')) +
+                 glob.glob(os.path.join(dirname, '*.shp')))
+    if len(filenames) != 1:
+        return None
+
+    # Mark entry as recently used
+    try:
+        os.utime(dirname, None)
+    except OSError:
+        # Evicted meanwhile
+        return None
+
+    return filenames[0]
+
+
+def add_to_cache(key, filename):
+    """Store downloaded file in the cache
+
+    Input
+        key: Key of entry as obtained from cache_key
+        filename: Name of raster or vector file. Files with the same
+                  basename and other extensions, e.g. .dbf and .keywords,
+                  are stored along with it.
+
+    Output
+        filename: Name of file in the cache
+    """
+
+    try:
+        os.makedirs(CACHE_DIR)
+    except OSError:
+        # Already there (possibly made by another process)
+        if not os.path.isdir(CACHE_DIR):
+            raise
+
+    dirname = os.path.join(CACHE_DIR, key)
+    tmp_dirname = tempfile.mkdtemp(prefix='.add_', dir=CACHE_DIR)
+    try:
+        basename = os.path.splitext(filename)[0]
+        for name in glob.glob(basename + '.*'):
+            shutil.copy(name, tmp_dirname)
+
+        try:
+            os.rename(tmp_dirname, dirname)
+        except OSError:
+            # Added by another process meanwhile
+            shutil.rmtree(tmp_dirname)
+    except:
+        shutil.rmtree(tmp_dirname, ignore_errors=True)
+        raise
+
+    evict_cache()
+
+    return os.path.join(dirname, os.path.basename(filename))
+
+
+def is_cached_file(filename):
+    """Determine if file is in an entry of the cache
+    """
+
+    if CACHE_DIR is None:
+        return False
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    return os.path.dirname(dirname) == os.path.abspath(CACHE_DIR)
+
+
+def load_spatial_index(filename):
+    """Load spatial index stored with cached vector file
+
+    Input
+        filename: Name of file as returned by get_cached_file
+
+    Output
+        tree: Tree as built by build_str_tree or None if there is none
+    """
+
+    index_filename = os.path.join(os.path.dirname(filename), INDEX_FILENAME)
+    if not is_cached_file(filename) or not os.path.isfile(index_filename):
+        return None
+
+    data = numpy.load(index_filename)
+    try:
+        return dict([(name, data[name]) for name in data.files])
+    finally:
+        data.close()
+
+
+def get_spatial_index(filename):
+    """Get spatial index of the features of vector file
+
+    Input
+        filename: Name of vector file, e.g. that of a downloaded layer
+
+    Output
+        tree: Tree as built by build_str_tree which can be queried with
+              query_str_tree. Its item numbers are the positions of the
+              features in the file.
+
+    The index of a cached file is built when first asked for and stored
+    in its entry for later use.
+    """
+
+    tree = load_spatial_index(filename)
+    if tree is not None:
+        return tree
+
+    tree = build_str_tree(get_feature_envelopes(filename))
+    if is_cached_file(filename):
+        # Write index in full before moving it in place so that other
+        # processes never see a partial one
+        dirname = os.path.dirname(filename)
+        try:
+            fd, tmp_filename = tempfile.mkstemp(suffix='.npz', dir=dirname)
+            os.close(fd)
+            numpy.savez(tmp_filename, **tree)
+            os.rename(tmp_filename, os.path.join(dirname, INDEX_FILENAME))
+        except (OSError, IOError), e:
+            # Entry was evicted meanwhile
+            logger.debug('Could not store spatial index of %s: %s'
+                         % (filename, e))
+
+    return tree
+
+
+def get_entry_size(dirname):
+    """Get number of bytes used by cache entry
+    """
+
+    total = 0
+    for name in os.listdir(dirname):
+        try:
+            total += os.path.getsize(os.path.join(dirname, name))
+        except OSError:
+            # Removed meanwhile
+            pass
+
+    return total
+
+
+def evict_cache(max_size=None):
+    """Remove least recently used entries until cache is within max_size
+
+    Input
+        max_size: Maximal number of bytes in the cache.
+                  If None, SAFE_CACHE_MAX_SIZE is used.
+
+    Output
+        removed: List of keys of the entries that were removed
+    """
+
+    if max_size is None:
+        max_size = CACHE_MAX_SIZE
+
+    if max_size is None or CACHE_DIR is None or not os.path.isdir(CACHE_DIR):
+        return []
+
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        dirname = os.path.join(CACHE_DIR, name)
+        if name.startswith('.') or not os.path.isdir(dirname):
+            continue
+
+        try:
+            entries.append((os.path.getmtime(dirname),
+                            get_entry_size(dirname), name))
+        except OSError:
+            # Removed by someone else
+            continue
+
+    now = time.time()
+    total = sum([size for _, size, _ in entries])
+    removed = []
+    for mtime, size, name in sorted(entries):
+        if total <= max_size or now - mtime < CACHE_MIN_AGE:
+            break
+
+        shutil.rmtree(os.path.join(CACHE_DIR, name), ignore_errors=True)
+        total -= size
+        removed.append(name)
+
+    if len(removed) > 0:
+        logger.info('Evicted %i entries from download cache %s'
+                    % (len(removed), CACHE_DIR))
+
+    return removed
@@ -0,0 +1,616 @@
+"""Execution of impact calculations
+
+Raster impact calculations over large areas can be split into tiles which
+are calculated in parallel by a pool of worker processes. The resulting
+rasters are mosaicked into one impact layer and summary statistics that
+add up over tiles are totalled.
+
+Likewise, large vector exposure layers can be processed in batches of
+features so that only one batch is held in memory at a time.
+
+Impact functions opt in by declaring which of their output keywords are
+additive, e.g.
+
+    additive_keywords = ['total_affected']
+
+This also declares that the function works pixel by pixel or feature by
+feature so that the result for a tile or batch does not depend on data
+outside it.
+
+The impact summary of one tile or batch only accounts for part of the
+totals. Functions can declare how to summarise the combined keywords,
+e.g.
+
+    summary_template = '<b>%(total_affected)s</b> people affected'
+
+and the totals are otherwise listed in a table of their own.
+
+Areas where the hazard layer has no valid data are left out of the
+calculation when the function also lists all of its additive keywords in
+hazard_keywords, e.g.
+
+    additive_keywords = ['total_affected']
+    hazard_keywords = ['total_affected']
+
+This declares that they only count what is exposed to the hazard. Totals
+of the exposure alone, such as the total population, would be lost with
+the areas left out, so functions reporting them are calculated in full.
+"""
+
+import os
+import glob
+import tempfile
+import shutil
+import logging
+import threading
+
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from geonode_safe.storage import download
+from geonode_safe.storage import DOWNLOAD_THREADS
+from geonode_safe.storage import get_feature_count
+from geonode_safe.storage import get_sort_attribute
+from geonode_safe.storage import read_mapped_raster
+from geonode_safe.storage import MEMMAP_RASTERS
+from geonode_safe.utilities import split_bounding_box
+from geonode_safe.utilities import buffered_bounding_box
+from geonode_safe.utilities import bbox_intersection
+from geonode_safe.utilities import mosaic_rasters
+from geonode_safe.utilities import valid_data_bounding_box
+from geonode_safe.utilities import align_bounding_box
+from geonode_safe.utilities import merge_shapefiles
+from geonode_safe.utilities import extract_vector_features
+from geonode_safe.utilities import query_str_tree
+from geonode_safe.cache import get_spatial_index
+from geonode_safe.utilities import bboxlist2string
+from geonode_safe.utilities import write_keywords
+from geonode_safe.utilities import titelize
+
+from safe.api import get_admissible_plugins
+from safe.api import calculate_impact
+from safe.api import read_layer
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Number of worker processes for tiled calculations.
+# Tiling is disabled if this is None or 1.
+CALCULATION_PROCESSES = getattr(settings, 'SAFE_CALCULATION_PROCESSES', None)
+
+# Width and height of calculation tiles in pixels
+CALCULATION_TILE_SIZE = getattr(settings, 'SAFE_CALCULATION_TILE_SIZE', 1024)
+
+# Number of exposure features processed at a time in calculations with
+# vector exposure. Batching is disabled if this is None.
+EXPOSURE_BATCH_SIZE = getattr(settings, 'SAFE_EXPOSURE_BATCH_SIZE', None)
+
+
+def is_tileable(impact_function, haz_metadata, exp_metadata,
+                bbox=None, resolution=None):
+    """Determine if calculation can be split into tiles
+
+    Input
+        impact_function: Impact function class
+        haz_metadata: Metadata for hazard layer
+        exp_metadata: Metadata for exposure layer
+        bbox: Optional bounding box [W, S, E, N] of calculation
+        resolution: Optional (resx, resy) of calculation
+
+    Output
+        True if tiled calculations are enabled, both layers are rasters,
+        the impact function declares additive_keywords and, if bbox and
+        resolution are given, the area takes more than one tile.
+    """
+
+    if CALCULATION_PROCESSES is None or CALCULATION_PROCESSES < 2:
+        return False
+
+    if not hasattr(impact_function, 'additive_keywords'):
+        return False
+
+    for metadata in [haz_metadata, exp_metadata]:
+        if metadata['layertype'] != 'raster':
+            return False
+
+    if bbox is not None and resolution is not None:
+        tiles = split_bounding_box(bbox, resolution, CALCULATION_TILE_SIZE)
+        if len(tiles) < 2:
+            return False
+
+    return True
+
+
+def can_skip_empty_hazard(impact_function):
+    """Determine if areas without valid hazard data may be left out
+
+    Input
+        impact_function: Impact function class
+
+    Output
+        True if the impact function declares additive_keywords and lists
+        all of them in hazard_keywords, otherwise False
+    """
+
+    if not hasattr(impact_function, 'additive_keywords'):
+        return False
+
+    hazard_keywords = getattr(impact_function, 'hazard_keywords', [])
+    return set(impact_function.additive_keywords) <= set(hazard_keywords)
+
+
+def shrink_to_valid_hazard(tile_index, haz_bbox, exp_bbox, resolution=None):
+    """Shrink bounding boxes of calculation to where the hazard is valid
+
+    Input
+        tile_index: Tile index of the hazard layer in the coordinates of
+                    the bounding boxes (see get_tile_index)
+        haz_bbox, exp_bbox: Bounding boxes [W, S, E, N] of hazard and
+                            exposure as obtained from get_bounding_boxes
+        resolution: Optional (resx, resy) at which rasters are downloaded.
+                    If None, the native grid of the hazard layer is used.
+
+    Output
+        haz_bbox, exp_bbox: Bounding boxes holding all valid hazard data.
+                            Moved borders of haz_bbox stay on its grid.
+                            The given bounding boxes are returned if the
+                            hazard has no valid data in them so that the
+                            calculation still runs, e.g. for a viewport
+                            outside the hazard area.
+    """
+
+    valid_bbox = valid_data_bounding_box(tile_index, haz_bbox)
+    if valid_bbox is not None:
+        valid_exp_bbox = bbox_intersection(exp_bbox, valid_bbox)
+    else:
+        valid_exp_bbox = None
+
+    if valid_exp_bbox is None:
+        logger.info('Hazard layer has no valid data in bounding box %s'
+                    % str(haz_bbox))
+        return haz_bbox, exp_bbox
+    exp_bbox = valid_exp_bbox
+
+    # Tile boundaries are on the native grid. Otherwise snap outward to
+    # the grid of the download.
+    if resolution is not None:
+        geotransform = (haz_bbox[0], resolution[0], 0.0,
+                        haz_bbox[3], 0.0, -resolution[1])
+        valid_bbox = bbox_intersection(
+            align_bounding_box(valid_bbox, geotransform), haz_bbox)
+
+    return valid_bbox, exp_bbox
+
+
+def calculate_tile(args):
+    """Calculate impact for one tile
+
+    Input
+        args: Tuple (impact_function_name, filenames) where filenames are
+              the names of the downloaded hazard and exposure tiles
+
+    Output
+        filename: Name of impact raster for the tile
+        keywords: Keywords of impact raster
+
+    This is run in the worker processes of calculate_tiled.
+    """
+
+    impact_function_name, filenames = args
+
+    impact_function = get_admissible_plugins()[impact_function_name]
+    layers = []
+    for filename in filenames:
+        # Page data of the tile in as it is used
+        layer = None
+        if MEMMAP_RASTERS:
+            layer = read_mapped_raster(filename)
+        if layer is None:
+            layer = read_layer(filename)
+        layers.append(layer)
+
+    impact = calculate_impact(layers=layers, impact_fcn=impact_function)
+
+    return impact.filename, impact.get_keywords()
+
+
+def sum_keywords(keywords_list, names):
+    """Add up keywords over tiles or batches
+
+    Input
+        keywords_list: List of keyword dictionaries, one per tile or batch
+        names: Names of keywords to add up
+
+    Output
+        totals: Dictionary of totals for names present in all of them
+    """
+
+    totals = {}
+    for name in names:
+        try:
+            total = sum([float(keywords[name]) for keywords in keywords_list])
+        except (KeyError, TypeError, ValueError):
+            logger.warning('Keyword %s could not be added up'
+                           % name)
+            continue
+
+        if total == int(total):
+            total = int(total)
+        totals[name] = total
+
+    return totals
+
+
+def totals2summary(totals):
+    """Make HTML summary table of totals
+
+    Input
+        totals: Dictionary of totals as obtained from sum_keywords
+
+    Output
+        summary: HTML table with one row per total
+    """
+
+    rows = ['<tr><td>%s</td><td>%s</td></tr>' % (titelize(name),
+                                                 totals[name])
+            for name in sorted(totals.keys())]
+    return '<table class="table table-striped condensed">%s</table>' % (
+        ''.join(rows))
+
+
+def combine_summary(impact_function, keywords, totals):
+    """Make impact summary of keywords combined over tiles or batches
+
+    Input
+        impact_function: Impact function that was calculated
+        keywords: Combined keywords of the impact layer
+        totals: Dictionary of totals as obtained from sum_keywords
+
+    Output
+        summary: The summary_template of the impact function filled in
+                 with keywords if declared, otherwise HTML table of totals
+    """
+
+    if hasattr(impact_function, 'summary_template'):
+        return impact_function.summary_template % keywords
+    else:
+        return totals2summary(totals)
+
+
+def remove_impact_file(filename):
+    """Remove impact file and its auxiliary files (.keywords, .sld, etc)
+    """
+
+    for name in glob.glob(os.path.splitext(filename)[0] + '.*'):
+        os.remove(name)
+
+
+def calculate_tiled(impact_function_name, download_layers, bbox, resolution,
+                    workdir, crs=None, processes=None, tile_index=None):
+    """Calculate impact tile by tile in parallel
+
+    Input
+        impact_function_name: Name of impact function as in
+                              get_admissible_plugins
+        download_layers: List of (server, layer_name) for hazard and
+                         exposure rasters
+        bbox: Bounding box [W, S, E, N] of calculation aligned with the
+              grid of the layers
+        resolution: (resx, resy) of the layers
+        workdir: Scratch directory in which to store files
+        crs: Coordinate reference system of bbox and resolution
+             (see download). If None, EPSG:4326 is used.
+        processes: Number of worker processes. If None,
+                   SAFE_CALCULATION_PROCESSES is used. Tiles are
+                   calculated in the calling process instead if it is
+                   not the main thread.
+        tile_index: Optional tile index of the hazard layer in the
+                    coordinates of bbox (see get_tile_index). Tiles without
+                    valid hazard data are then neither downloaded nor
+                    calculated and are left as nodata in the impact layer.
+                    The impact function must only count what is exposed to
+                    the hazard (see can_skip_empty_hazard).
+
+    Output
+        filename: Name of impact raster in workdir. Keywords named in
+                  additive_keywords of the impact function are totals over
+                  all tiles and the impact summary is made from them
+                  (see combine_summary). Other keywords are those of the
+                  first tile.
+    """
+
+    if processes is None:
+        processes = CALCULATION_PROCESSES
+
+    impact_function = get_admissible_plugins()[impact_function_name]
+    additive_keywords = impact_function.additive_keywords
+
+    tiles = split_bounding_box(bbox, resolution, CALCULATION_TILE_SIZE)
+    if tile_index is not None:
+        number_of_tiles = len(tiles)
+        valid_tiles = [tile for tile in tiles
+                       if valid_data_bounding_box(tile_index, tile)
+                       is not None]
+
+        # Without valid hazard data anywhere, one tile is calculated so
+        # that the impact layer and its keywords are made as usual
+        if len(valid_tiles) == 0:
+            valid_tiles = tiles[:1]
+        tiles = valid_tiles
+
+        logger.info('Skipping %i of %i tiles without valid hazard data'
+                    % (number_of_tiles - len(tiles), number_of_tiles))
+
+    logger.info('Calculating %s in %i tiles using %i processes'
+                % (impact_function_name, len(tiles), processes))
+
+    # Download tiles to disk. Only the file names are kept here.
+    # Tiles do not overlap as every pixel would otherwise be counted in
+    # the additive keywords of each tile containing it.
+    def get_tile(tile):
+        filenames = []
+        for server, layer_name in download_layers:
+            filename = download(server, layer_name, tile, resolution,
+                                scratch_dir=workdir, crs=crs, read=False)
+            filenames.append(filename)
+        return filenames
+
+    thread_pool = ThreadPool(DOWNLOAD_THREADS)
+    try:
+        tile_filenames = thread_pool.map(get_tile, tiles)
+        thread_pool.close()
+    except:
+        thread_pool.terminate()
+        raise
+    finally:
+        thread_pool.join()
+
+    # Calculate impact for each tile. Forking from threads other than
+    # the main one, e.g. those of run_in_background, copies locks held by
+    # the others in their locked state, so tiles are then calculated one
+    # at a time in this process.
+    args = [(impact_function_name, filenames)
+            for filenames in tile_filenames]
+    if isinstance(threading.current_thread(), threading._MainThread):
+        pool = Pool(processes)
+        try:
+            results = pool.map(calculate_tile, args)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        logger.info('Calculating tiles in this process as it is not '
+                    'running in the main thread')
+        results = [calculate_tile(arg) for arg in args]
+
+    impact_filenames = [filename for filename, _ in results]
+    try:
+        # Mosaic the tiles into one raster with combined keywords
+        mosaic_filename = os.path.join(workdir, 'impact.tif')
+        mosaic_rasters(impact_filenames, tiles, bbox, resolution,
+                       mosaic_filename)
+
+        totals = sum_keywords([keywords for _, keywords in results],
+                              additive_keywords)
+        keywords = dict(results[0][1])
+        keywords.update(totals)
+        keywords['impact_summary'] = combine_summary(impact_function,
+                                                      keywords, totals)
+
+        basename = os.path.splitext(mosaic_filename)[0]
+        write_keywords(keywords, basename + '.keywords')
+
+        # Use style of first tile
+        sld_filename = os.path.splitext(impact_filenames[0])[0] + '.sld'
+        if os.path.isfile(sld_filename):
+            shutil.copy(sld_filename, basename + '.sld')
+    finally:
+        for filename in impact_filenames:
+            remove_impact_file(filename)
+
+    return mosaic_filename
+
+
+def is_batchable(impact_function, haz_metadata, exp_metadata):
+    """Determine if calculation can process exposure features in batches
+
+    Input
+        impact_function: Impact function class
+        haz_metadata: Metadata for hazard layer
+        exp_metadata: Metadata for exposure layer
+
+    Output
+        True if batched calculations are enabled, exposure is a vector
+        layer and the impact function declares additive_keywords
+    """
+
+    if EXPOSURE_BATCH_SIZE is None:
+        return False
+
+    if not hasattr(impact_function, 'additive_keywords'):
+        return False
+
+    return exp_metadata['layertype'] == 'vector'
+
+
+def calculate_batched(impact_function_name, hazard, exposure, haz_metadata,
+                      haz_bbox, exp_bbox, resolution, workdir,
+                      attributes=None, simplify_tolerance=None,
+                      batch_size=None):
+    """Calculate impact on vector exposure in batches of features
+
+    Input
+        impact_function_name: Name of impact function as in
+                              get_admissible_plugins
+        hazard: Tuple (server, layer_name) of hazard layer
+        exposure: Tuple (server, layer_name) of vector exposure layer
+        haz_metadata: Metadata for hazard layer
+        haz_bbox: Bounding box [W, S, E, N] of hazard layer
+        exp_bbox: Bounding box [W, S, E, N] of exposure layer
+        resolution: Resolution of hazard in case it is a raster layer
+                    (see download). If None, the native resolution is used.
+        workdir: Scratch directory in which to store files
+        attributes: Optional dictionary of attributes to download for
+                    'hazard' and 'exposure' (see download)
+        simplify_tolerance: Optional tolerance for simplification of
+                            exposure features (see download)
+        batch_size: Number of exposure features per batch. If None,
+                    SAFE_EXPOSURE_BATCH_SIZE is used.
+
+    Output
+        filename: Name of impact shapefile in workdir. Keywords named in
+                  additive_keywords of the impact function are totals over
+                  all batches and the impact summary is made from them
+                  (see combine_summary). Other keywords are those of the
+                  first batch.
+                  None if the exposure is not split into batches, in
+                  which case the impact is to be calculated in one go.
+                  This happens when the layer has no attribute to sort its
+                  features by (see get_sort_attribute) or no more than
+                  batch_size features in exp_bbox.
+
+    Batches follow the order of the sort attribute which is spatially
+    coherent for layers sorted on upload (see the spatial_index option of
+    save_file_to_geonode) as feature ids are assigned in the order of
+    the features on upload. Raster hazard is downloaded for the
+    area of each batch only. Vector hazard is downloaded once and the
+    features overlapping each batch are found in its spatial index (see
+    get_spatial_index). The results of each batch are written to disk
+    and merged in the end. Hence memory use is proportional to the
+    batch size rather than to the size of the exposure layer.
+    """
+
+    if batch_size is None:
+        batch_size = EXPOSURE_BATCH_SIZE
+
+    if attributes is None:
+        attributes = {}
+
+    haz_server, haz_layer_name = hazard
+    exp_server, exp_layer_name = exposure
+
+    # Batches are pages of features which need a stable order
+    if get_sort_attribute(exp_server, exp_layer_name) is None:
+        logger.info('Calculating %s in one go as layer %s has no attribute '
+                    'to sort features by' % (impact_function_name,
+                                             exp_layer_name))
+        return None
+
+    number_of_features = get_feature_count(exp_server, exp_layer_name,
+                                           bboxlist2string(exp_bbox,
+                                                           decimals=12))
+    if number_of_features <= batch_size:
+        logger.info('Calculating %s in one go for %i features'
+                    % (impact_function_name, number_of_features))
+        return None
+
+    impact_function = get_admissible_plugins()[impact_function_name]
+    additive_keywords = impact_function.additive_keywords
+
+    if haz_metadata['layertype'] == 'raster':
+        margin = resolution
+        if margin is None:
+            margin = haz_metadata['resolution']
+    else:
+        # Keep bounding boxes of single points valid
+        margin = 1.0e-6
+
+    # Vector hazard is downloaded once and the features needed for each
+    # batch are looked up in its spatial index
+    haz_filename = haz_tree = None
+    if haz_metadata['layertype'] == 'vector':
+        H = download(haz_server, haz_layer_name, haz_bbox,
+                     scratch_dir=workdir, in_memory=False,
+                     attributes=attributes.get('hazard'))
+        haz_filename = H.filename
+        haz_tree = get_spatial_index(haz_filename)
+        del H
+
+    logger.info('Calculating %s for %i features in batches of %i'
+                % (impact_function_name, number_of_features, batch_size))
+
+    impact_filenames = []
+    keywords_list = []
+    try:
+        for start in range(0, number_of_features, batch_size):
+            # The last batch has no upper limit so features added since
+            # they were counted are not lost
+            if start + batch_size < number_of_features:
+                max_features = batch_size
+            else:
+                max_features = None
+
+            E = download(exp_server, exp_layer_name, exp_bbox,
+                         scratch_dir=workdir, in_memory=False,
+                         attributes=attributes.get('exposure'),
+                         simplify_tolerance=simplify_tolerance,
+                         start_index=start, max_features=max_features)
+            if len(E) == 0:
+                continue
+
+            # Hazard for the area of this batch only
+            bbox = bbox_intersection(buffered_bounding_box(
+                E.get_bounding_box(), margin), haz_bbox)
+            if bbox is None:
+                bbox = haz_bbox
+
+            haz_dirname = None
+            if haz_tree is None:
+                H = download(haz_server, haz_layer_name, bbox, resolution,
+                             scratch_dir=workdir, in_memory=False,
+                             attributes=attributes.get('hazard'))
+            else:
+                haz_dirname = tempfile.mkdtemp(dir=workdir)
+                basename = os.path.splitext(os.path.basename(haz_filename))[0]
+                extract_vector_features(haz_filename,
+                                        query_str_tree(haz_tree, bbox),
+                                        os.path.join(haz_dirname,
+                                                     basename + '.shp'))
+                shutil.copy(os.path.splitext(haz_filename)[0] + '.keywords',
+                            haz_dirname)
+                H = read_layer(os.path.join(haz_dirname, basename + '.shp'))
+
+            impact = calculate_impact(layers=[H, E],
+                                      impact_fcn=impact_function)
+            impact_filenames.append(impact.filename)
+            keywords_list.append(impact.get_keywords())
+
+            # Release the batch before downloading the next one
+            del E, H, impact
+            if haz_dirname is not None:
+                shutil.rmtree(haz_dirname)
+
+        if len(impact_filenames) == 0:
+            # Features were removed since they were counted
+            logger.info('No exposure features found for calculation %s '
+                        'in %s' % (impact_function_name, exp_bbox))
+            return None
+
+        # Merge batches into one shapefile with combined keywords
+        dirname = tempfile.mkdtemp(dir=workdir)
+        impact_filename = os.path.join(dirname, 'impact.shp')
+        merge_shapefiles(impact_filenames, impact_filename)
+
+        keywords = dict(keywords_list[0])
+        if len(keywords_list) > 1:
+            totals = sum_keywords(keywords_list, additive_keywords)
+            keywords.update(totals)
+            keywords['impact_summary'] = combine_summary(impact_function,
+                                                          keywords, totals)
+
+        basename = os.path.splitext(impact_filename)[0]
+        write_keywords(keywords, basename + '.keywords')
+
+        # Use style of first batch
+        sld_filename = os.path.splitext(impact_filenames[0])[0] + '.sld'
+        if os.path.isfile(sld_filename):
+            shutil.copy(sld_filename, basename + '.sld')
+    finally:
+        for filename in impact_filenames:
+            remove_impact_file(filename)
+
+    return impact_filename
@@ -0,0 +1,372 @@
+"""Store of hazard layers shared by all calculations on this host
+
+Layers named in SAFE_HOT_LAYERS, e.g. the shakemap of an ongoing event,
+are downloaded once in their entirety and kept as numpy arrays in files
+below a common store directory. Calculations in any process memory map
+these read-only, so the data is held in memory once and shared through
+the page cache instead of being downloaded and read for each request.
+
+Each entry is a directory named by a key derived from the layer and its
+version. Processes record the references they hold in the entry and
+entries nobody refers to are evicted, least recently used first, when
+the store exceeds SAFE_HOT_LAYER_MAX_SIZE bytes.
+"""
+
+import os
+import json
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import weakref
+import threading
+import contextlib
+
+import numpy
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Layers (workspace:name) to keep in the store
+HOT_LAYERS = getattr(settings, 'SAFE_HOT_LAYERS', [])
+
+# Directory holding the store
+HOT_LAYER_DIR = getattr(settings, 'SAFE_HOT_LAYER_DIR',
+                        os.path.join(tempfile.gettempdir(),
+                                     'geonode_safe_hot'))
+
+# Maximal number of bytes in the store or None for no limit
+HOT_LAYER_MAX_SIZE = getattr(settings, 'SAFE_HOT_LAYER_MAX_SIZE', None)
+
+# Names of files in each entry
+DATA_FILENAME = 'data.npy'
+INFO_FILENAME = 'info.json'
+REFS_FILENAME = 'refs.json'
+LOCK_FILENAME = '.lock'
+
+# Weak references to arrays handed out by this process keeping their
+# entries referenced until the arrays are garbage collected
+views = {}
+views_lock = threading.Lock()
+
+
+def is_hot_layer(layer_name):
+    """Determine if layer is to be kept in the store
+    """
+
+    return layer_name in HOT_LAYERS
+
+
+def layer_version(metadata):
+    """Get version of layer as given by its metadata
+
+    Input
+        metadata: Layer metadata as returned by get_metadata
+
+    Output
+        version: MD5 hex digest of the checksum of the data, extent, grid
+                 and keywords of the layer. It changes when the layer is
+                 replaced.
+
+    The checksum is the keyword recorded by save_file_to_geonode. Without
+    it, a layer replaced by other data on the same grid and with the same
+    keywords keeps its version.
+    """
+
+    keywords = metadata.get('keywords') or {}
+    items = [('checksum', keywords.get('checksum')),
+             ('bounding_box', metadata.get('bounding_box')),
+             ('geotransform', metadata.get('geotransform')),
+             ('native_crs', metadata.get('native_crs')),
+             ('keywords', sorted(keywords.items()))]
+
+    return hashlib.md5(repr(items)).hexdigest()
+
+
+def entry_key(server_url, layer_name, metadata):
+    """Get key of store entry for given version of layer
+    """
+
+    name = '%s|%s|%s' % (server_url, layer_name, layer_version(metadata))
+    return hashlib.md5(name).hexdigest()
+
+
+@contextlib.contextmanager
+def store_lock():
+    """Context manager holding exclusive lock on the store
+
+    The lock is shared by all processes on this host.
+    """
+
+    try:
+        os.makedirs(HOT_LAYER_DIR)
+    except OSError:
+        # Already there (possibly made by another process)
+        if not os.path.isdir(HOT_LAYER_DIR):
+            raise
+
+    f = open(os.path.join(HOT_LAYER_DIR, LOCK_FILENAME), 'a')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+
+def is_alive(pid):
+    """Determine if process with given pid exists
+    """
+
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+
+    return True
+
+
+def read_refs(dirname):
+    """Get references held on entry by live processes
+
+    Output
+        refs: Dictionary mapping process ids to number of references
+    """
+
+    try:
+        f = open(os.path.join(dirname, REFS_FILENAME))
+    except IOError:
+        return {}
+
+    try:
+        refs = json.load(f)
+    finally:
+        f.close()
+
+    # References of processes that died without releasing them are void
+    return dict([(int(pid), count) for pid, count in refs.items()
+                 if count > 0 and is_alive(int(pid))])
+
+
+def write_refs(dirname, refs):
+    """Record references held on entry (called with the store locked)
+    """
+
+    f = open(os.path.join(dirname, REFS_FILENAME), 'w')
+    try:
+        json.dump(refs, f)
+    finally:
+        f.close()
+
+
+def change_refs(dirname, change):
+    """Change number of references held on entry by this process
+
+    Output
+        True if the entry exists, False otherwise
+    """
+
+    with store_lock():
+        if not os.path.isdir(dirname):
+            return False
+
+        refs = read_refs(dirname)
+        pid = os.getpid()
+        refs[pid] = refs.get(pid, 0) + change
+        if refs[pid] <= 0:
+            del refs[pid]
+        write_refs(dirname, refs)
+
+        # Mark entry as recently used
+        os.utime(dirname, None)
+
+    return True
+
+
+def get_entry(key, build):
+    """Get store entry, adding it if not there, and hold a reference to it
+
+    Input
+        key: Key of entry as obtained from entry_key
+        build: Function taking the name of an empty directory and
+               writing the data of the entry into it by calling
+               write_entry.
+
+    Output
+        dirname: Directory of entry. The reference must be given back
+                 with release_entry when no longer needed (see hold_view).
+    """
+
+    dirname = os.path.join(HOT_LAYER_DIR, key)
+    if change_refs(dirname, 1):
+        return dirname
+
+    # Build entry in temporary directory and move it in place so that
+    # other processes never see a partial entry. Entries built by several
+    # processes at once are identical and only one is kept.
+    with store_lock():
+        tmp_dirname = tempfile.mkdtemp(prefix='.build_', dir=HOT_LAYER_DIR)
+
+    try:
+        build(tmp_dirname)
+        with store_lock():
+            if os.path.isdir(dirname):
+                shutil.rmtree(tmp_dirname)
+            else:
+                os.rename(tmp_dirname, dirname)
+
+            refs = read_refs(dirname)
+            pid = os.getpid()
+            refs[pid] = refs.get(pid, 0) + 1
+            write_refs(dirname, refs)
+    except:
+        shutil.rmtree(tmp_dirname, ignore_errors=True)
+        raise
+
+    logger.info('Added entry %s to hot layer store %s'
+                % (key, HOT_LAYER_DIR))
+    evict_entries()
+
+    return dirname
+
+
+def release_entry(dirname):
+    """Give back reference held on entry by get_entry
+    """
+
+    change_refs(dirname, -1)
+
+
+def write_entry(dirname, data, projection, geotransform, keywords):
+    """Write data of raster layer to entry directory
+
+    Input
+        dirname: Directory passed to the build function of get_entry
+        data: Numpy array of raster data with NaN where there is no data
+        projection: WKT projection information
+        geotransform: GDAL geotransform (6-tuple)
+        keywords: Dictionary of layer keywords
+    """
+
+    numpy.save(os.path.join(dirname, DATA_FILENAME), data)
+
+    info = {'projection': projection,
+            'geotransform': list(geotransform),
+            'keywords': keywords}
+    f = open(os.path.join(dirname, INFO_FILENAME), 'w')
+    try:
+        json.dump(info, f)
+    finally:
+        f.close()
+
+
+def read_entry(dirname):
+    """Read entry of the store
+
+    Input
+        dirname: Directory of entry as returned by get_entry
+
+    Output
+        data: Read-only memory mapped array of raster data
+        info: Dictionary with projection, geotransform and keywords
+    """
+
+    data = numpy.load(os.path.join(dirname, DATA_FILENAME), mmap_mode='r')
+
+    f = open(os.path.join(dirname, INFO_FILENAME))
+    try:
+        info = json.load(f)
+    finally:
+        f.close()
+
+    info['projection'] = str(info['projection'])
+    info['geotransform'] = tuple(info['geotransform'])
+    return data, info
+
+
+def hold_view(A, dirname):
+    """Keep reference on entry for as long as array A exists
+
+    Input
+        A: Numpy array viewing data of entry
+        dirname: Directory of entry as returned by get_entry. The
+                 reference obtained there is released when A is garbage
+                 collected.
+    """
+
+    def release(ref):
+        with views_lock:
+            views.pop(id(ref), None)
+        release_entry(dirname)
+
+    ref = weakref.ref(A, release)
+    with views_lock:
+        views[id(ref)] = ref
+
+
+def get_entry_size(dirname):
+    """Get number of bytes used by entry
+    """
+
+    total = 0
+    for name in os.listdir(dirname):
+        try:
+            total += os.path.getsize(os.path.join(dirname, name))
+        except OSError:
+            # Removed meanwhile
+            pass
+
+    return total
+
+
+def evict_entries(max_size=None):
+    """Remove least recently used entries until store is within max_size
+
+    Input
+        max_size: Maximal number of bytes in the store.
+                  If None, SAFE_HOT_LAYER_MAX_SIZE is used.
+
+    Output
+        removed: List of keys of the entries that were removed
+
+    Entries referenced by live processes are never removed.
+    """
+
+    if max_size is None:
+        max_size = HOT_LAYER_MAX_SIZE
+
+    if max_size is None or not os.path.isdir(HOT_LAYER_DIR):
+        return []
+
+    removed = []
+    with store_lock():
+        entries = []
+        for name in os.listdir(HOT_LAYER_DIR):
+            dirname = os.path.join(HOT_LAYER_DIR, name)
+            if name.startswith('.') or not os.path.isdir(dirname):
+                continue
+
+            entries.append((os.path.getmtime(dirname),
+                            get_entry_size(dirname), name))
+
+        total = sum([size for _, size, _ in entries])
+        for _, size, name in sorted(entries):
+            if total <= max_size:
+                break
+
+            dirname = os.path.join(HOT_LAYER_DIR, name)
+            if len(read_refs(dirname)) > 0:
+                continue
+
+            shutil.rmtree(dirname, ignore_errors=True)
+            total -= size
+            removed.append(name)
+
+    if len(removed) > 0:
+        logger.info('Evicted %i entries from hot layer store %s'
+                    % (len(removed), HOT_LAYER_DIR))
+
+    return removed
@@ -39,13 +39,25 @@ class Command(BaseCommand):
                 default=False,
                 help='Stop after any errors are encountered.'),
             make_option('-k', '--keywords', dest='keywords', default="", 
-                help="The default keywords for the imported layer(s). Will be the same for all imported layers if multiple imports are done in one command")
+                help="The default keywords for the imported layer(s). Will be the same for all imported layers if multiple imports are done in one command"),
+            make_option('-s', '--spatial-index',
+                action='store_true',
+                dest='spatial_index',
+                default=None,
+                help='Sort shapefile features spatially and build a spatial index before upload. Existing layers are overwritten, so this retrofits layers imported without one.'),
+            make_option('-d', '--density-grids',
+                action='store_true',
+                dest='density_grids',
+                default=None,
+                help='Upload grids counting the features of vector exposure layers at the resolutions in SAFE_DENSITY_RESOLUTIONS along with them.')
         )
 
     def handle(self, *args, **options):
         verbosity = int(options.get('verbosity'))
         ignore_errors = options.get('ignore_errors')
         user = options.get('user')
+        spatial_index = options.get('spatial_index')
+        density_grids = options.get('density_grids')
         overwrite = True
         skip = False
 
@@ -55,7 +67,9 @@ class Command(BaseCommand):
         for path in args:
             out = save_to_geonode(path, user=user, ignore_errors=ignore_errors, 
                                   overwrite=overwrite, skip=skip,
-                                  keywords=keywords, verbosity=verbosity)
+                                  keywords=keywords, verbosity=verbosity,
+                                  spatial_index=spatial_index,
+                                  density_grids=density_grids)
             output.extend(out)
 
         updated = [dict_['file'] for dict_ in output if dict_['status']=='updated']
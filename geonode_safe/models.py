@@ -60,11 +60,17 @@ class Workspace(models.Model):
         return self.user.username
 
 
+def get_duration(start):
+    """Get number of seconds since start as recorded in run_duration
+    """
+
+    td = datetime.datetime.now() - start
+    duration = td.microseconds / 1000000 + td.seconds + td.days * 24 * 3600
+    return round(duration, 2)
+
+
 def duration(sender, **kwargs):
     instance = kwargs['instance']
-    now = datetime.datetime.now()
-    td = now - instance.run_date
-    duration = td.microseconds / 1000000 + td.seconds + td.days * 24 * 3600
-    instance.run_duration = round(duration, 2)
+    instance.run_duration = get_duration(instance.run_date)
 
 models.signals.pre_save.connect(duration, sender=Calculation)
@@ -0,0 +1,267 @@
+"""Scratch space for temporary downloads and conversions
+
+All temporary files made by geonode_safe live in uniquely named
+directories below a common scratch root, one directory per download,
+upload or calculation. Directories are removed when the task completes
+or fails and a background reaper removes directories orphaned by
+processes that died before they could clean up.
+"""
+
+import os
+import time
+import shutil
+import logging
+import weakref
+import tempfile
+import threading
+import contextlib
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Root directory for all scratch space
+SCRATCH_ROOT = getattr(settings, 'SAFE_SCRATCH_ROOT',
+                       os.path.join(tempfile.gettempdir(), 'geonode_safe'))
+
+# Maximal number of bytes in scratch space or None for no limit
+SCRATCH_QUOTA = getattr(settings, 'SAFE_SCRATCH_QUOTA', None)
+
+# Age in seconds after which unused scratch directories are orphans
+SCRATCH_MAX_AGE = getattr(settings, 'SAFE_SCRATCH_MAX_AGE', 24 * 3600)
+
+# Seconds between runs of the background reaper or None to disable it
+REAPER_INTERVAL = getattr(settings, 'SAFE_SCRATCH_REAPER_INTERVAL', 3600)
+
+# Scratch directories in use by this process. These are never reaped.
+active_dirs = set()
+active_dirs_lock = threading.Lock()
+
+reaper = None
+reaper_lock = threading.Lock()
+
+# Weak references to objects whose scratch directories are removed
+# when they are garbage collected (see remove_with)
+owners = {}
+owners_lock = threading.Lock()
+
+
+class ScratchSpaceException(Exception):
+    pass
+
+
+def make_scratch_dir(prefix='scratch'):
+    """Create new scratch directory
+
+    Input
+        prefix: Start of directory name indicating what it is used for
+
+    Output
+        dirname: Absolute name of new, empty directory below SCRATCH_ROOT.
+                 It is the responsibility of the caller to remove it with
+                 remove_scratch_dir when done.
+
+    The name is guaranteed unique by mkdtemp even if several processes
+    create directories at the same time.
+    """
+
+    try:
+        os.makedirs(SCRATCH_ROOT)
+    except OSError:
+        # Already there (possibly made by another process)
+        if not os.path.isdir(SCRATCH_ROOT):
+            raise
+
+    start_reaper()
+    check_quota()
+
+    dirname = tempfile.mkdtemp(prefix=prefix + '_', dir=SCRATCH_ROOT)
+    with active_dirs_lock:
+        active_dirs.add(dirname)
+
+    return dirname
+
+
+def remove_scratch_dir(dirname):
+    """Remove scratch directory and everything in it
+
+    Input
+        dirname: Directory as returned by make_scratch_dir
+    """
+
+    if not is_scratch_dir(dirname):
+        msg = ('Directory %s is not in scratch space %s'
+               % (dirname, SCRATCH_ROOT))
+        raise ScratchSpaceException(msg)
+
+    shutil.rmtree(dirname, ignore_errors=True)
+    with active_dirs_lock:
+        active_dirs.discard(dirname)
+
+
+def is_scratch_dir(dirname):
+    """Determine if dirname is a directory directly below SCRATCH_ROOT
+    """
+
+    parent = os.path.dirname(os.path.abspath(dirname))
+    return parent == os.path.abspath(SCRATCH_ROOT)
+
+
+@contextlib.contextmanager
+def scratch_dir(prefix='scratch'):
+    """Context manager providing scratch directory
+
+    The directory is removed when the block is left whether or not
+    an exception was raised, e.g.
+
+    with scratch_dir('calculation') as dirname:
+        ...
+    """
+
+    dirname = make_scratch_dir(prefix)
+    try:
+        yield dirname
+    finally:
+        remove_scratch_dir(dirname)
+
+
+def remove_with(obj, dirname):
+    """Remove scratch directory once obj has been garbage collected
+
+    Input
+        obj: Object depending on files in dirname, e.g. a layer read
+             from a downloaded file
+        dirname: Directory as returned by make_scratch_dir
+    """
+
+    if not is_scratch_dir(dirname):
+        msg = ('Directory %s is not in scratch space %s'
+               % (dirname, SCRATCH_ROOT))
+        raise ScratchSpaceException(msg)
+
+    def remove(ref):
+        with owners_lock:
+            owners.pop(id(ref), None)
+        remove_scratch_dir(dirname)
+
+    ref = weakref.ref(obj, remove)
+    with owners_lock:
+        owners[id(ref)] = ref
+
+
+def get_scratch_usage():
+    """Get number of bytes used in scratch space
+    """
+
+    total = 0
+    for root, dirs, files in os.walk(SCRATCH_ROOT):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # File was removed while walking
+                pass
+
+    return total
+
+
+def check_quota():
+    """Verify that scratch space is within SCRATCH_QUOTA
+
+    If the quota is exceeded orphans are reaped. If that does not
+    free enough space a ScratchSpaceException is raised.
+    """
+
+    if SCRATCH_QUOTA is None:
+        return
+
+    if get_scratch_usage() <= SCRATCH_QUOTA:
+        return
+
+    reap_orphans()
+    usage = get_scratch_usage()
+    if usage > SCRATCH_QUOTA:
+        msg = ('Scratch space %s uses %i bytes which exceeds the quota of '
+               '%i bytes' % (SCRATCH_ROOT, usage, SCRATCH_QUOTA))
+        raise ScratchSpaceException(msg)
+
+
+def reap_orphans(max_age=None):
+    """Remove scratch directories that have not been modified recently
+
+    Input
+        max_age: Age in seconds of directories to remove.
+                 If None, SCRATCH_MAX_AGE is used.
+
+    Output
+        removed: List of directories that were removed
+
+    Directories in use by this process are never removed.
+    """
+
+    if max_age is None:
+        max_age = SCRATCH_MAX_AGE
+
+    if not os.path.isdir(SCRATCH_ROOT):
+        return []
+
+    with active_dirs_lock:
+        in_use = set(active_dirs)
+
+    now = time.time()
+    removed = []
+    for name in os.listdir(SCRATCH_ROOT):
+        dirname = os.path.join(SCRATCH_ROOT, name)
+        if dirname in in_use or not os.path.isdir(dirname):
+            continue
+
+        try:
+            age = now - os.path.getmtime(dirname)
+        except OSError:
+            # Removed by someone else
+            continue
+
+        if age > max_age:
+            shutil.rmtree(dirname, ignore_errors=True)
+            removed.append(dirname)
+
+    if len(removed) > 0:
+        logger.info('Reaped %i orphaned scratch directories in %s'
+                    % (len(removed), SCRATCH_ROOT))
+
+    return removed
+
+
+def start_reaper():
+    """Start background thread reaping orphans every REAPER_INTERVAL seconds
+
+    Only one reaper is started per process.
+    """
+
+    global reaper
+
+    if REAPER_INTERVAL is None:
+        return
+
+    with reaper_lock:
+        if reaper is not None:
+            return
+
+        reaper = threading.Thread(target=reap_forever,
+                                  args=(REAPER_INTERVAL,),
+                                  name='geonode_safe-scratch-reaper')
+        reaper.daemon = True
+        reaper.start()
+
+
+def reap_forever(interval):
+    """Reap orphaned scratch directories every interval seconds
+    """
+
+    while True:
+        time.sleep(interval)
+        try:
+            reap_orphans()
+        except Exception, e:
+            logger.error('Could not reap scratch space %s: %s'
+                         % (SCRATCH_ROOT, e))
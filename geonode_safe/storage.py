@@ -5,31 +5,75 @@
 """
 
 import os
+import re
 import sys
 import time
+import uuid
 import numpy
+import shutil
 import urllib2
 import tempfile
 import contextlib
 import logging
 
 from zipfile import ZipFile
+from multiprocessing.pool import ThreadPool
+from osgeo import gdal
 
 from geonode_safe.utilities import LAYER_TYPES
 from geonode_safe.utilities import WCS_TEMPLATE
 from geonode_safe.utilities import WFS_TEMPLATE
+from geonode_safe.utilities import WFS_HITS_TEMPLATE
+from geonode_safe.utilities import WFS_DESCRIBE_TEMPLATE
+from geonode_safe.utilities import WFS_PROPERTY_TEMPLATE
+from geonode_safe.utilities import WFS_SORTED_TEMPLATE
+from geonode_safe.utilities import WFS_PAGE_TEMPLATE
+from geonode_safe.utilities import WFS_PAGE_SIZE_TEMPLATE
 from geonode_safe.utilities import extract_WGS84_geotransform
+from geonode_safe.utilities import extract_native_geotransform
+from geonode_safe.utilities import is_geographic
 from geonode_safe.utilities import is_sequence
-from geonode_safe.utilities import unique_filename
 from geonode_safe.utilities import write_keywords
 from geonode_safe.utilities import geotransform2resolution
 from geonode_safe.utilities import get_bounding_box
 from geonode_safe.utilities import bboxlist2string
 from geonode_safe.utilities import check_bbox_string
+from geonode_safe.utilities import bboxstring2list
+from geonode_safe.utilities import align_to_layer
+from geonode_safe.utilities import convert_to_geotiff
+from geonode_safe.utilities import write_geotiff
+from geonode_safe.utilities import build_overviews
+from geonode_safe.utilities import is_optimized_geotiff
+from geonode_safe.utilities import get_raster_statistics
+from geonode_safe.utilities import get_file_checksum
+from geonode_safe.utilities import statistics2keywords
+from geonode_safe.utilities import keywords2statistics
+from geonode_safe.utilities import sort_features_spatially
+from geonode_safe.utilities import build_spatial_index
+from geonode_safe.utilities import merge_shapefiles
+from geonode_safe.utilities import is_simplifiable
+from geonode_safe.utilities import simplify_shapefile
+from geonode_safe.utilities import get_crs
+from geonode_safe.utilities import extract_raster_window
+from geonode_safe.utilities import extract_vector_window
+from geonode_safe.utilities import memmap_raster
+from geonode_safe.utilities import cast_floats
+from geonode_safe.utilities import can_cast_raster
+from geonode_safe.utilities import get_tile_index
+from geonode_safe.utilities import rasterize_feature_counts
+from geonode_safe.scratch import make_scratch_dir
+from geonode_safe.scratch import remove_scratch_dir, remove_with
+from geonode_safe import scratch
+from geonode_safe.hotlayers import is_hot_layer, entry_key
+from geonode_safe.hotlayers import get_entry, release_entry, hold_view
+from geonode_safe.hotlayers import write_entry, read_entry
+from geonode_safe.cache import CACHE_DIR, cache_key, get_cached_file
+from geonode_safe.cache import add_to_cache
 
 # Do we really need to import these objects? should they be part of the API?
 from safe.storage.vector import Vector
 from safe.storage.raster import Raster
+from safe.storage.utilities import read_keywords
 from safe.api import read_layer
 
 from owslib.wcs import WebCoverageService
@@ -43,7 +87,107 @@ logger = logging.getLogger(__name__)
 
 INTERNAL_SERVER_URL = os.path.join(settings.GEOSERVER_BASE_URL, 'ows')
 
-def write_raster_data(data, projection, geotransform, filename, keywords=None):
+# Uploaded rasters are rewritten as tiled and compressed GeoTIFFs with
+# overviews unless this is switched off
+OPTIMIZE_RASTERS = getattr(settings, 'SAFE_OPTIMIZE_RASTERS', True)
+GEOTIFF_COMPRESSION = getattr(settings, 'SAFE_GEOTIFF_COMPRESSION', 'DEFLATE')
+OVERVIEW_RESAMPLING = getattr(settings, 'SAFE_OVERVIEW_RESAMPLING', 'NEAREST')
+
+# Downloads no larger than this number of bytes are kept in GDAL's
+# in-memory filesystem if in-memory downloads are enabled
+IN_MEMORY_DOWNLOADS = getattr(settings, 'SAFE_IN_MEMORY_DOWNLOADS', False)
+IN_MEMORY_MAX_SIZE = getattr(settings, 'SAFE_IN_MEMORY_MAX_SIZE',
+                             16 * 1024 ** 2)
+
+# Memory map uncompressed raster downloads rather than reading them
+# into memory. Data is then read on demand. Downloads in the cache
+# (SAFE_CACHE_DIR) are mapped there and so shared between processes.
+MEMMAP_RASTERS = getattr(settings, 'SAFE_MEMMAP_RASTERS', False)
+
+# Floating point type in which raster data is held in calculations and
+# stored on upload (None keeps the type of the data). Values that are not
+# represented within the relative tolerance RASTER_DTYPE_RTOL are kept in
+# their original type as are layers with the keyword precision: float64.
+RASTER_DTYPE = getattr(settings, 'SAFE_RASTER_DTYPE', 'float32')
+RASTER_DTYPE_RTOL = getattr(settings, 'SAFE_RASTER_DTYPE_RTOL', 1.0e-6)
+
+# Directory in which to record which tiles of raster layers contain valid
+# data (None means no records are kept)
+TILE_INDEX_DIR = getattr(settings, 'SAFE_TILE_INDEX_DIR', None)
+TILE_INDEX_SIZE = getattr(settings, 'SAFE_TILE_INDEX_SIZE', 256)
+
+# Leave out parts of hazard rasters without valid data from calculations
+SKIP_EMPTY_TILES = getattr(settings, 'SAFE_SKIP_EMPTY_TILES', False)
+
+# Vector exposure layers are summarised in grids counting their features
+# at these resolutions (in decimal degrees) if density grids are enabled.
+# Calculations for viewports wider or taller than SAFE_DENSITY_MIN_EXTENT
+# degrees use the grids instead of the features where possible.
+DENSITY_GRIDS = getattr(settings, 'SAFE_DENSITY_GRIDS', False)
+DENSITY_RESOLUTIONS = getattr(settings, 'SAFE_DENSITY_RESOLUTIONS', [])
+DENSITY_MIN_EXTENT = getattr(settings, 'SAFE_DENSITY_MIN_EXTENT', None)
+
+# Downloads are streamed to disk in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE = 1024 ** 2
+
+# Members of zipped shapefiles needed to open them
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+# Vector layers with more features than this are downloaded in pages
+# fetched in parallel. SAFE_WFS_PAGE_SIZES maps server urls to page sizes
+# overriding the default SAFE_WFS_PAGE_SIZE (None means no paging).
+WFS_PAGE_SIZE = getattr(settings, 'SAFE_WFS_PAGE_SIZE', None)
+WFS_PAGE_SIZES = getattr(settings, 'SAFE_WFS_PAGE_SIZES', {})
+
+# Attributes holding unique feature ids (e.g. primary keys) by which
+# features are sorted when a vector layer is downloaded in pages. The
+# first one a layer has is used. Layers with none of them are downloaded
+# in one request as the order of their features may change between pages.
+WFS_SORT_ATTRIBUTES = getattr(settings, 'SAFE_WFS_SORT_ATTRIBUTES',
+                              ['fid', 'FID', 'gid', 'id', 'ID', 'osm_id'])
+
+# Line and polygon exposure is simplified with a tolerance of this
+# fraction of the hazard raster resolution (None means no simplification)
+SIMPLIFICATION_FACTOR = getattr(settings, 'SAFE_SIMPLIFICATION_FACTOR', None)
+
+# Maximal number of pixels in each raster of a calculation. Rasters are
+# downloaded at coarser resolution if needed (None means no limit).
+MAX_PIXELS = getattr(settings, 'SAFE_MAX_PIXELS', None)
+
+# Pixel budget of the coarse pass of calculations asking for a preview
+PREVIEW_MAX_PIXELS = getattr(settings, 'SAFE_PREVIEW_MAX_PIXELS', 250000)
+
+# Calculations run in the background are saved every this many seconds.
+# Those not saved for SAFE_CALCULATION_TIMEOUT seconds, e.g. because the
+# process running them was recycled, are reported as failed.
+CALCULATION_HEARTBEAT = getattr(settings, 'SAFE_CALCULATION_HEARTBEAT', 10)
+CALCULATION_TIMEOUT = getattr(settings, 'SAFE_CALCULATION_TIMEOUT', 120)
+
+# Download raster pairs stored in the same projected coordinate reference
+# system in that system instead of having the server reproject them.
+# The impact layer is then stored in that system too.
+NATIVE_CRS_DOWNLOADS = getattr(settings, 'SAFE_NATIVE_CRS_DOWNLOADS', False)
+
+# Read layers of the internal GeoServer straight from its data directory
+# rather than through WCS/WFS where this gives the same result
+LOCAL_READS = getattr(settings, 'SAFE_LOCAL_READS', False)
+
+# Data directory of the internal GeoServer. Relative store locations
+# are resolved against it.
+GEOSERVER_DATA_DIR = getattr(settings, 'SAFE_GEOSERVER_DATA_DIR', None)
+
+# Maximal number of concurrent requests per download
+DOWNLOAD_THREADS = getattr(settings, 'SAFE_DOWNLOAD_THREADS', 4)
+
+# Compute value statistics of rasters at upload and store them as keywords
+RASTER_STATISTICS = getattr(settings, 'SAFE_RASTER_STATISTICS', True)
+
+# Uploaded shapefiles are sorted spatially and given a spatial index
+# unless this is switched off
+INDEX_SHAPEFILES = getattr(settings, 'SAFE_INDEX_SHAPEFILES', True)
+
+def write_raster_data(data, projection, geotransform, filename, keywords=None,
+                      dtype=None):
     """Write array to raster file with specified metadata and one data layer
 
     Input:
@@ -55,12 +199,79 @@ def write_raster_data(data, projection, geotransform, filename, keywords=None):
                        See e.g. http://www.gdal.org/gdal_tutorial.html
         filename: Output filename
         keywords: Optional dictionary
+        dtype: Optional floating point type to store values as.
+               If None (default) the type given by get_raster_dtype is used.
+               Values are stored in double precision if they are not
+               represented within SAFE_RASTER_DTYPE_RTOL.
 
     Note: The only format implemented is GTiff and the extension must be .tif
     """
 
-    R = Raster(data, projection, geotransform, keywords=keywords)
-    R.write_to_file(filename)
+    basename, extension = os.path.splitext(filename)
+    msg = ('Invalid file type for file %s. Only extension '
+           'tif allowed.' % filename)
+    assert extension == '.tif', msg
+
+    # Store in working precision. Values are cast in memory so that the
+    # file is written once.
+    if dtype is None:
+        dtype = get_raster_dtype(keywords)
+
+    A = numpy.array(data, dtype=numpy.float64, copy=False)
+    if dtype is not None:
+        A = cast_floats(A, dtype, rtol=RASTER_DTYPE_RTOL)
+
+    write_geotiff(A, projection, geotransform, filename)
+    if keywords is not None:
+        write_keywords(keywords, basename + '.keywords')
+
+
+def get_raster_dtype(keywords=None):
+    """Get floating point type to hold raster data in
+
+    Input
+        keywords: Optional dictionary of layer keywords
+
+    Output
+        dtype: SAFE_RASTER_DTYPE or None if the keyword precision
+               requires double precision or no type is configured
+    """
+
+    if keywords is not None and keywords.get('precision') == 'float64':
+        return None
+
+    return RASTER_DTYPE
+
+
+def cast_layer_data(layer, dtype):
+    """Hold data of raster layer in narrower floating point type
+
+    Input
+        layer: Raster layer
+        dtype: Floating point type, e.g. 'float32'
+
+    Output
+        True if the data was cast, False if the values are not represented
+        within SAFE_RASTER_DTYPE_RTOL, the data is memory mapped or it is
+        already of that type or narrower.
+    """
+
+    if isinstance(layer.data, numpy.memmap):
+        # Keep pages shared with other processes
+        return False
+
+    if layer.data is None:
+        A = layer.get_data(nan=False)
+    else:
+        A = layer.data
+
+    B = cast_floats(A, dtype, rtol=RASTER_DTYPE_RTOL)
+    if B is A:
+        return False
+
+    # FIXME: Don't monkeypatch the layer object
+    layer.data = B
+    return True
 
 
 def write_vector_data(data, projection, geometry, filename, keywords=None):
@@ -130,9 +341,18 @@ def get_metadata_from_layer(layer):
                                                          # Get both resx
                                                          # and resy
                                                          isotropic=False)
+
+        # Native grid which may be projected
+        crs, geotransform, bbox = extract_native_geotransform(layer)
+        metadata['native_crs'] = crs
+        metadata['native_geotransform'] = geotransform
+        metadata['native_bounding_box'] = bbox
     else:
         metadata['resolution'] = None
         metadata['geotransform'] = None
+        metadata['native_crs'] = None
+        metadata['native_geotransform'] = None
+        metadata['native_bounding_box'] = None
 
     # Metadata common to both raster and vector data
     metadata['bounding_box'] = layer.boundingBoxWGS84
@@ -165,6 +385,9 @@ def get_metadata_from_layer(layer):
     if 'title' in keyword_dict:
         metadata['title'] = keyword_dict['title']
 
+    # Value statistics computed when the layer was uploaded (if any)
+    metadata['statistics'] = keywords2statistics(keyword_dict)
+
     # FIXME (Ole): The statement below does not raise an Exception,
     # and nothing is written to the log file. See issue #170
     #raise Exception('weird')
@@ -232,33 +455,354 @@ def get_metadata(server_url, layer_name=None):
         return metadata
 
 
-def get_file(download_url, suffix):
+def get_file(download_url, suffix, dirname=None, max_memory_size=None):
     """Download a file from an HTTP server.
+
+    Input
+        download_url: URL of file
+        suffix: Extension of the file to create, e.g. '.tif'
+        dirname: Directory in which to store the file. If None a new
+                 scratch directory is created.
+        max_memory_size: If the response is no larger than this number of
+                         bytes it is kept in GDAL's in-memory filesystem
+                         instead of being written to disk.
+                         If None (default) the file is always written to disk.
+
+    Output
+        filename: Absolute name of downloaded file or name of in-memory file
+                  of the form /vsimem/... In the latter case the caller must
+                  release it with gdal.Unlink when done.
+    """
+
+    with contextlib.closing(urllib2.urlopen(download_url)) as f:
+        # Read as much as may be kept in memory plus one byte
+        # to tell whether there is more
+        if max_memory_size is None:
+            data = f.read(DOWNLOAD_CHUNK_SIZE)
+        else:
+            data = f.read(max(max_memory_size + 1, DOWNLOAD_CHUNK_SIZE))
+
+        # Service exceptions are small documents in place of the data
+        if '<ServiceException>' in data:
+            msg = ('File download failed.\n'
+                   'URL: %s\n'
+                   'Error message: %s' % (download_url, data + f.read()))
+            raise Exception(msg)
+
+        if max_memory_size is not None and len(data) <= max_memory_size:
+            filename = '/vsimem/%s%s' % (uuid.uuid4().hex, suffix)
+            gdal.FileFromMemBuffer(filename, data)
+            return filename
+
+        # Stream to disk chunk by chunk and return filename
+        if dirname is None:
+            dirname = make_scratch_dir('download')
+
+        fd, filename = tempfile.mkstemp(suffix=suffix, dir=dirname)
+        with os.fdopen(fd, 'wb') as t:
+            t.write(data)
+            shutil.copyfileobj(f, t, DOWNLOAD_CHUNK_SIZE)
+
+    return os.path.abspath(filename)
+
+
+def extract_shapefile(zipname, dirname):
+    """Extract shapefile from zip file
+
+    Input
+        zipname: Name of zip file containing one shapefile
+        dirname: Directory in which to place the extracted files
+
+    Output
+        filename: Name of extracted .shp file
+
+    Only the members needed to open the shapefile are extracted and
+    they are copied in chunks without holding them in memory.
     """
 
-    tempdir = '/tmp/%s' % str(time.time())
-    os.mkdir(tempdir)
-    t = tempfile.NamedTemporaryFile(delete=False,
-                                    suffix=suffix,
-                                    dir=tempdir)
+    with contextlib.closing(ZipFile(zipname)) as zf:
+        namelist = zf.namelist()
+        (shpname,) = [name for name in namelist
+                      if name.lower().endswith('.shp')]
+
+        for name in namelist:
+            extension = os.path.splitext(name)[1].lower()
+            if extension not in SHAPEFILE_EXTENSIONS:
+                continue
+
+            target = os.path.join(dirname, os.path.basename(name))
+            with contextlib.closing(zf.open(name)) as src:
+                with open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+
+    return os.path.join(dirname, os.path.basename(shpname))
+
+
+def is_memory_file(filename):
+    """Determine if filename refers to GDAL's in-memory filesystem
+    """
+
+    return filename.startswith('/vsimem/')
+
 
+def get_feature_count(server_url, layer_name, bbox_string):
+    """Get number of features of vector layer within bounding box
+
+    Input
+        server_url: URL of WFS server
+        layer_name: Layer identifier of the form workspace:name
+        bbox_string: Bounding box with format 'W,S,E,N'
+
+    Output
+        Number of features as reported by a WFS 1.1.0 hits request
+    """
+
+    download_url = WFS_HITS_TEMPLATE % (server_url, layer_name, bbox_string)
     with contextlib.closing(urllib2.urlopen(download_url)) as f:
         data = f.read()
 
-    if '<ServiceException>' in data:
-        msg = ('File download failed.\n'
+    match = re.search('numberOfFeatures="([0-9]+)"', data)
+    if match is None:
+        msg = ('Could not get number of features for layer %s.\n'
                'URL: %s\n'
-               'Error message: %s' % (download_url, data))
+               'Response: %s' % (layer_name, download_url, data))
         raise Exception(msg)
 
-    # Write and return filename
-    t.write(data)
-    filename = os.path.abspath(t.name)
+    return int(match.group(1))
+
+
+def get_feature_attributes(server_url, layer_name):
+    """Get attribute names of vector layer from its WFS schema
+
+    Input
+        server_url: URL of WFS server
+        layer_name: Layer identifier of the form workspace:name
+
+    Output
+        geometry_names: List of names of geometry attributes
+        attribute_names: List of names of all other attributes
+    """
+
+    download_url = WFS_DESCRIBE_TEMPLATE % (server_url, layer_name)
+    with contextlib.closing(urllib2.urlopen(download_url)) as f:
+        data = f.read()
+
+    geometry_names = []
+    attribute_names = []
+    for element in re.findall('<xsd:element\s[^>]*>', data):
+        # Skip the feature type itself
+        if 'substitutionGroup=' in element:
+            continue
+
+        name = re.search('name="([^"]+)"', element)
+        datatype = re.search('type="([^"]+)"', element)
+        if name is None or datatype is None:
+            continue
+
+        if datatype.group(1).startswith('gml:'):
+            geometry_names.append(name.group(1))
+        else:
+            attribute_names.append(name.group(1))
+
+    if len(geometry_names) == 0:
+        msg = ('Could not find geometry attribute of layer %s.\n'
+               'URL: %s\n'
+               'Response: %s' % (layer_name, download_url, data))
+        raise Exception(msg)
+
+    return geometry_names, attribute_names
+
+
+def get_wfs_page_size(server_url):
+    """Get number of features per WFS page for server or None for no paging
+    """
+
+    return WFS_PAGE_SIZES.get(server_url, WFS_PAGE_SIZE)
+
+
+def get_sort_attribute(server_url, layer_name):
+    """Get attribute by which to sort features of vector layer in pages
+
+    Input
+        server_url: URL of WFS server
+        layer_name: Layer identifier of the form workspace:name
+
+    Output
+        Name of first attribute in SAFE_WFS_SORT_ATTRIBUTES the layer has
+        or None if it has none of them
+    """
+
+    _, attribute_names = get_feature_attributes(server_url, layer_name)
+    for name in WFS_SORT_ATTRIBUTES:
+        if name in attribute_names:
+            return name
+
+    return None
+
+
+def get_shapefile_pages(download_url, number_of_features, page_size,
+                        dirname=None):
+    """Download zipped shapefile in pages and merge them
+
+    Input
+        download_url: WFS GetFeature URL with outputFormat SHAPE-ZIP and
+                      features sorted (see WFS_SORTED_TEMPLATE)
+        number_of_features: Expected number of features
+        page_size: Number of features per request
+        dirname: Directory in which to store the result. If None a new
+                 scratch directory is created.
+
+    Output
+        filename: Name of merged shapefile
+
+    Pages are fetched concurrently by up to SAFE_DOWNLOAD_THREADS threads.
+    The last page has no upper limit so features added since the number
+    was determined are not lost.
+    """
+
+    if dirname is None:
+        dirname = make_scratch_dir('download')
+
+    urls = []
+    for start in range(0, number_of_features, page_size):
+        url = download_url + WFS_PAGE_TEMPLATE % start
+        if start + page_size < number_of_features:
+            url += WFS_PAGE_SIZE_TEMPLATE % page_size
+        urls.append(url)
+
+    def get_page(url):
+        zipname = get_file(url, '.zip', dirname=dirname)
+        pagedir = tempfile.mkdtemp(dir=dirname)
+        filename = extract_shapefile(zipname, pagedir)
+        os.remove(zipname)
+        return filename
+
+    pool = ThreadPool(max(1, min(DOWNLOAD_THREADS, len(urls))))
+    try:
+        filenames = pool.map(get_page, urls)
+    finally:
+        pool.terminate()
+
+    # Merge pages in their original order and remove them
+    mergedir = tempfile.mkdtemp(dir=dirname)
+    filename = os.path.join(mergedir, os.path.basename(filenames[0]))
+    merge_shapefiles(filenames, filename)
+    for page in filenames:
+        shutil.rmtree(os.path.dirname(page))
+
     return filename
 
 
+def get_layer_filename(layer_name):
+    """Get name of file from which the internal GeoServer reads a layer
+
+    Input
+        layer_name: Layer identifier of the form workspace:name
+
+    Output
+        filename: Absolute name of the raster or vector file of the layer's
+                  store or None if it is not a file that can be read here
+    """
 
-def download(server_url, layer_name, bbox, resolution=None):
+    workspace, name = layer_name.split(':')
+    try:
+        layer = Layer.objects.get(workspace=workspace, name=name)
+        cat = Layer.objects.gs_catalog
+        store = cat.get_store(layer.store, cat.get_workspace(workspace))
+        if layer.storeType == 'coverageStore':
+            url = store.url
+        else:
+            url = store.connection_parameters.get('url')
+    except Exception, e:
+        logger.debug('Could not find file of layer %s: %s'
+                     % (layer_name, e))
+        return None
+
+    if url is None or not url.startswith('file:'):
+        return None
+
+    filename = url[len('file:'):]
+    if not os.path.isabs(filename):
+        if GEOSERVER_DATA_DIR is None:
+            return None
+        filename = os.path.join(GEOSERVER_DATA_DIR, filename)
+
+    # Directory stores and the like are not handled
+    if not os.path.isfile(filename):
+        return None
+
+    return filename
+
+
+def read_local_window(server_url, layer_name, metadata, bbox,
+                      resolution=None, crs='EPSG:4326', attributes=None,
+                      dirname=None):
+    """Read layer of the internal GeoServer straight from its data directory
+
+    Input
+        server_url, layer_name, resolution, crs, attributes: See download
+        metadata: Layer metadata as obtained from get_metadata
+        bbox: Bounding box [W, S, E, N] in crs
+        dirname: Directory in which to store the file. If None a new
+                 scratch directory is created.
+
+    Output
+        filename: Name of GeoTIFF or shapefile with the requested part of
+                  the layer or None if the layer can not be read like this.
+                  In the latter case it must be downloaded through WCS/WFS.
+
+    Only requests that GeoServer would serve without reprojection or
+    resampling are handled here, so the result is the same either way.
+    Disabled unless SAFE_LOCAL_READS is set.
+    """
+
+    if not LOCAL_READS or server_url != INTERNAL_SERVER_URL:
+        return None
+
+    source = get_layer_filename(layer_name)
+    if source is None:
+        return None
+
+    # The file must be in the requested coordinate reference system
+    if is_geographic(crs):
+        crs = 'EPSG:4326'
+    if get_crs(source) != crs:
+        return None
+
+    data_type = metadata['layertype']
+    if data_type == 'raster':
+        # and at the requested resolution
+        if resolution is not None:
+            fid = gdal.Open(source, gdal.GA_ReadOnly)
+            native_resolution = geotransform2resolution(fid.GetGeoTransform())
+            fid = None
+            if not numpy.allclose(resolution, native_resolution,
+                                  rtol=1.0e-9, atol=0):
+                return None
+    elif resolution is not None:
+        return None
+
+    if dirname is None:
+        dirname = make_scratch_dir('download')
+
+    if data_type == 'raster':
+        fd, filename = tempfile.mkstemp(suffix='.tif', dir=dirname)
+        os.close(fd)
+        extract_raster_window(source, bbox, filename)
+    else:
+        # Shapefiles go in a directory of their own
+        filename = os.path.join(tempfile.mkdtemp(dir=dirname),
+                                os.path.basename(source))
+        extract_vector_window(source, bbox, filename, attributes=attributes)
+
+    logger.debug('Read layer %s from %s' % (layer_name, source))
+    return os.path.abspath(filename)
+
+
+def download(server_url, layer_name, bbox, resolution=None,
+             scratch_dir=None, in_memory=None, attributes=None,
+             simplify_tolerance=None, crs=None, start_index=None,
+             max_features=None, read=True):
     """Download the source data of a given layer.
 
     Input
@@ -277,10 +821,76 @@ def download(server_url, layer_name, bbox, resolution=None):
                     and resy.
                     If resolution is None, the 'native' resolution of
                     the dataset is used.
+        scratch_dir: Directory in which to store downloaded files, e.g. one
+                     made by make_scratch_dir for the calculation at hand.
+                     If None a new scratch directory is created which is
+                     removed when the returned layer is garbage collected.
+        in_memory: Flag controlling whether responses no larger than
+                   SAFE_IN_MEMORY_MAX_SIZE bytes are kept in memory
+                   rather than written to disk. Keywords are then attached
+                   to the layer directly and the filename of the returned
+                   layer does not exist on disk.
+                   If None (default) the setting SAFE_IN_MEMORY_DOWNLOADS
+                   is used.
+        attributes: Optional list of attribute names to download in case of
+                    vector layers. Names the layer doesn't have are ignored.
+                    Geometry is always included. If None (default) all
+                    attributes are downloaded.
+        simplify_tolerance: Optional tolerance (in decimal degrees) for
+                            topology preserving simplification of line and
+                            polygon layers after download. Layers kept in
+                            memory are small and are never simplified.
+        crs: Optional coordinate reference system of bbox and resolution
+             for raster layers, e.g. 'EPSG:32750'. The raster is returned
+             in this system. If None (default) WGS84 geographic coordinates
+             (EPSG:4326) are used.
+        start_index: Optional index of first feature to download in case
+                     of vector layers (counting from 0)
+        max_features: Optional maximal number of features to download in
+                      case of vector layers. Together with start_index this
+                      allows a large layer to be processed one part at a
+                      time.
+        read: If False the data is only written to scratch_dir, together
+              with its keywords, and the filename is returned rather than
+              a layer. This requires scratch_dir and implies in_memory
+              False.
+
+    Layers of the internal GeoServer are read straight from its data
+    directory when SAFE_LOCAL_READS is set (see read_local_window).
+    Rasters named in SAFE_HOT_LAYERS are views onto the hot layer store
+    (see get_hot_layer) unless in_memory is False.
+
+    Downloads written to disk are cached in SAFE_CACHE_DIR if set.
 
     Layer geometry type must be either 'vector' or 'raster'
     """
 
+    if not read:
+        msg = ('Argument scratch_dir must be given when only the file of '
+               'layer %s is requested' % layer_name)
+        assert scratch_dir is not None, msg
+        in_memory = False
+
+    if scratch_dir is None:
+        # Download into directory of our own living as long as the layer
+        dirname = make_scratch_dir('download')
+        try:
+            lyr = download(server_url, layer_name, bbox,
+                           resolution=resolution, scratch_dir=dirname,
+                           in_memory=in_memory, attributes=attributes,
+                           simplify_tolerance=simplify_tolerance, crs=crs,
+                           start_index=start_index, max_features=max_features)
+        except:
+            remove_scratch_dir(dirname)
+            raise
+
+        if len(os.listdir(dirname)) == 0:
+            # Nothing was written, e.g. for cached and hot layers
+            remove_scratch_dir(dirname)
+        else:
+            remove_with(lyr, dirname)
+        return lyr
+
     # Input checks
     assert isinstance(server_url, basestring)
     try:
@@ -300,7 +910,8 @@ def download(server_url, layer_name, bbox, resolution=None):
     assert len(layer_name.split(':')) == 2, msg
 
     if isinstance(bbox, list) or isinstance(bbox, tuple):
-        bbox_string = bboxlist2string(bbox)
+        # Keep enough decimals to preserve alignment with pixel grids
+        bbox_string = bboxlist2string(bbox, decimals=12)
     elif isinstance(bbox, basestring):
         # Remove spaces if any (GeoServer freaks if string has spaces)
         bbox_string = ','.join([x.strip() for x in bbox.split(',')])
@@ -310,7 +921,11 @@ def download(server_url, layer_name, bbox, resolution=None):
         raise Exception(msg)
 
     # Check integrity of bounding box
-    check_bbox_string(bbox_string)
+    if crs is None:
+        crs = 'EPSG:4326'
+
+    if is_geographic(crs):
+        check_bbox_string(bbox_string)
 
     # Check resolution
     if resolution is not None:
@@ -334,55 +949,478 @@ def download(server_url, layer_name, bbox, resolution=None):
                        % (res, str(e)))
                 raise RisikoException(msg)
 
+    if in_memory is None:
+        in_memory = IN_MEMORY_DOWNLOADS
+
+    if in_memory:
+        max_memory_size = IN_MEMORY_MAX_SIZE
+    else:
+        max_memory_size = None
+
     # Create REST request and download file
     template = None
     layer_metadata = get_metadata(server_url, layer_name)
 
     data_type = layer_metadata['layertype']
-    if data_type == 'vector':
+
+    # Serve hot layers from the store shared with other processes
+    # unless a file is needed
+    if (data_type == 'raster' and in_memory is not False and
+        is_geographic(crs) and is_hot_layer(layer_name)):
+        lyr = get_hot_layer(server_url, layer_name, layer_metadata,
+                            bboxstring2list(bbox_string), resolution)
+        if lyr is not None:
+            # FIXME (Ariel) Don't monkeypatch the layer object
+            lyr.metadata = layer_metadata
+            return lyr
+
+    # Reuse earlier download of the same data if cached
+    key = None
+    cached_filename = None
+    if CACHE_DIR is not None:
+        if attributes is not None:
+            attributes = sorted(attributes)
+        if resolution is not None:
+            resolution = tuple(resolution)
+        key = cache_key(server_url, layer_name, layer_metadata,
+                        bbox=bbox_string, resolution=resolution, crs=crs,
+                        attributes=attributes,
+                        simplify_tolerance=simplify_tolerance,
+                        start_index=start_index, max_features=max_features)
+        cached_filename = get_cached_file(key)
+
+    # Read from disk if the layer belongs to the internal GeoServer
+    if cached_filename is not None:
+        filename = cached_filename
+    elif start_index is None and max_features is None:
+        filename = read_local_window(server_url, layer_name, layer_metadata,
+                                     bboxstring2list(bbox_string),
+                                     resolution=resolution, crs=crs,
+                                     attributes=attributes,
+                                     dirname=scratch_dir)
+    else:
+        filename = None
+
+    if filename is not None:
+        thefilename = filename
+    elif data_type == 'vector':
 
         if resolution is not None:
             msg = ('Resolution was requested for Vector layer %s. '
                    'This can only be done for raster layers.' % layer_name)
             raise RisikoException(msg)
 
-        template = WFS_TEMPLATE
+        if not is_geographic(crs):
+            msg = ('Coordinate reference system %s was requested for Vector '
+                   'layer %s. Only EPSG:4326 is supported for vector '
+                   'layers.' % (crs, layer_name))
+            raise RisikoException(msg)
+
         suffix = '.zip'
-        download_url = template % (server_url, layer_name, bbox_string)
-        thefilename = get_file(download_url, suffix)
-        dirname = os.path.dirname(thefilename)
-        t = open(thefilename, 'r')
-        zf = ZipFile(t)
-        namelist = zf.namelist()
-        zf.extractall(path=dirname)
-        (shpname,) = [name for name in namelist if '.shp' in name]
-        filename = os.path.join(dirname, shpname)
+
+        # Split large requests into pages if configured for this server
+        page_size = get_wfs_page_size(server_url)
+        paged = start_index is not None or max_features is not None
+        number_of_features = None
+        if not paged and page_size is not None:
+            number_of_features = get_feature_count(server_url, layer_name,
+                                                   bbox_string)
+            paged = number_of_features > page_size
+
+        # Pages are only well defined if the features are sorted
+        sort_attribute = None
+        if paged:
+            sort_attribute = get_sort_attribute(server_url, layer_name)
+
+        if sort_attribute is not None:
+            download_url = WFS_SORTED_TEMPLATE % (server_url, layer_name,
+                                                  bbox_string,
+                                                  sort_attribute)
+        elif start_index is not None or max_features is not None:
+            msg = ('Vector layer %s has none of the attributes %s by which '
+                   'its features can be sorted, so it cannot be downloaded '
+                   'in parts.' % (layer_name, WFS_SORT_ATTRIBUTES))
+            raise RisikoException(msg)
+        else:
+            # Download in one request
+            number_of_features = None
+            download_url = WFS_TEMPLATE % (server_url, layer_name,
+                                           bbox_string)
+
+        # Restrict download to the requested attributes
+        if attributes is not None:
+            geometry_names, attribute_names = get_feature_attributes(
+                server_url, layer_name)
+            names = geometry_names + [name for name in attribute_names
+                                      if name in attributes]
+            download_url += WFS_PROPERTY_TEMPLATE % ','.join(names)
+
+        # Restrict download to the requested features
+        if start_index is not None:
+            download_url += WFS_PAGE_TEMPLATE % start_index
+        if max_features is not None:
+            download_url += WFS_PAGE_SIZE_TEMPLATE % max_features
+
+        if number_of_features is not None:
+            # Pages are merged into one shapefile on disk
+            thefilename = filename = get_shapefile_pages(download_url,
+                                                         number_of_features,
+                                                         page_size,
+                                                         dirname=scratch_dir)
+        else:
+            thefilename = get_file(download_url, suffix, dirname=scratch_dir,
+                                   max_memory_size=max_memory_size)
+
+            if is_memory_file(thefilename):
+                # Read shapefile straight from the zip file in memory
+                namelist = gdal.ReadDir('/vsizip/' + thefilename)
+                (shpname,) = [name for name in namelist
+                              if name.endswith('.shp')]
+                filename = '/vsizip/%s/%s' % (thefilename, shpname)
+            else:
+                # Extract what is needed into a directory of its own
+                # and discard the zip file
+                dirname = tempfile.mkdtemp(dir=os.path.dirname(thefilename))
+                filename = extract_shapefile(thefilename, dirname)
+                os.remove(thefilename)
+                thefilename = filename
     elif data_type == 'raster':
 
         if resolution is None:
-            # Get native resolution and use that
-            resolution = layer_metadata['resolution']
-            #resolution = (resolution, resolution)  #FIXME (Ole): Make nicer
+            native = not is_geographic(crs)
+            if native:
+                msg = ('Native resolution of layer %s was requested in '
+                       '%s which is not its native coordinate reference '
+                       'system %s' % (layer_name, crs,
+                                      layer_metadata['native_crs']))
+                assert crs == layer_metadata['native_crs'], msg
+
+                resolution = geotransform2resolution(
+                    layer_metadata['native_geotransform'])
+            else:
+                # Get native resolution and use that
+                resolution = layer_metadata['resolution']
+                #resolution = (resolution, resolution)  #FIXME (Ole)
+
+            # Align with native pixel grid to avoid resampling
+            aligned_bbox = align_to_layer(bboxstring2list(bbox_string),
+                                          layer_metadata, native=native)
+            bbox_string = bboxlist2string(aligned_bbox, decimals=12)
 
         # Download raster using specified bounding box and resolution
         template = WCS_TEMPLATE
         suffix = '.tif'
-        download_url = template % (server_url, layer_name, bbox_string,
+        download_url = template % (server_url, layer_name, crs, bbox_string,
                                    resolution[0], resolution[1])
-        filename = get_file(download_url, suffix)
+        thefilename = filename = get_file(download_url, suffix,
+                                          dirname=scratch_dir,
+                                          max_memory_size=max_memory_size)
+
+    # Thin out vertices that are below the resolution of interest
+    if (data_type == 'vector' and simplify_tolerance is not None and
+        cached_filename is None and not is_memory_file(thefilename) and
+        is_simplifiable(filename)):
+        dirname = tempfile.mkdtemp(dir=os.path.dirname(filename))
+        simplified = os.path.join(dirname, os.path.basename(filename))
+        simplify_shapefile(filename, simplified, simplify_tolerance)
+        shutil.rmtree(os.path.dirname(filename))
+        thefilename = filename = simplified
 
-    # Write keywords file
     keywords = layer_metadata['keywords']
-    write_keywords(keywords, os.path.splitext(filename)[0] + '.keywords')
-
-    # Instantiate layer from file
-    lyr = read_layer(filename)
+    if is_memory_file(thefilename):
+        # Instantiate layer from memory. Data is read in its entirety
+        # by read_layer so the memory can be released straight away.
+        try:
+            lyr = read_layer(filename)
+        finally:
+            gdal.Unlink(thefilename)
+
+        # Attach keywords as they would have been read from file
+        lyr.keywords = {}
+        for key, value in keywords.items():
+            if value is not None:
+                value = str(value).strip().replace(',', '')
+            lyr.keywords[key.strip()] = value
+    else:
+        # File shared by all users of this download (see cache.py)
+        shared_filename = filename
+
+        # Keywords of cached files were stored with them
+        if cached_filename is None:
+            # Write keywords file
+            write_keywords(keywords,
+                           os.path.splitext(filename)[0] + '.keywords')
+
+            if key is not None:
+                shared_filename = add_to_cache(key, filename)
+
+        if not read:
+            return filename
+
+        # Instantiate layer from file
+        lyr = None
+        if data_type == 'raster' and MEMMAP_RASTERS:
+            lyr = read_mapped_raster(filename, shared_filename)
+        if lyr is None:
+            lyr = read_layer(filename)
+
+    # Hold raster data in working precision
+    if lyr.is_raster:
+        dtype = get_raster_dtype(keywords)
+        if dtype is not None:
+            cast_layer_data(lyr, dtype)
 
     # FIXME (Ariel) Don't monkeypatch the layer object
     lyr.metadata = layer_metadata
     return lyr
 
 
+def tile_index_filename(layer_name):
+    """Get name of file recording valid tiles of layer of internal GeoServer
+    """
+
+    basename = layer_name.replace(':', '__') + '.npz'
+    return os.path.join(TILE_INDEX_DIR, basename)
+
+
+def save_tile_index(layer_name, index):
+    """Record tile index of layer of the internal GeoServer
+
+    Input
+        layer_name: Layer identifier of the form workspace:name
+        index: Tile index as obtained from get_tile_index. An entry
+               checksum holding the checksum keyword of the layer is
+               recorded too if present (see load_tile_index).
+
+    Nothing is done unless SAFE_TILE_INDEX_DIR is set.
+    """
+
+    if TILE_INDEX_DIR is None:
+        return
+
+    try:
+        os.makedirs(TILE_INDEX_DIR)
+    except OSError:
+        # Already there (possibly made by another process)
+        if not os.path.isdir(TILE_INDEX_DIR):
+            raise
+
+    # Write to temporary file and move it in place so readers
+    # never see a partial file
+    fd, tmp_filename = tempfile.mkstemp(suffix='.npz', dir=TILE_INDEX_DIR)
+    os.close(fd)
+    try:
+        numpy.savez(tmp_filename,
+                    valid=index['valid'],
+                    geotransform=numpy.array(index['geotransform']),
+                    shape=numpy.array(index['shape']),
+                    tile_size=index['tile_size'],
+                    crs=str(index['crs']),
+                    checksum=str(index.get('checksum')))
+        os.rename(tmp_filename, tile_index_filename(layer_name))
+    except:
+        os.remove(tmp_filename)
+        raise
+
+
+def load_tile_index(layer_name, metadata=None):
+    """Get recorded tile index of layer of the internal GeoServer
+
+    Input
+        layer_name: Layer identifier of the form workspace:name
+        metadata: Optional layer metadata as returned by get_metadata.
+                  The index is then only returned if it was recorded for
+                  the data and grid the metadata describes.
+
+    Output
+        index: Tile index as obtained from get_tile_index or None if
+               none has been recorded or it is out of date, e.g. because
+               the layer was replaced without recording a new index
+    """
+
+    if TILE_INDEX_DIR is None:
+        return None
+
+    filename = tile_index_filename(layer_name)
+    if not os.path.isfile(filename):
+        return None
+
+    data = numpy.load(filename)
+    try:
+        crs = str(data['crs'])
+        if crs == 'None':
+            crs = None
+
+        # Indices recorded without checksum are never taken as current
+        checksum = None
+        if 'checksum' in data.files:
+            checksum = str(data['checksum'])
+            if checksum == 'None':
+                checksum = None
+
+        index = {'valid': data['valid'],
+                 'geotransform': tuple(data['geotransform']),
+                 'shape': tuple(data['shape']),
+                 'tile_size': int(data['tile_size']),
+                 'crs': crs,
+                 'checksum': checksum}
+    finally:
+        data.close()
+
+    if metadata is not None:
+        keywords = metadata.get('keywords') or {}
+        geotransform = metadata.get('native_geotransform')
+        if (checksum is None or checksum != str(keywords.get('checksum')) or
+            geotransform is None or
+            not numpy.allclose(geotransform, index['geotransform'],
+                               rtol=1.0e-12, atol=0)):
+            logger.info('Ignoring tile index of layer %s recorded for other '
+                        'data' % layer_name)
+            return None
+
+    return index
+
+
+def get_hot_layer(server_url, layer_name, metadata, bbox, resolution=None):
+    """Get raster layer viewing data held in the hot layer store
+
+    Input
+        server_url, layer_name: Layer as given to download
+        metadata: Layer metadata as returned by get_metadata
+        bbox: Bounding box [W, S, E, N] in WGS84 geographic coordinates
+        resolution: Optional (resx, resy). Only the native resolution of
+                    the layer can be served from the store.
+
+    Output
+        layer: Raster layer whose data is a read-only view onto the
+               memory mapped data of the store or None if the request
+               can't be served from it, i.e. bbox does not fall on pixel
+               boundaries within the layer or resolution is not native.
+
+    The layer is added to the store on first use by downloading all of it.
+    """
+
+    native_resolution = metadata['resolution']
+    if resolution is None:
+        resolution = native_resolution
+        bbox = align_to_layer(bbox, metadata)
+    elif not numpy.allclose(resolution, native_resolution, rtol=1.0e-6,
+                            atol=0):
+        return None
+
+    def build(dirname):
+        with scratch.scratch_dir('hot') as workdir:
+            lyr = download(server_url, layer_name, metadata['bounding_box'],
+                           scratch_dir=workdir, in_memory=False)
+            A = lyr.get_data(nan=True)
+            dtype = get_raster_dtype(metadata['keywords'])
+            if dtype is not None:
+                A = cast_floats(A, dtype, rtol=RASTER_DTYPE_RTOL)
+
+            write_entry(dirname, A, lyr.get_projection(),
+                        lyr.get_geotransform(), lyr.get_keywords())
+
+    dirname = get_entry(entry_key(server_url, layer_name, metadata), build)
+    try:
+        A, info = read_entry(dirname)
+
+        # Window of bbox in the grid of the store
+        x0, dx, _, y0, _, dy = info['geotransform']
+        window = [(bbox[0] - x0) / dx, (y0 - bbox[3]) / -dy,
+                  (bbox[2] - x0) / dx, (y0 - bbox[1]) / -dy]
+        j0, i0, j1, i1 = [int(round(x)) for x in window]
+        if (not numpy.allclose(window, [j0, i0, j1, i1], rtol=0,
+                               atol=1.0e-6) or
+            i0 < 0 or j0 < 0 or i1 > A.shape[0] or j1 > A.shape[1] or
+            i1 <= i0 or j1 <= j0):
+            release_entry(dirname)
+            return None
+
+        view = A[i0:i1, j0:j1]
+        geotransform = (x0 + j0 * dx, dx, 0.0, y0 + i0 * dy, 0.0, dy)
+        lyr = Raster(view, info['projection'], geotransform,
+                     keywords=info['keywords'])
+    except:
+        release_entry(dirname)
+        raise
+
+    # Keep entry referenced while the view is in use
+    hold_view(view, dirname)
+
+    return lyr
+
+
+class MappedRaster(Raster):
+    """Raster layer whose data is memory mapped rather than read
+
+    Input
+        filename: Name of uncompressed GeoTIFF file
+        data: Memory mapped grid of filename or of an identical copy of
+              it as obtained from memmap_raster
+
+    Only the header of filename and its keywords file are read.
+    """
+
+    def __init__(self, filename, data):
+        src = gdal.Open(filename, gdal.GA_ReadOnly)
+        if src is None:
+            msg = 'Could not open raster file %s' % filename
+            raise Exception(msg)
+
+        projection = src.GetProjection()
+        geotransform = src.GetGeoTransform()
+        self.nodata = src.GetRasterBand(1).GetNoDataValue()
+        src = None
+
+        basename = os.path.splitext(filename)[0]
+        keywords_filename = basename + '.keywords'
+        if os.path.isfile(keywords_filename):
+            keywords = read_keywords(keywords_filename)
+        else:
+            keywords = {}
+
+        Raster.__init__(self, data=data, projection=projection,
+                        geotransform=geotransform,
+                        name=os.path.basename(basename), keywords=keywords)
+
+        # Keep the mapping rather than any copy made of it
+        self.data = data
+        self.filename = filename
+
+    def get_nodata_value(self):
+        """Get nodata value of the file or the default of SAFE
+        """
+
+        if self.nodata is not None:
+            return self.nodata
+        else:
+            return Raster.get_nodata_value(self)
+
+
+def read_mapped_raster(filename, shared_filename=None):
+    """Read raster layer with its data memory mapped
+
+    Input
+        filename: Name of uncompressed GeoTIFF file
+        shared_filename: Optional name of an identical copy of the file
+                         used by other processes, e.g. in the download
+                         cache. It is mapped instead of filename so that
+                         the pages of the data are shared with them.
+
+    Output
+        layer: MappedRaster or None if the file does not allow mapping
+    """
+
+    if shared_filename is None:
+        shared_filename = filename
+
+    A = memmap_raster(shared_filename)
+    if A is None:
+        return None
+
+    return MappedRaster(filename, A)
+
+
 def dummy_save(filename, title, user, metadata=''):
     """Take a file-like object and uploads it to a GeoNode
     """
@@ -512,15 +1550,17 @@ def check_layer(layer, full=False):
     assert len(bbox) == 4
 
     if full:
-        # Check that layer can be downloaded again
-        downloaded_layer = download(INTERNAL_SERVER_URL, layer_name, bbox)
-        assert os.path.exists(downloaded_layer.filename)
+        with scratch.scratch_dir('check') as dirname:
+            # Check that layer can be downloaded again
+            downloaded_layer = download(INTERNAL_SERVER_URL, layer_name, bbox,
+                                        scratch_dir=dirname)
+            assert os.path.exists(downloaded_layer.filename)
 
-        # Check integrity between Django layer and file
-        assert_bounding_box_matches(layer, downloaded_layer.filename)
+            # Check integrity between Django layer and file
+            assert_bounding_box_matches(layer, downloaded_layer.filename)
 
-        # Read layer and verify
-        L = read_layer(downloaded_layer.filename)
+            # Read layer and verify
+            L = read_layer(downloaded_layer.filename)
 
         # Could do more here
         #print dir(L)
@@ -530,7 +1570,8 @@ def check_layer(layer, full=False):
 
 def save_file_to_geonode(filename, user=None, title=None,
                          overwrite=True, check_metadata=True,
-                         ignore=None):
+                         ignore=None, optimize=None, spatial_index=None,
+                         density_grids=None):
     """Save a single layer file to local Risiko GeoNode
 
     Input
@@ -544,6 +1585,20 @@ def save_file_to_geonode(filename, user=None, title=None,
                         If True (default), an exception will be raised
                         if metada is not available after a number of retries.
                         If False, no check is done making the function faster.
+        optimize: Flag controlling whether raster files are converted to
+                  tiled and compressed GeoTIFFs with overviews before upload.
+                  If None (default) the setting SAFE_OPTIMIZE_RASTERS is used.
+                  ASCII files are always converted.
+        spatial_index: Flag controlling whether features of shapefiles are
+                       reordered along a space filling curve and indexed
+                       (.qix) before upload. If None (default) the setting
+                       SAFE_INDEX_SHAPEFILES is used. Whether the .qix
+                       reaches the store depends on the GeoNode upload;
+                       the order of the features always does.
+        density_grids: Flag controlling whether grids counting the features
+                       of vector exposure layers are uploaded along with
+                       them (see save_density_grids). If None (default)
+                       the setting SAFE_DENSITY_GRIDS is used.
     Output
         layer object
     """
@@ -598,21 +1653,28 @@ def save_file_to_geonode(filename, user=None, title=None,
         f.close()
 
     # Take care of file types
+    if optimize is None:
+        optimize = OPTIMIZE_RASTERS
+
+    if spatial_index is None:
+        spatial_index = INDEX_SHAPEFILES
+
+    # Floating point type to store rasters in if narrower than that of
+    # the file and the values allow it
+    raster_dtype = None
+    if extension != '.shp' and (optimize or extension == '.asc'):
+        keyword_dict = dict([k.split(':', 1) for k in keyword_list
+                             if ':' in k])
+        raster_dtype = get_raster_dtype(keyword_dict)
+        if (raster_dtype is not None and
+            not can_cast_raster(filename, raster_dtype,
+                                rtol=RASTER_DTYPE_RTOL)):
+            raster_dtype = None
+
     if extension == '.asc':
         # We assume this is an AAIGrid ASCII file such as those generated by
         # ESRI and convert it to Geotiff before uploading.
 
-        # Create temporary tif file for upload and check that the road is clear
-        prefix = os.path.split(basename)[-1]
-        upload_filename = unique_filename(prefix=prefix, suffix='.tif')
-        upload_basename, extension = os.path.splitext(upload_filename)
-
-        # Copy any metadata files to unique filename
-        for ext in ['.sld', '.keywords']:
-            if os.path.exists(basename + ext):
-                cmd = 'cp %s%s %s%s' % (basename, ext, upload_basename, ext)
-                run(cmd)
-
         # Check that projection file exists
         prjname = basename + '.prj'
         if not os.path.isfile(prjname):
@@ -620,13 +1682,78 @@ def save_file_to_geonode(filename, user=None, title=None,
                    '%s' % (filename, prjname))
             raise RisikoException(msg)
 
-        # Convert ASCII file to GeoTIFF
-        R = read_layer(filename)
-        R.write_to_file(upload_filename)
+        convert = True
+    elif extension == '.shp':
+        # Store features of small regions close together and index them
+        # so that bounding box requests need not scan the whole file
+        convert = spatial_index
+    elif optimize:
+        # Rewrite GeoTIFF unless it is already tiled, compressed,
+        # has overviews and holds values in working precision
+        convert = (not is_optimized_geotiff(filename) or
+                   raster_dtype is not None)
+    else:
+        convert = False
+
+    if convert:
+        if extension == '.shp':
+            upload_extension = '.shp'
+        else:
+            upload_extension = '.tif'
+
+        # Create file for upload in its own scratch directory
+        upload_dir = make_scratch_dir('upload')
+        upload_basename = os.path.join(upload_dir,
+                                       os.path.split(basename)[-1])
+        upload_filename = upload_basename + upload_extension
+
+        try:
+            # Copy any metadata files along
+            for ext in ['.sld', '.keywords']:
+                if os.path.exists(basename + ext):
+                    shutil.copyfile(basename + ext, upload_basename + ext)
+
+            if extension == '.shp':
+                # Sort features along Hilbert curve and build quadtree index
+                sort_features_spatially(filename, upload_filename)
+                build_spatial_index(upload_filename)
+            else:
+                # Convert to tiled GeoTIFF block by block and add overviews
+                convert_to_geotiff(filename, upload_filename,
+                                   compression=GEOTIFF_COMPRESSION,
+                                   dtype=raster_dtype)
+                build_overviews(upload_filename,
+                                resampling=OVERVIEW_RESAMPLING)
+        except:
+            remove_scratch_dir(upload_dir)
+            raise
     else:
         # The specified file is the one to upload
         upload_filename = filename
 
+    # Record value statistics of rasters with the layer keywords
+    # unless they were given explicitly
+    keyword_names = [k.split(':')[0] for k in keyword_list]
+    if (RASTER_STATISTICS and extension != '.shp' and
+        'minimum' not in keyword_names):
+        statistics = get_raster_statistics(upload_filename)
+        keyword_list.extend(statistics2keywords(statistics))
+
+    # Record checksum of the data so that a layer replaced by other data
+    # on the same grid is told apart from its predecessor. Checksums of
+    # layers the file was derived from no longer apply.
+    keyword_list = [k for k in keyword_list
+                    if k.split(':')[0] != 'checksum']
+    checksum = get_file_checksum(upload_filename)
+    keyword_list.append('checksum:%s' % checksum)
+
+    # Record which tiles of rasters have valid data
+    if TILE_INDEX_DIR is not None and extension != '.shp':
+        tile_index = get_tile_index(upload_filename, TILE_INDEX_SIZE)
+        tile_index['checksum'] = checksum
+    else:
+        tile_index = None
+
     # Use file name or keywords to derive title if not specified
     if kw_title is None:
         title = os.path.split(basename)[-1]
@@ -652,6 +1779,21 @@ def save_file_to_geonode(filename, user=None, title=None,
             layer.title = kw_title
 
         layer.save()
+
+        if tile_index is not None:
+            save_tile_index('%s:%s' % (layer.workspace, layer.name),
+                            tile_index)
+
+        # Summarise vector exposure in density grids
+        if density_grids is None:
+            density_grids = DENSITY_GRIDS
+
+        keyword_dict = dict([k.split(':', 1) for k in keyword_list
+                             if ':' in k])
+        if (density_grids and extension == '.shp' and
+            keyword_dict.get('category') == 'exposure'):
+            save_density_grids(upload_filename, layer, keyword_dict,
+                               user=user)
     except GeoNodeException, e:
         raise
     else:
@@ -686,17 +1828,156 @@ def save_file_to_geonode(filename, user=None, title=None,
                        'correctly: %s' % (layer, errmsg))
                 raise Exception(msg)
     finally:
-        # Clean up generated tif files in either case
-        if extension == '.asc':
-            os.remove(upload_filename)
-            os.remove(upload_filename + '.aux.xml')
+        # Clean up generated files in either case
+        if convert:
+            remove_scratch_dir(upload_dir)
+
+
+def save_density_grids(filename, layer, keywords, user=None,
+                       resolutions=None):
+    """Upload grids counting features of vector exposure layer
+
+    Input
+        filename: Name of shapefile of the layer
+        layer: GeoNode layer it was uploaded as
+        keywords: Dictionary of keywords of the layer
+        user: Django User object
+        resolutions: List of grid resolutions in decimal degrees.
+                     If None, SAFE_DENSITY_RESOLUTIONS is used.
+
+    Output
+        layers: List of uploaded grid layers
+
+    Grids are named after the layer and resolution. Their keywords are
+    those of the layer with datatype count and density_of naming the
+    layer so they can be found with get_density_grids.
+    """
+
+    if resolutions is None:
+        resolutions = DENSITY_RESOLUTIONS
+
+    # Keywords of grids. Keep those describing what is exposed.
+    grid_keywords = {}
+    for key in ['category', 'subcategory', 'unit']:
+        if key in keywords:
+            grid_keywords[key] = keywords[key]
+    grid_keywords['datatype'] = 'count'
+    grid_keywords['density_of'] = layer.name
+
+    layers = []
+    for resolution in sorted(resolutions):
+        with scratch.scratch_dir('density') as dirname:
+            tif_filename = os.path.join(dirname, '%s.tif' %
+                                        get_density_grid_name(layer.name,
+                                                              resolution))
+            rasterize_feature_counts(filename, resolution, tif_filename)
+
+            grid_keywords['title'] = ('%s density %g degrees'
+                                      % (layer.title, resolution))
+            write_keywords(grid_keywords,
+                           os.path.splitext(tif_filename)[0] + '.keywords')
+
+            layers.append(save_file_to_geonode(tif_filename, user=user,
+                                               overwrite=True,
+                                               density_grids=False))
+
+    return layers
+
+
+def get_density_grid_name(layer_name, resolution):
+    """Get name of grid counting features of vector layer
+
+    Input
+        layer_name: Name of layer, optionally of the form workspace:name
+        resolution: Grid resolution in decimal degrees
+
+    Output
+        grid_name: Name of the grid in the same workspace, e.g.
+                   geonode:buildings_density_0_01
+    """
+
+    suffix = ('%g' % resolution).replace('.', '_')
+    return '%s_density_%s' % (layer_name, suffix)
+
+
+def get_density_grids(server_url, layer_name, resolutions=None):
+    """Get grids counting features of vector layer
+
+    Input
+        server_url: Server of the layer
+        layer_name: Layer identifier of the form workspace:name
+        resolutions: List of grid resolutions in decimal degrees to look
+                     for. If None, SAFE_DENSITY_RESOLUTIONS is used.
+
+    Output
+        grids: List of (layer_name, metadata) of density grids of the
+               layer on the same server, finest first
+
+    Grids are looked up by the names given them by save_density_grids so
+    that the metadata of other layers on the server is never fetched.
+    """
+
+    if resolutions is None:
+        resolutions = DENSITY_RESOLUTIONS
+
+    name = layer_name.split(':')[-1]
+
+    grids = []
+    for resolution in sorted(resolutions):
+        grid_name = get_density_grid_name(layer_name, resolution)
+        try:
+            metadata = get_metadata(server_url, grid_name)
+        except Exception, e:
+            # Not uploaded for this layer
+            logger.debug('No density grid %s: %s' % (grid_name, e))
+            continue
+
+        if (metadata['layertype'] == 'raster' and
+            metadata['keywords'].get('density_of') == name):
+            grids.append((grid_name, metadata))
+
+    return grids
+
+
+def get_linked_layers(layer_name, metadata):
+    """Get layers linked to a layer through its associates keyword
+
+    Input
+        layer_name: Layer identifier of the form workspace:name
+        metadata: Metadata of the layer as returned by get_metadata
+
+    Output
+        layer_names: List of identifiers of linked layers. Names in the
+                     keyword, e.g. associates: female_pct_yogya, are
+                     separated by semicolons or spaces and belong to the
+                     workspace of the layer unless given as workspace.name
+    """
+
+    associates = metadata['keywords'].get('associates')
+    if associates is None:
+        return []
+
+    workspace = layer_name.split(':')[0]
+
+    layer_names = []
+    for name in associates.replace(';', ' ').split():
+        if '.' in name:
+            name = ':'.join(name.split('.', 1))
+        else:
+            name = '%s:%s' % (workspace, name)
+
+        if name != layer_name and name not in layer_names:
+            layer_names.append(name)
+
+    return layer_names
 
 
 def save_to_geonode(incoming, user=None, title=None,
                     overwrite=True, check_metadata=True,
                     keywords=[], verbosity=1, console=sys.stdout,
                     ignore_errors=True,
-                    skip=False, ignore=None):
+                    skip=False, ignore=None, spatial_index=None,
+                    density_grids=None):
     """Save a files to local Risiko GeoNode
 
     Input
@@ -708,6 +1989,8 @@ def save_to_geonode(incoming, user=None, title=None,
                    can be overwritten by this operation. Default is True
         check_metadata: See save_file_to_geonode
         ignore: None or list of filenames to ignore
+        spatial_index: See save_file_to_geonode
+        density_grids: See save_file_to_geonode
 
         FIXME (Ole): WxS contents does not reflect the renaming done
                      when overwrite is False. This should be reported to
@@ -771,7 +2054,9 @@ def save_to_geonode(incoming, user=None, title=None,
                 layer = save_file_to_geonode(filename, title=None, user=user,
                                          overwrite=overwrite,
                                          check_metadata=check_metadata,
-                                         ignore=ignore)
+                                         ignore=ignore,
+                                         spatial_index=spatial_index,
+                                         density_grids=density_grids)
                 if not existed:
                     status = 'created'
                 else:
@@ -0,0 +1,83 @@
+"""Impact functions for testing only
+
+Impact functions register with SAFE when defined. The ones here are taken
+out of the registry again straight away so that they are only admissible
+in tests that register them (see register_plugin and unregister_plugin).
+"""
+
+import numpy
+
+from safe.impact_functions.core import FunctionProvider
+from safe.impact_functions.core import get_hazard_layer, get_exposure_layer
+from safe.storage.raster import Raster
+
+
+def register_plugin(plugin):
+    """Make impact function admissible
+    """
+
+    if plugin not in FunctionProvider.plugins:
+        FunctionProvider.plugins.append(plugin)
+
+
+def unregister_plugin(plugin):
+    """Remove impact function from the registry of SAFE
+    """
+
+    if plugin in FunctionProvider.plugins:
+        FunctionProvider.plugins.remove(plugin)
+
+
+class TiledSumFunction(FunctionProvider):
+    """Add up exposure where hazard exceeds 0.1
+
+    For testing tiled calculations only. No real layer meets its
+    requirements.
+
+    :param requires category=='hazard' and subcategory=='tiled_sum_test'
+
+    :param requires category=='exposure' and subcategory=='tiled_sum_test'
+    """
+
+    additive_keywords = ['total_exposed']
+    summary_template = '%(total_exposed)s exposed'
+
+    def run(self, layers):
+        H = get_hazard_layer(layers)
+        E = get_exposure_layer(layers)
+
+        A = numpy.where(H.get_data(nan=0.0) > 0.1, E.get_data(nan=0.0), 0.0)
+        total = float(numpy.sum(A))
+        return Raster(A, projection=H.get_projection(),
+                      geotransform=H.get_geotransform(),
+                      name='Exposed',
+                      keywords={'total_exposed': total,
+                                'impact_summary': '%s exposed' % total})
+
+
+class LinkedSumFunction(FunctionProvider):
+    """Add up exposure times linked fraction where hazard exceeds 0.1
+
+    For testing linked layers only. No real layer meets its requirements.
+
+    :param requires category=='hazard' and subcategory=='linked_sum_test'
+
+    :param requires category=='exposure' and subcategory=='linked_sum_test'
+    """
+
+    def run(self, layers):
+        H = get_hazard_layer(layers)
+        E = get_exposure_layer(layers)
+        (F,) = [L for L in layers
+                if L.get_keywords().get('category') == 'linked']
+
+        A = numpy.where(H.get_data(nan=0.0) > 0.1,
+                        E.get_data(nan=0.0) * F.get_data(nan=0.0), 0.0)
+        return Raster(A, projection=H.get_projection(),
+                      geotransform=H.get_geotransform(),
+                      name='Linked sum',
+                      keywords={'total_exposed': float(numpy.sum(A))})
+
+
+for plugin in [TiledSumFunction, LinkedSumFunction]:
+    unregister_plugin(plugin)
@@ -4,8 +4,11 @@ import sys
 import unittest
 import warnings
 import time
+import datetime
 
 from geonode_safe.views import calculate
+from geonode_safe import views
+from geonode_safe.models import Calculation
 from geonode_safe.storage import save_file_to_geonode as save_to_geonode
 from geonode_safe.storage import check_layer
 from geonode_safe.storage import assert_bounding_box_matches
@@ -13,12 +16,18 @@ from geonode_safe.storage import download
 from geonode_safe.storage import read_layer
 from geonode_safe.storage import get_metadata
 from geonode_safe.storage import get_bounding_box
+from geonode_safe.storage import CALCULATION_TIMEOUT
+from geonode_safe.storage import write_raster_data
+from geonode_safe.scratch import scratch_dir
 from geonode_safe.utilities import get_bounding_box_string
 from geonode_safe.utilities import nanallclose
 from geonode_safe.utilities import compatible_layers
+from geonode_safe.tests.plugins import LinkedSumFunction
+from geonode_safe.tests.plugins import register_plugin, unregister_plugin
 from geonode_safe.tests.utilities import TESTDATA, INTERNAL_SERVER_URL
 
 from geonode.layers.utils import get_valid_user, check_geonode_is_up
+from geonode.layers.models import Layer
 
 from safe.common.testing import UNITDATA
 from safe.engine.impact_functions_for_testing import unspecific_building_impact_model
@@ -59,6 +68,10 @@ class TestApi(LiveServerTestCase):
         """
         check_geonode_is_up()
         self.user = get_valid_user()
+        register_plugin(LinkedSumFunction)
+
+    def tearDown(self):
+        unregister_plugin(LinkedSumFunction)
 
     def test_the_earthquake_fatality_estimation_allen(self):
         """Fatality computation computed correctly with GeoServer Data
@@ -576,6 +589,231 @@ class TestApi(LiveServerTestCase):
         # Parse caption and look for the correct numbers
 
 
+    def test_linked_layer_calculation(self):
+        """Linked rasters are downloaded on the grid of the other rasters
+        """
+
+        R = read_layer(os.path.join(UNITDATA, 'hazard',
+                                    'jakarta_flood_design.tif'))
+        projection = R.get_projection()
+
+        with scratch_dir('test') as dirname:
+            # Linked fraction on a finer grid covering part of the area
+            filename = os.path.join(dirname, 'linked_test_fraction.tif')
+            write_raster_data(0.5 * numpy.ones((120, 120)), projection,
+                              (106.2, 0.005, 0, -6.2, 0, -0.005), filename,
+                              keywords={'category': 'linked',
+                                        'subcategory': 'linked_sum_test'})
+            linked_layer = save_to_geonode(filename, user=self.user,
+                                           overwrite=True)
+
+            # Exposure on a coarser grid pulling in the fraction
+            filename = os.path.join(dirname, 'linked_test_exposure.tif')
+            write_raster_data(2.0 * numpy.ones((50, 50)), projection,
+                              (106.0, 0.02, 0, -6.0, 0, -0.02), filename,
+                              keywords={'category': 'exposure',
+                                        'subcategory': 'linked_sum_test',
+                                        'associates': linked_layer.name})
+            exposure_layer = save_to_geonode(filename, user=self.user,
+                                             overwrite=True)
+            exposure_name = '%s:%s' % (exposure_layer.workspace,
+                                       exposure_layer.name)
+
+            filename = os.path.join(dirname, 'linked_test_hazard.tif')
+            write_raster_data(numpy.ones((100, 100)), projection,
+                              (106.0, 0.01, 0, -6.0, 0, -0.01), filename,
+                              keywords={'category': 'hazard',
+                                        'subcategory': 'linked_sum_test'})
+            hazard_layer = save_to_geonode(filename, user=self.user,
+                                           overwrite=True)
+            hazard_name = '%s:%s' % (hazard_layer.workspace,
+                                     hazard_layer.name)
+
+        (plugin_name,) = [
+            name for name, function in get_admissible_plugins().items()
+            if function is LinkedSumFunction]
+
+        c = Client()
+        rv = c.post(reverse('safe-calculate'), data=dict(
+                hazard_server=INTERNAL_SERVER_URL,
+                hazard=hazard_name,
+                exposure_server=INTERNAL_SERVER_URL,
+                exposure=exposure_name,
+                bbox='106.0,-7.0,107.0,-6.0',
+                impact_function=plugin_name,
+                keywords='test,linked'))
+
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.content)
+        msg = 'The server returned the error message: %s' % data['errors']
+        assert data['errors'] is None, msg
+        assert data['success']
+
+        # All rasters come at the finest resolution within the area
+        # covered by the linked layer
+        msg = 'Expected resolution 0.005, got %s' % str(data['resolution'])
+        assert numpy.allclose(data['resolution'], (0.005, 0.005)), msg
+
+        layer_name = data['layer'].split('/')[-1]
+        metadata = get_metadata(INTERNAL_SERVER_URL, layer_name)
+        assert numpy.allclose(metadata['bounding_box'],
+                              [106.2, -6.8, 106.8, -6.2])
+
+        total = float(metadata['keywords']['total_exposed'])
+        msg = 'Expected total 14400, got %f' % total
+        assert numpy.allclose(total, 120 * 120 * 2.0 * 0.5,
+                              rtol=1.0e-6), msg
+
+    def test_preview_calculation(self):
+        """Previews are returned straight away and full results polled for
+        """
+
+        # Upload hazard and exposure data for this test
+        hazard_filename = os.path.join(UNITDATA, 'hazard',
+                                       'jakarta_flood_design.tif')
+        hazard_layer = save_to_geonode(hazard_filename,
+                                       user=self.user, overwrite=True)
+        hazard_name = '%s:%s' % (hazard_layer.workspace, hazard_layer.name)
+
+        exposure_filename = '%s/%s.asc' % (TESTDATA,
+                                           'Population_Jakarta_geographic')
+        exposure_layer = save_to_geonode(exposure_filename,
+                                         user=self.user, overwrite=True)
+        exposure_name = '%s:%s' % (exposure_layer.workspace,
+                                   exposure_layer.name)
+
+        # Run calculation asking for a preview coarser than the layers
+        preview_max_pixels = views.PREVIEW_MAX_PIXELS
+        views.PREVIEW_MAX_PIXELS = 1000
+        try:
+            c = Client()
+            rv = c.post(reverse('safe-calculate'), data=dict(
+                    hazard_server=INTERNAL_SERVER_URL,
+                    hazard=hazard_name,
+                    exposure_server=INTERNAL_SERVER_URL,
+                    exposure=exposure_name,
+                    bbox=get_bounding_box_string(hazard_filename),
+                    impact_function='Flood Evacuation Function',
+                    keywords='test,flood,preview',
+                    preview='true'))
+        finally:
+            views.PREVIEW_MAX_PIXELS = preview_max_pixels
+
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.content)
+        msg = 'The server returned the error message: %s' % data['errors']
+        assert data['errors'] is None, msg
+        assert data['success']
+        assert data['preview']
+        assert 'layer' in data
+        assert 'status_url' in data
+
+        # Poll full calculation until it is done
+        for i in range(120):
+            rv = c.get(data['status_url'])
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv['Content-Type'], 'application/json')
+            status = json.loads(rv.content)
+            assert status['id'] == data['calculation_id']
+            if status['status'] != 'running':
+                break
+            time.sleep(1)
+
+        msg = 'Full calculation did not complete: %s' % str(status)
+        assert status['status'] == 'complete', msg
+        assert status['layer'] is not None
+        assert status['layer'] != data['layer']
+
+        # The preview is replaced by the full impact layer
+        preview_calculation = Calculation.objects.get(id=data['id'])
+        assert preview_calculation.layer == status['layer']
+
+        typename = data['layer'].rstrip('/').split('/')[-1]
+        msg = 'Preview layer %s was not deleted' % typename
+        assert Layer.objects.filter(typename=typename).count() == 0, msg
+
+        # Unknown calculations are not found
+        rv = c.get(reverse('safe-calculation-status', args=[999999]))
+        self.assertEqual(rv.status_code, 404)
+
+    def test_preview_of_vector_exposure(self):
+        """Vector exposure without density grids is calculated in full
+        """
+
+        hazard_filename = os.path.join(UNITDATA, 'hazard',
+                                       'jakarta_flood_design.tif')
+        hazard_layer = save_to_geonode(hazard_filename,
+                                       user=self.user, overwrite=True)
+        hazard_name = '%s:%s' % (hazard_layer.workspace, hazard_layer.name)
+
+        exposure_filename = os.path.join(UNITDATA, 'exposure',
+                                         'buildings_osm_4326.shp')
+        exposure_layer = save_to_geonode(exposure_filename,
+                                         user=self.user, overwrite=True,
+                                         density_grids=False)
+        exposure_name = '%s:%s' % (exposure_layer.workspace,
+                                   exposure_layer.name)
+
+        (plugin_name,) = [
+            name for name, function in get_admissible_plugins().items()
+            if function is FloodBuildingImpactFunction]
+
+        # A preview would take as long as the full calculation
+        c = Client()
+        rv = c.post(reverse('safe-calculate'), data=dict(
+                hazard_server=INTERNAL_SERVER_URL,
+                hazard=hazard_name,
+                exposure_server=INTERNAL_SERVER_URL,
+                exposure=exposure_name,
+                bbox=get_bounding_box_string(exposure_filename),
+                impact_function=plugin_name,
+                keywords='test,flood,preview',
+                preview='true'))
+
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.content)
+        msg = 'The server returned the error message: %s' % data['errors']
+        assert data['errors'] is None, msg
+        assert data['success']
+        assert 'preview' not in data
+        assert 'status_url' not in data
+        assert data['layer'] is not None
+
+    def test_stale_calculation_status(self):
+        """Calculations no longer running are reported as failed
+        """
+
+        calculation = Calculation(user=self.user,
+                                  run_date=datetime.datetime.now(),
+                                  impact_function='Flood Evacuation Function',
+                                  success=False)
+        calculation.save()
+
+        c = Client()
+        status_url = reverse('safe-calculation-status',
+                             args=[calculation.id])
+        rv = c.get(status_url)
+        status = json.loads(rv.content)
+        assert status['status'] == 'running', status['status']
+
+        # Last saved, e.g. by run_in_background, well beyond the timeout
+        run_date = (datetime.datetime.now() -
+                    datetime.timedelta(seconds=2 * CALCULATION_TIMEOUT))
+        Calculation.objects.filter(id=calculation.id).update(
+            run_date=run_date, run_duration=0)
+        assert views.is_stale(Calculation.objects.get(id=calculation.id))
+
+        rv = c.get(status_url)
+        status = json.loads(rv.content)
+        assert status['status'] == 'failed', status['status']
+        assert status['errors'] is not None
+
+        # It stays failed with only the errors recorded
+        calculation = Calculation.objects.get(id=calculation.id)
+        assert len(calculation.errors) > 0
+        assert calculation.run_duration == 0
+        assert not views.is_stale(calculation)
+
     def test_functions(self):
         """Functions can be retrieved from the HTTP Rest API
         """
@@ -1,10 +1,19 @@
 import os
 
+import numpy
+
 from django.core.management import call_command
 from django.test import LiveServerTestCase
 from safe.common.testing import UNITDATA
 from gisdata import BAD_DATA
+from geonode.layers.models import Layer
 from geonode_safe import get_version
+from geonode_safe.storage import download
+from geonode_safe.storage import get_bounding_box, get_metadata
+from geonode_safe.storage import get_density_grids, get_density_grid_name
+from geonode_safe import storage
+from geonode_safe.utilities import get_feature_order
+from geonode_safe.tests.utilities import INTERNAL_SERVER_URL
 
 class CommandsTestCase(LiveServerTestCase):
 
@@ -19,6 +28,63 @@ class CommandsTestCase(LiveServerTestCase):
 
         # FIXME(Ariel): Implement some asserts
 
+    def test_safeimportlayers_spatial_index(self):
+        "Test safeimportlayers with spatial indexing of shapefiles."
+        layer_filename = os.path.join(UNITDATA, 'exposure',
+                                      'buildings_osm_4326.shp')
+        args = [layer_filename]
+        opts = {'spatial_index': True}
+        call_command('safeimportlayers', *args, **opts)
+
+        layer = Layer.objects.get(name='buildings_osm_4326')
+
+        # Features served by GeoServer come in the order of the store
+        # which must already be sorted along the Hilbert curve
+        bbox = get_bounding_box(layer_filename)
+        V = download(INTERNAL_SERVER_URL, layer.typename, bbox,
+                     in_memory=False)
+        order = get_feature_order(V.filename)
+        msg = ('Features of %s were not stored in Hilbert order'
+               % layer.typename)
+        assert numpy.all(order == numpy.arange(len(order))), msg
+
+    def test_safeimportlayers_density_grids(self):
+        "Test safeimportlayers with density grids of vector exposure."
+        layer_filename = os.path.join(UNITDATA, 'exposure',
+                                      'buildings_osm_4326.shp')
+        args = [layer_filename]
+        opts = {'density_grids': True}
+
+        resolutions = [0.001, 0.01]
+        density_resolutions = storage.DENSITY_RESOLUTIONS
+        storage.DENSITY_RESOLUTIONS = resolutions
+        try:
+            call_command('safeimportlayers', *args, **opts)
+        finally:
+            storage.DENSITY_RESOLUTIONS = density_resolutions
+
+        layer = Layer.objects.get(name='buildings_osm_4326')
+
+        # One grid per resolution naming the layer it counts
+        for resolution in resolutions:
+            grid_name = get_density_grid_name(layer.name, resolution)
+            grid = Layer.objects.get(name=grid_name)
+            metadata = get_metadata(INTERNAL_SERVER_URL, grid.typename)
+            msg = 'Grid %s is not a raster' % grid.typename
+            assert metadata['layertype'] == 'raster', msg
+            density_of = metadata['keywords'].get('density_of')
+            msg = ('Grid %s is density_of %s, expected %s'
+                   % (grid.typename, density_of, layer.name))
+            assert density_of == layer.name, msg
+
+        # Grids are found by name, finest first
+        grids = get_density_grids(INTERNAL_SERVER_URL, layer.typename,
+                                  resolutions)
+        grid_names = [name for name, _ in grids]
+        assert grid_names == [get_density_grid_name(layer.typename,
+                                                    resolution)
+                              for resolution in resolutions], grid_names
+
     def test_error_safeimportlayers(self):
         "Test safeimportlayers with bad data."
         args = [BAD_DATA]
@@ -3,8 +3,10 @@ import time
 import unittest
 import numpy
 import urllib2
+import shutil
 import tempfile
 import datetime
+import threading
 import gisdata
 
 from geonode_safe.storage import save_file_to_geonode as save_to_geonode
@@ -13,14 +15,68 @@ from geonode_safe.storage import check_layer, assert_bounding_box_matches
 from geonode_safe.storage import get_bounding_box
 from geonode_safe.storage import download, get_metadata
 from geonode_safe.storage import read_layer
+from geonode_safe.storage import get_feature_count, get_shapefile_pages
+from geonode_safe.storage import get_sort_attribute
+from geonode_safe.storage import get_feature_attributes
+from geonode_safe.storage import write_raster_data
+from geonode_safe.storage import read_mapped_raster, MappedRaster
+from geonode_safe.storage import cast_layer_data, RASTER_DTYPE_RTOL
+from geonode_safe import storage
+from geonode_safe.storage import get_linked_layers
+from geonode_safe.storage import get_density_grids, get_density_grid_name
+from geonode_safe.storage import save_tile_index, load_tile_index
 from geonode_safe.utilities import get_bounding_box_string
-from geonode_safe.utilities import bboxstring2list
+from geonode_safe.utilities import bboxstring2list, bboxlist2string
+from geonode_safe.utilities import write_keywords
 from geonode_safe.utilities import unique_filename, LAYER_TYPES
 from geonode_safe.utilities import nanallclose
+from geonode_safe.utilities import WFS_TEMPLATE, WFS_SORTED_TEMPLATE
+from geonode_safe.utilities import align_bounding_box
+from geonode_safe.utilities import get_common_resolution
+from geonode_safe.utilities import transform_bounding_box
+from geonode_safe.utilities import get_common_native_crs
+from geonode_safe.utilities import get_native_download
+from geonode_safe.utilities import get_bounding_boxes
+from geonode_safe.utilities import get_linked_bounding_box
+from geonode_safe.utilities import extract_raster_window
+from geonode_safe.utilities import extract_vector_window
+from geonode_safe.utilities import get_crs
+from geonode_safe.utilities import memmap_raster
+from geonode_safe.utilities import cast_floats, can_cast_raster
+from geonode_safe.utilities import get_tile_index, valid_data_bounding_box
+from geonode_safe.utilities import get_feature_envelopes
+from geonode_safe.utilities import build_str_tree, query_str_tree
+from geonode_safe.utilities import rasterize_feature_counts
+from geonode_safe.utilities import split_bounding_box, mosaic_rasters
+from geonode_safe.utilities import buffered_bounding_box, bbox_intersection
+from geonode_safe.calculations import sum_keywords
+from geonode_safe.calculations import calculate_tiled, remove_impact_file
+from geonode_safe.calculations import calculate_batched
+from geonode_safe.calculations import can_skip_empty_hazard
+from geonode_safe.calculations import shrink_to_valid_hazard
+from geonode_safe import calculations
+from geonode_safe.utilities import convert_to_geotiff, build_overviews
+from geonode_safe.utilities import is_optimized_geotiff
+from geonode_safe.utilities import get_raster_statistics
+from geonode_safe.utilities import sort_features_spatially
+from geonode_safe.utilities import build_spatial_index
+from geonode_safe.utilities import is_simplifiable, simplify_shapefile
+from geonode_safe.utilities import get_file_checksum
+from geonode_safe.scratch import make_scratch_dir, remove_scratch_dir
+from geonode_safe.scratch import scratch_dir, reap_orphans, SCRATCH_ROOT
+from geonode_safe.scratch import ScratchSpaceException
+from geonode_safe import hotlayers
+from geonode_safe import cache
+from geonode_safe.views import select_density_grid, run_calculation
+from geonode_safe.models import Calculation
+from geonode_safe.tests.plugins import TiledSumFunction
+from geonode_safe.tests.plugins import register_plugin, unregister_plugin
 from geonode_safe.tests.utilities import TESTDATA, INTERNAL_SERVER_URL
 from geonode_safe.tests.utilities import get_web_page
+from geonode_safe.tests.utilities import add_id_attribute
 
 from safe.common.testing import UNITDATA
+from safe.api import calculate_impact
 from safe.impact_functions.core import get_admissible_plugins
 from safe.impact_functions.core import compatible_layers
 from safe.engine.interpolation import assign_hazard_values_to_exposure_data
@@ -55,9 +111,10 @@ class TestStorage(LiveServerTestCase):
         """Create valid superuser
         """
         self.user = get_valid_user()
+        register_plugin(TiledSumFunction)
 
     def tearDown(self):
-        pass
+        unregister_plugin(TiledSumFunction)
 
     def test_extension_not_implemented(self):
         """RisikoException is returned for not compatible extensions
@@ -1039,3 +1096,1268 @@ class TestStorage(LiveServerTestCase):
 
         msg = 'No compatible layers returned'
         assert len(plugins) > 0, msg
+
+    def test_optimized_geotiff(self):
+        """Rasters are converted to tiled GeoTIFFs with overviews
+        """
+
+        filename = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        assert not is_optimized_geotiff(filename)
+
+        tif_filename = unique_filename(suffix='.tif')
+        convert_to_geotiff(filename, tif_filename, rows_per_block=7)
+        build_overviews(tif_filename, min_size=16)
+
+        msg = 'File %s was not tiled and compressed' % tif_filename
+        assert is_optimized_geotiff(tif_filename), msg
+
+        # Data must be unchanged by the conversion
+        R1 = read_layer(filename)
+        R2 = read_layer(tif_filename)
+        assert numpy.allclose(R1.get_geotransform(), R2.get_geotransform())
+        assert nanallclose(R1.get_data(), R2.get_data())
+
+        os.remove(tif_filename)
+
+    def test_raster_statistics(self):
+        """Raster statistics are computed at upload and exposed as metadata
+        """
+
+        filename = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+
+        # Compare block wise statistics with those of the full array
+        statistics = get_raster_statistics(filename, rows_per_block=7)
+        A = read_layer(filename).get_data(nan=True)
+        valid = A[~numpy.isnan(A)]
+        assert numpy.allclose(statistics['minimum'], numpy.min(valid))
+        assert numpy.allclose(statistics['maximum'], numpy.max(valid))
+        assert numpy.allclose(statistics['mean'], numpy.mean(valid))
+        assert numpy.allclose(statistics['nodata_fraction'],
+                              1.0 - float(len(valid)) / A.size)
+        assert sum(statistics['histogram']) == len(valid)
+
+        # Statistics are available through the layer metadata
+        layer = save_to_geonode(filename, user=self.user, overwrite=True)
+        layer_name = '%s:%s' % (layer.workspace, layer.name)
+        metadata = get_metadata(INTERNAL_SERVER_URL, layer_name)
+
+        msg = 'No statistics found in metadata for %s' % layer_name
+        assert metadata['statistics'] is not None, msg
+        assert numpy.allclose(metadata['statistics']['minimum'],
+                              statistics['minimum'])
+        assert numpy.allclose(metadata['statistics']['maximum'],
+                              statistics['maximum'])
+
+    def test_spatially_sorted_shapefile(self):
+        """Shapefiles can be sorted spatially and indexed before upload
+        """
+
+        filename = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        sorted_filename = unique_filename(suffix='.shp')
+        sort_features_spatially(filename, sorted_filename)
+        qix_filename = build_spatial_index(sorted_filename)
+        assert os.path.isfile(qix_filename)
+
+        # Same features and extent, possibly in a different order
+        V1 = read_layer(filename)
+        V2 = read_layer(sorted_filename)
+        assert len(V1) == len(V2)
+        assert numpy.allclose(V1.get_bounding_box(), V2.get_bounding_box())
+
+        # Indexed layer can be uploaded and downloaded
+        layer = save_to_geonode(filename, user=self.user, overwrite=True,
+                                spatial_index=True)
+        check_layer(layer, full=True)
+
+    def test_bounding_box_from_header(self):
+        """Bounding boxes read from file headers match those of read_layer
+        """
+
+        for filename in [os.path.join('hazard', 'jakarta_flood_design.tif'),
+                         os.path.join('exposure', 'buildings_osm_4326.shp')]:
+            thefile = os.path.join(UNITDATA, filename)
+            ref_bbox = read_layer(thefile).get_bounding_box()
+
+            bbox = get_bounding_box(thefile)
+            msg = ('Bounding box for %s was %s. Expected %s'
+                   % (thefile, bbox, ref_bbox))
+            assert numpy.allclose(bbox, ref_bbox,
+                                  rtol=1.0e-12, atol=1.0e-12), msg
+
+            # Cached value is the same
+            assert numpy.allclose(get_bounding_box(thefile), bbox)
+
+    def test_scratch_space(self):
+        """Scratch directories are unique and removed after use
+        """
+
+        dirnames = [make_scratch_dir('test') for i in range(10)]
+        assert len(set(dirnames)) == len(dirnames)
+
+        with scratch_dir('test') as dirname:
+            assert os.path.isdir(dirname)
+            filename = os.path.join(dirname, 'test.txt')
+            open(filename, 'w').write('test')
+        assert not os.path.exists(dirname)
+
+        # Directories in use are never reaped
+        removed = reap_orphans(max_age=-1)
+        for dirname in dirnames:
+            assert dirname not in removed
+            assert os.path.isdir(dirname)
+            remove_scratch_dir(dirname)
+            assert not os.path.exists(dirname)
+
+        # Orphans are
+        orphan = tempfile.mkdtemp(dir=SCRATCH_ROOT)
+        removed = reap_orphans(max_age=-1)
+        assert orphan in removed
+        assert not os.path.exists(orphan)
+
+        # Directories outside scratch space are refused
+        outside = tempfile.mkdtemp()
+        try:
+            remove_scratch_dir(outside)
+        except ScratchSpaceException:
+            pass
+        else:
+            msg = 'Directory %s outside scratch space was removed' % outside
+            raise Exception(msg)
+        assert os.path.isdir(outside)
+        os.rmdir(outside)
+
+    def test_download_scratch_cleanup(self):
+        """Downloads without scratch directory are removed with the layer
+        """
+
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+        layer_name = '%s:%s' % (layer.workspace, layer.name)
+        bbox = get_bounding_box_string(thefile)
+
+        H = download(INTERNAL_SERVER_URL, layer_name, bbox, in_memory=False)
+        dirname = os.path.dirname(H.filename)
+        assert os.path.isfile(H.filename)
+
+        del H
+        msg = 'Download directory %s outlived its layer' % dirname
+        assert not os.path.exists(dirname), msg
+
+    def test_in_memory_download(self):
+        """Small layers can be downloaded without touching the disk
+        """
+
+        for filename in [os.path.join('hazard', 'jakarta_flood_design.tif'),
+                         os.path.join('exposure', 'buildings_osm_4326.shp')]:
+            thefile = os.path.join(UNITDATA, filename)
+            layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+            layer_name = '%s:%s' % (layer.workspace, layer.name)
+            bbox = get_bounding_box_string(thefile)
+
+            L1 = download(INTERNAL_SERVER_URL, layer_name, bbox,
+                          in_memory=False)
+            L2 = download(INTERNAL_SERVER_URL, layer_name, bbox,
+                          in_memory=True)
+
+            msg = 'Layer %s was not downloaded to memory' % layer_name
+            assert not os.path.exists(L2.filename), msg
+
+            assert L1.get_keywords() == L2.get_keywords()
+            assert numpy.allclose(L1.get_bounding_box(),
+                                  L2.get_bounding_box())
+            if L1.is_raster:
+                assert nanallclose(L1.get_data(), L2.get_data())
+            else:
+                assert len(L1) == len(L2)
+
+    def test_paged_vector_download(self):
+        """Vector layers can be downloaded in pages and merged
+        """
+
+        filename = os.path.join(UNITDATA, 'exposure',
+                                'buildings_osm_4326.shp')
+        with scratch_dir('test') as dirname:
+            # Features numbered in an attribute they can be sorted by
+            thefile = os.path.join(dirname, 'buildings_paged.shp')
+            add_id_attribute(filename, thefile, 'gid')
+            layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+            layer_name = '%s:%s' % (layer.workspace, layer.name)
+            bbox = get_bounding_box_string(thefile)
+            reference = read_layer(thefile)
+
+        assert get_sort_attribute(INTERNAL_SERVER_URL, layer_name) == 'gid'
+
+        number_of_features = get_feature_count(INTERNAL_SERVER_URL,
+                                               layer_name, bbox)
+        assert number_of_features == len(reference)
+
+        page_size = number_of_features // 3 + 1
+        download_url = WFS_SORTED_TEMPLATE % (INTERNAL_SERVER_URL, layer_name,
+                                              bbox, 'gid')
+        with scratch_dir('test') as dirname:
+            filename = get_shapefile_pages(download_url, number_of_features,
+                                           page_size, dirname=dirname)
+            merged = read_layer(filename)
+            msg = ('Expected %i features in merged layer, got %i'
+                   % (len(reference), len(merged)))
+            assert len(merged) == len(reference), msg
+
+            # Every feature comes exactly once
+            gids = sorted([int(attributes['gid'])
+                           for attributes in merged.get_data()])
+            assert gids == range(len(reference))
+
+    def test_vector_attribute_selection(self):
+        """Vector layers can be downloaded with selected attributes only
+        """
+
+        thefile = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+        layer_name = '%s:%s' % (layer.workspace, layer.name)
+        bbox = get_bounding_box_string(thefile)
+
+        geometry_names, attribute_names = get_feature_attributes(
+            INTERNAL_SERVER_URL, layer_name)
+        assert len(geometry_names) == 1
+        assert len(attribute_names) > 1
+
+        selected = attribute_names[:1]
+        L = download(INTERNAL_SERVER_URL, layer_name, bbox,
+                     attributes=selected + ['not_an_attribute'])
+        reference = read_layer(thefile)
+        assert len(L) == len(reference)
+
+        names = L.get_attribute_names()
+        msg = 'Expected attributes %s, got %s' % (selected, names)
+        assert list(names) == selected, msg
+
+    def test_polygon_simplification(self):
+        """Polygons can be simplified to a given tolerance
+        """
+
+        filename = os.path.join(UNITDATA, 'hazard',
+                                'multipart_polygons_osm_4326.shp')
+        assert is_simplifiable(filename)
+
+        tolerance = 0.001
+        simplified_filename = unique_filename(suffix='.shp')
+        simplify_shapefile(filename, simplified_filename, tolerance)
+
+        V1 = read_layer(filename)
+        V2 = read_layer(simplified_filename)
+        assert len(V1) == len(V2)
+        assert V1.get_data() == V2.get_data()
+        assert numpy.allclose(V1.get_bounding_box(), V2.get_bounding_box(),
+                              atol=tolerance)
+
+        # Simplification never adds vertices
+        n1 = sum([len(p) for p in V1.get_geometry()])
+        n2 = sum([len(p) for p in V2.get_geometry()])
+        assert n2 <= n1
+
+    def test_bounding_box_alignment(self):
+        """Bounding boxes can be snapped outward to a pixel grid
+        """
+
+        geotransform = (105.0, 0.5, 0.0, -5.0, 0.0, -0.25)
+
+        # Already aligned boxes are unchanged
+        bbox = [106.0, -7.0, 107.5, -5.25]
+        assert numpy.allclose(align_bounding_box(bbox, geotransform), bbox)
+
+        # Others grow to the nearest pixel boundaries
+        bbox = [106.1, -6.9, 107.4, -5.3]
+        ref = [106.0, -7.0, 107.5, -5.25]
+        assert numpy.allclose(align_bounding_box(bbox, geotransform), ref)
+
+        # Floating point noise does not add a pixel
+        bbox = [106.0 - 1.0e-12, -7.0 - 1.0e-12, 107.5 + 1.0e-12, -5.25]
+        ref = [106.0, -7.0, 107.5, -5.25]
+        assert numpy.allclose(align_bounding_box(bbox, geotransform), ref)
+
+    def test_pixel_budget(self):
+        """Common resolution is coarsened to stay within pixel budget
+        """
+
+        haz_metadata = {'layertype': 'raster',
+                        'resolution': (0.01, 0.01),
+                        'bounding_box': [100.0, -10.0, 110.0, 0.0]}
+        exp_metadata = {'layertype': 'raster',
+                        'resolution': (0.02, 0.02),
+                        'bounding_box': [104.0, -8.0, 112.0, 2.0]}
+        bbox = '105.0,-7.0,107.0,-5.0'
+
+        # Finest resolution holds 200 x 200 pixels
+        res = get_common_resolution(haz_metadata, exp_metadata)
+        assert numpy.allclose(res, (0.01, 0.01))
+
+        res = get_common_resolution(haz_metadata, exp_metadata,
+                                    bbox, max_pixels=40000)
+        assert numpy.allclose(res, (0.01, 0.01))
+
+        # Smallest power of two within budget is used
+        res = get_common_resolution(haz_metadata, exp_metadata,
+                                    bbox, max_pixels=39999)
+        assert numpy.allclose(res, (0.02, 0.02))
+
+        res = get_common_resolution(haz_metadata, exp_metadata,
+                                    bbox, max_pixels=2000)
+        assert numpy.allclose(res, (0.08, 0.08))
+
+        # Only the overlap with the layers counts
+        res = get_common_resolution(haz_metadata, exp_metadata,
+                                    '90.0,-50.0,105.0,-5.0',
+                                    max_pixels=30000)
+        assert numpy.allclose(res, (0.01, 0.01))
+
+        # Native raster resolution is coarsened for vector exposure
+        exp_metadata = {'layertype': 'vector',
+                        'bounding_box': [104.0, -8.0, 112.0, 2.0]}
+        res = get_common_resolution(haz_metadata, exp_metadata)
+        assert res is None
+
+        res = get_common_resolution(haz_metadata, exp_metadata,
+                                    bbox, max_pixels=10000)
+        assert numpy.allclose(res, (0.02, 0.02))
+
+    def test_native_crs_download_parameters(self):
+        """Rasters sharing a projection can be requested in that projection
+        """
+
+        crs = 'EPSG:32748'
+        native_bbox = [650000.0, 9250000.0, 750000.0, 9350000.0]
+        geo_bbox = transform_bounding_box(native_bbox, crs, 'EPSG:4326')
+
+        # Round trip contains the original box
+        bbox = transform_bounding_box(geo_bbox, 'EPSG:4326', crs)
+        assert bbox[0] <= native_bbox[0] and bbox[1] <= native_bbox[1]
+        assert bbox[2] >= native_bbox[2] and bbox[3] >= native_bbox[3]
+        assert numpy.allclose(bbox, native_bbox, rtol=0, atol=1000)
+
+        haz_metadata = {'layertype': 'raster',
+                        'title': 'hazard',
+                        'resolution': (0.0009, 0.0009),
+                        'native_crs': crs,
+                        'native_geotransform': (650000.0, 100.0, 0.0,
+                                                9350000.0, 0.0, -100.0),
+                        'native_bounding_box': native_bbox}
+        exp_metadata = {'layertype': 'raster',
+                        'title': 'exposure',
+                        'resolution': (0.00045, 0.00045),
+                        'native_crs': crs,
+                        'native_geotransform': (650000.0, 50.0, 0.0,
+                                                9350000.0, 0.0, -50.0),
+                        'native_bounding_box': native_bbox}
+        assert get_common_native_crs(haz_metadata, exp_metadata) == crs
+
+        # Geographic and vector layers are downloaded in EPSG:4326
+        geo_metadata = dict(haz_metadata, native_crs='EPSG:4326')
+        assert get_common_native_crs(geo_metadata, exp_metadata) is None
+        vec_metadata = {'layertype': 'vector', 'native_crs': None}
+        assert get_common_native_crs(haz_metadata, vec_metadata) is None
+
+        # Requested area is aligned with the finest grid
+        req_bbox = transform_bounding_box([680010.0, 9280010.0,
+                                           690010.0, 9290010.0],
+                                          crs, 'EPSG:4326')
+        bbox, res = get_native_download(haz_metadata, exp_metadata,
+                                        req_bbox, (0.00045, 0.00045))
+        assert numpy.allclose(res, (50.0, 50.0))
+        assert bbox[0] <= 680010.0 and bbox[1] <= 9280010.0
+        assert bbox[2] >= 690010.0 and bbox[3] >= 9290010.0
+        for x in bbox:
+            assert numpy.allclose(round(x / 50.0) * 50.0, x)
+
+        # Coarsening of the common resolution carries over
+        bbox, res = get_native_download(haz_metadata, exp_metadata,
+                                        req_bbox, (0.0018, 0.0018))
+        assert numpy.allclose(res, (200.0, 200.0))
+
+    def test_linked_layer_reconciliation(self):
+        """Linked layers are reconciled with hazard and exposure
+        """
+
+        haz_metadata = {'layertype': 'vector',
+                        'title': 'hazard',
+                        'bounding_box': [100.0, -10.0, 110.0, 0.0],
+                        'native_crs': None}
+        exp_metadata = {'layertype': 'raster',
+                        'title': 'exposure',
+                        'resolution': (0.02, 0.02),
+                        'geotransform': (100.0, 0.02, 0, 0.0, 0, -0.02),
+                        'bounding_box': [100.0, -10.0, 110.0, 0.0],
+                        'native_crs': 'EPSG:4326'}
+        linked_metadata = [{'layertype': 'raster',
+                            'title': 'linked',
+                            'resolution': (0.01, 0.01),
+                            'geotransform': (104.005, 0.01, 0,
+                                             -1.995, 0, -0.01),
+                            'bounding_box': [104.005, -8.005,
+                                             112.005, -1.995],
+                            'native_crs': 'EPSG:4326'}]
+        bbox = '103.0,-7.0,106.0,-5.0'
+
+        # Single raster is used at its native resolution
+        res = get_common_resolution(haz_metadata, exp_metadata, bbox)
+        assert res is None
+
+        # Linked raster shares the finest resolution
+        res = get_common_resolution(haz_metadata, exp_metadata, bbox,
+                                    linked_metadata=linked_metadata)
+        assert numpy.allclose(res, (0.01, 0.01))
+
+        res = get_common_resolution(haz_metadata, exp_metadata, bbox,
+                                    max_pixels=20000,
+                                    linked_metadata=linked_metadata)
+        assert numpy.allclose(res, (0.02, 0.02))
+
+        # Only data covered by the linked layer is used and the exposure
+        # is snapped to the grid of the linked raster it shares
+        haz_bbox, exp_bbox, imp_bbox = get_bounding_boxes(haz_metadata,
+                                                          exp_metadata,
+                                                          bbox, (0.01, 0.01),
+                                                          linked_metadata)
+        assert numpy.allclose(haz_bbox, [104.005, -7.0, 106.0, -5.0])
+        assert numpy.allclose(exp_bbox, [104.005, -7.005, 106.005, -4.995])
+        assert exp_bbox == imp_bbox
+
+        linked_bbox = get_linked_bounding_box(haz_metadata, exp_metadata,
+                                              linked_metadata[0],
+                                              haz_bbox, exp_bbox, haz_bbox)
+        assert linked_bbox == exp_bbox
+
+        # Linked vector layers are downloaded with the layer they are
+        # linked to
+        vec_metadata = {'layertype': 'vector', 'native_crs': None}
+        linked_bbox = get_linked_bounding_box(haz_metadata, exp_metadata,
+                                              vec_metadata,
+                                              haz_bbox, exp_bbox, haz_bbox)
+        assert linked_bbox == haz_bbox
+
+        # Layers not overlapping the linked layer are reported
+        try:
+            get_bounding_boxes(haz_metadata, exp_metadata,
+                               '100.0,-9.0,103.0,-7.0', None,
+                               linked_metadata)
+        except Exception, e:
+            assert 'Linked layers cover' in str(e)
+        else:
+            msg = 'Bounding boxes not covered by linked layer were accepted'
+            raise Exception(msg)
+
+        # Rasters are only downloaded in their projection if all layers,
+        # linked ones included, share it
+        crs = 'EPSG:32748'
+        native_bbox = [650000.0, 9250000.0, 750000.0, 9350000.0]
+        metadata = {'layertype': 'raster',
+                    'title': 'raster',
+                    'resolution': (0.0009, 0.0009),
+                    'native_crs': crs,
+                    'native_geotransform': (650000.0, 100.0, 0.0,
+                                            9350000.0, 0.0, -100.0),
+                    'native_bounding_box': native_bbox}
+        fine_metadata = dict(metadata,
+                             resolution=(0.00045, 0.00045),
+                             native_geotransform=(650000.0, 50.0, 0.0,
+                                                  9350000.0, 0.0, -50.0))
+        assert get_common_native_crs(metadata, metadata) == crs
+        assert get_common_native_crs(metadata, metadata,
+                                     [fine_metadata]) == crs
+        assert get_common_native_crs(metadata, metadata,
+                                     [vec_metadata]) is None
+        geo_metadata = dict(metadata, native_crs='EPSG:4326')
+        assert get_common_native_crs(metadata, metadata,
+                                     [geo_metadata]) is None
+
+        # The finest linked raster sets the native grid
+        req_bbox = transform_bounding_box([680010.0, 9280010.0,
+                                           690010.0, 9290010.0],
+                                          crs, 'EPSG:4326')
+        bbox, res = get_native_download(metadata, metadata, req_bbox,
+                                        (0.00045, 0.00045),
+                                        [fine_metadata])
+        assert numpy.allclose(res, (50.0, 50.0))
+
+    def test_local_windows(self):
+        """Windows read from local files match those served by GeoServer
+        """
+
+        # Raster window at native resolution
+        filename = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        assert get_crs(filename) == 'EPSG:4326'
+
+        layer = save_to_geonode(filename, user=self.user, overwrite=True)
+        layer_name = '%s:%s' % (layer.workspace, layer.name)
+
+        R = read_layer(filename)
+        west, south, east, north = R.get_bounding_box()
+        bbox = [west + (east - west) / 3, south + (north - south) / 3,
+                east - (east - west) / 4, north - (north - south) / 4]
+
+        tif_filename = unique_filename(suffix='.tif')
+        extract_raster_window(filename, bbox, tif_filename, rows_per_block=7)
+        R1 = read_layer(tif_filename)
+        R2 = download(INTERNAL_SERVER_URL, layer_name, bbox)
+        assert numpy.allclose(R1.get_geotransform(), R2.get_geotransform(),
+                              rtol=1.0e-12, atol=1.0e-12)
+        assert nanallclose(R1.get_data(), R2.get_data())
+        os.remove(tif_filename)
+
+        # Vector window with selected attributes
+        filename = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        V = read_layer(filename)
+        west, south, east, north = V.get_bounding_box()
+        bbox = [west, south, (west + east) / 2, (south + north) / 2]
+
+        selected = list(V.get_attribute_names())[:1]
+        shp_filename = unique_filename(suffix='.shp')
+        extract_vector_window(filename, bbox, shp_filename,
+                              attributes=selected + ['not_an_attribute'])
+        V1 = read_layer(shp_filename)
+        assert 0 < len(V1) < len(V)
+        assert list(V1.get_attribute_names()) == selected
+
+    def test_tiled_mosaic(self):
+        """Rasters split into overlapping tiles mosaic back to the original
+        """
+
+        filename = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        R = read_layer(filename)
+        bbox = R.get_bounding_box()
+        resolution = R.get_resolution(isotropic=False)
+
+        tiles = split_bounding_box(bbox, resolution, 50)
+        assert len(tiles) > 1
+        assert numpy.allclose(tiles[0][0], bbox[0])
+        assert numpy.allclose(tiles[0][3], bbox[3])
+        assert numpy.allclose(tiles[-1][1:3], bbox[1:3])
+
+        with scratch_dir('test') as dirname:
+            filenames = []
+            for i, tile in enumerate(tiles):
+                buffered = bbox_intersection(buffered_bounding_box(
+                    tile, resolution), bbox)
+                tile_filename = os.path.join(dirname, 'tile%i.tif' % i)
+                extract_raster_window(filename, buffered, tile_filename)
+                filenames.append(tile_filename)
+
+            mosaic_filename = os.path.join(dirname, 'mosaic.tif')
+            mosaic_rasters(filenames, tiles, bbox, resolution,
+                           mosaic_filename)
+
+            M = read_layer(mosaic_filename)
+            assert numpy.allclose(M.get_geotransform(), R.get_geotransform())
+            assert nanallclose(M.get_data(), R.get_data())
+
+        # Summary statistics add up over tiles
+        totals = sum_keywords([{'total': '10', 'mean': '2.5'},
+                               {'total': '5', 'mean': '1.5'},
+                               {'total': '7'}], ['total', 'mean'])
+        assert totals == {'total': 22}
+
+    def test_tiled_totals(self):
+        """Totals of tiled calculations equal those of untiled ones
+        """
+
+        hazard_filename = os.path.join(UNITDATA, 'hazard',
+                                       'jakarta_flood_design.tif')
+        exposure_filename = os.path.join(TESTDATA,
+                                         'Population_Jakarta_geographic.asc')
+
+        download_layers = []
+        for filename in [hazard_filename, exposure_filename]:
+            layer = save_to_geonode(filename, user=self.user, overwrite=True)
+            download_layers.append((INTERNAL_SERVER_URL,
+                                    '%s:%s' % (layer.workspace, layer.name)))
+
+        H = read_layer(hazard_filename)
+        bbox = H.get_bounding_box()
+        resolution = H.get_resolution(isotropic=False)
+
+        (impact_function_name,) = [
+            name for name, function in get_admissible_plugins().items()
+            if function is TiledSumFunction]
+
+        with scratch_dir('test') as dirname:
+            # Reference calculated in one go
+            layers = [download(server, layer_name, bbox, resolution,
+                               scratch_dir=dirname)
+                      for server, layer_name in download_layers]
+            impact = calculate_impact(layers=layers,
+                                      impact_fcn=TiledSumFunction)
+            reference = float(impact.get_keywords()['total_exposed'])
+            remove_impact_file(impact.filename)
+            assert reference > 0
+
+            # Same calculation in many small tiles
+            tile_size = calculations.CALCULATION_TILE_SIZE
+            calculations.CALCULATION_TILE_SIZE = 50
+            try:
+                filename = calculate_tiled(impact_function_name,
+                                           download_layers, bbox,
+                                           resolution, dirname, processes=2)
+            finally:
+                calculations.CALCULATION_TILE_SIZE = tile_size
+
+            keywords = read_layer(filename).get_keywords()
+            total = float(keywords['total_exposed'])
+            msg = ('Total %f of tiled calculation differs from total %f of '
+                   'untiled calculation' % (total, reference))
+            assert numpy.allclose(total, reference, rtol=1.0e-6), msg
+
+            # Summary of the impact function is made from the total
+            expected = TiledSumFunction.summary_template % keywords
+            msg = ('Expected impact summary %s but got %s'
+                   % (expected, keywords['impact_summary']))
+            assert keywords['impact_summary'] == expected, msg
+
+            # Threads other than the main one calculate tiles themselves
+            filenames = []
+            thread = threading.Thread(
+                target=lambda: filenames.append(calculate_tiled(
+                    impact_function_name, download_layers, bbox,
+                    resolution, dirname, processes=2)))
+            thread.start()
+            thread.join()
+            (filename,) = filenames
+            total = float(read_layer(filename).get_keywords()['total_exposed'])
+            msg = ('Total %f of tiled calculation in thread differs from '
+                   'total %f of untiled calculation' % (total, reference))
+            assert numpy.allclose(total, reference, rtol=1.0e-6), msg
+
+    def test_feature_batches(self):
+        """Vector layers can be downloaded a batch of features at a time
+        """
+
+        filename = os.path.join(UNITDATA, 'exposure',
+                                'buildings_osm_4326.shp')
+        with scratch_dir('test') as dirname:
+            thefile = os.path.join(dirname, 'buildings_batched.shp')
+            add_id_attribute(filename, thefile, 'gid')
+            layer = save_to_geonode(thefile, user=self.user, overwrite=True,
+                                    spatial_index=True)
+            layer_name = '%s:%s' % (layer.workspace, layer.name)
+            bbox = get_bounding_box_string(thefile)
+            reference = read_layer(thefile)
+
+        batch_size = len(reference) // 3 + 1
+
+        gids = []
+        for start in range(0, len(reference), batch_size):
+            with scratch_dir('test') as dirname:
+                L = download(INTERNAL_SERVER_URL, layer_name, bbox,
+                             scratch_dir=dirname, in_memory=False,
+                             start_index=start, max_features=batch_size)
+            assert 0 < len(L) <= batch_size
+            gids.extend([int(attributes['gid'])
+                         for attributes in L.get_data()])
+
+        # Batches neither overlap nor miss features
+        msg = ('Expected features %i to %i in all batches, got %s'
+               % (0, len(reference) - 1, sorted(gids)))
+        assert sorted(gids) == range(len(reference)), msg
+
+        # Layers without an attribute to sort by are not split
+        sort_attributes = storage.WFS_SORT_ATTRIBUTES
+        storage.WFS_SORT_ATTRIBUTES = []
+        try:
+            try:
+                with scratch_dir('test') as dirname:
+                    download(INTERNAL_SERVER_URL, layer_name, bbox,
+                             scratch_dir=dirname, in_memory=False,
+                             start_index=0, max_features=batch_size)
+            except RisikoException:
+                pass
+            else:
+                msg = 'Layer without sort attribute was downloaded in parts'
+                raise Exception(msg)
+
+            # and are calculated in one go, like layers of a single batch
+            with scratch_dir('test') as dirname:
+                filename = calculate_batched(
+                    'Any function', (INTERNAL_SERVER_URL, layer_name),
+                    (INTERNAL_SERVER_URL, layer_name), None, None,
+                    bboxstring2list(bbox), None, dirname,
+                    batch_size=batch_size)
+            assert filename is None
+        finally:
+            storage.WFS_SORT_ATTRIBUTES = sort_attributes
+
+        with scratch_dir('test') as dirname:
+            filename = calculate_batched(
+                'Any function', (INTERNAL_SERVER_URL, layer_name),
+                (INTERNAL_SERVER_URL, layer_name), None, None,
+                bboxstring2list(bbox), None, dirname,
+                batch_size=len(reference))
+        assert filename is None
+
+    def test_memmap_raster(self):
+        """Uncompressed GeoTIFF files can be memory mapped
+        """
+
+        filename = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        R = read_layer(filename)
+
+        with scratch_dir('test') as dirname:
+            # Window of whole grid is written uncompressed in strips
+            tif_filename = os.path.join(dirname, 'plain.tif')
+            extract_raster_window(filename, R.get_bounding_box(),
+                                  tif_filename)
+            A = memmap_raster(tif_filename)
+            assert isinstance(A, numpy.memmap)
+            assert nanallclose(A, R.get_data(nan=False))
+
+            # Changes are not written back
+            A[0, 0] = -1
+            B = memmap_raster(tif_filename)
+            assert B[0, 0] != -1
+
+            # Layers map a shared copy of their file if there is one
+            shared_filename = os.path.join(dirname, 'shared.tif')
+            shutil.copy(tif_filename, shared_filename)
+            L = read_mapped_raster(tif_filename, shared_filename)
+            assert isinstance(L, MappedRaster)
+            assert L.filename == tif_filename
+            assert L.data.filename == os.path.abspath(shared_filename)
+            assert nanallclose(L.get_data(), R.get_data())
+            assert numpy.allclose(L.get_geotransform(), R.get_geotransform())
+            assert L.get_projection() == R.get_projection()
+
+            # Compressed files are read as usual
+            tif_filename = os.path.join(dirname, 'compressed.tif')
+            convert_to_geotiff(filename, tif_filename)
+            assert memmap_raster(tif_filename) is None
+            assert read_mapped_raster(tif_filename) is None
+
+    def test_working_precision(self):
+        """Raster values are held in single precision when they allow it
+        """
+
+        A = numpy.array([[0.0, 1.5, numpy.nan], [2.25, -3.0, 1.0e6]])
+        B = cast_floats(A, 'float32')
+        assert B.dtype == numpy.float32
+        assert nanallclose(A, B, rtol=0, atol=0)
+
+        # Values that single precision can't represent are kept as they are
+        for value in [1.0e-40, 1.0e300]:
+            A[0, 0] = value
+            assert cast_floats(A, 'float32') is A
+
+        # Narrower and integer types are left alone
+        A = numpy.arange(6, dtype=numpy.int32).reshape(2, 3)
+        assert cast_floats(A, 'float32') is A
+
+        # Rasters are written in single precision unless asked otherwise
+        filename = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        R = read_layer(filename)
+        A = numpy.array(R.get_data(nan=False), dtype=numpy.float64)
+        with scratch_dir('test') as dirname:
+            tif_filename = os.path.join(dirname, 'single.tif')
+            write_raster_data(A, R.get_projection(), R.get_geotransform(),
+                              tif_filename, keywords={'category': 'hazard'})
+            assert not can_cast_raster(tif_filename, 'float32')
+            R1 = read_layer(tif_filename)
+            assert nanallclose(R1.get_data(), R.get_data())
+
+            tif_filename = os.path.join(dirname, 'double.tif')
+            write_raster_data(A, R.get_projection(), R.get_geotransform(),
+                              tif_filename, keywords={'precision': 'float64'})
+            assert can_cast_raster(tif_filename, 'float32')
+
+    def test_working_precision_impact(self):
+        """Impacts calculated in single precision match double precision
+        """
+
+        hazard_filename = os.path.join(UNITDATA, 'hazard',
+                                       'jakarta_flood_design.tif')
+        exposure_filename = os.path.join(TESTDATA,
+                                         'Population_Jakarta_geographic.asc')
+
+        layer_names = []
+        for filename in [hazard_filename, exposure_filename]:
+            layer = save_to_geonode(filename, user=self.user, overwrite=True)
+            layer_names.append('%s:%s' % (layer.workspace, layer.name))
+
+        H = read_layer(hazard_filename)
+        bbox = H.get_bounding_box()
+        resolution = H.get_resolution(isotropic=False)
+
+        with scratch_dir('test') as dirname:
+            # Reference with layers held in double precision
+            raster_dtype = storage.RASTER_DTYPE
+            storage.RASTER_DTYPE = None
+            try:
+                layers = [download(INTERNAL_SERVER_URL, layer_name, bbox,
+                                   resolution, scratch_dir=dirname)
+                          for layer_name in layer_names]
+            finally:
+                storage.RASTER_DTYPE = raster_dtype
+
+            reference = calculate_impact(layers=layers,
+                                         impact_fcn=TiledSumFunction)
+
+            # Same layers in working precision
+            casts = [cast_layer_data(L, 'float32') for L in layers]
+            assert any(casts)
+            impact = calculate_impact(layers=layers,
+                                      impact_fcn=TiledSumFunction)
+
+            msg = ('Impact calculated in single precision differs from '
+                   'impact calculated in double precision')
+            assert nanallclose(impact.get_data(), reference.get_data(),
+                               rtol=RASTER_DTYPE_RTOL), msg
+
+            total = float(impact.get_keywords()['total_exposed'])
+            expected = float(reference.get_keywords()['total_exposed'])
+            msg = ('Total %f in single precision differs from total %f '
+                   'in double precision' % (total, expected))
+            assert numpy.allclose(total, expected, rtol=RASTER_DTYPE_RTOL), msg
+
+            for R in [reference, impact]:
+                remove_impact_file(R.filename)
+
+    def test_tile_index(self):
+        """Tiles of rasters without valid data are recorded
+        """
+
+        # Raster of 30 x 40 pixels with valid data in one corner only
+        A = numpy.zeros((30, 40))
+        A[:] = numpy.nan
+        A[12:18, 25:28] = 1.0
+        projection = ('GEOGCS["WGS 84",DATUM["WGS_1984",'
+                      'SPHEROID["WGS 84",6378137,298.257223563]],'
+                      'PRIMEM["Greenwich",0],UNIT["degree",0.0174532925]]')
+        geotransform = (100.0, 0.1, 0.0, -5.0, 0.0, -0.1)
+        bbox = [100.0, -8.0, 104.0, -5.0]
+
+        with scratch_dir('test') as dirname:
+            filename = os.path.join(dirname, 'sparse.tif')
+            write_raster_data(A, projection, geotransform, filename)
+
+            index = get_tile_index(filename, tile_size=10)
+            assert index['shape'] == (30, 40)
+            assert index['tile_size'] == 10
+            assert index['crs'] == 'EPSG:4326'
+
+            # Valid data is in the second row of tiles
+            # and the third column of tiles only
+            expected = numpy.zeros((3, 4), dtype=bool)
+            expected[1, 2] = True
+            assert numpy.all(index['valid'] == expected)
+
+            # Bounding boxes shrink to the valid tiles
+            msg = 'Expected %s, got %s'
+            valid_bbox = valid_data_bounding_box(index, bbox)
+            expected_bbox = [102.0, -7.0, 103.0, -6.0]
+            assert numpy.allclose(valid_bbox, expected_bbox), \
+                msg % (expected_bbox, valid_bbox)
+
+            valid_bbox = valid_data_bounding_box(index,
+                                                 [102.5, -6.5, 104.0, -5.0])
+            expected_bbox = [102.5, -6.5, 103.0, -6.0]
+            assert numpy.allclose(valid_bbox, expected_bbox), \
+                msg % (expected_bbox, valid_bbox)
+
+            assert valid_data_bounding_box(index,
+                                           [100.0, -8.0, 102.0, -5.0]) is None
+
+            # Parts of a mosaic not covered by any tile have no data
+            mosaic_filename = os.path.join(dirname, 'mosaic.tif')
+            mosaic_rasters([filename], [expected_bbox], bbox, (0.1, 0.1),
+                           mosaic_filename)
+            M = read_layer(mosaic_filename).get_data()
+            assert M.shape == (30, 40)
+            assert numpy.sum(~numpy.isnan(M)) == 3 * 3
+
+            # Calculations shrink to the valid tiles on their own grid
+            haz_bbox, exp_bbox = shrink_to_valid_hazard(
+                index, bbox, [101.05, -7.95, 104.0, -5.0], (0.3, 0.3))
+            expected_bbox = [101.8, -7.1, 103.0, -5.9]
+            assert numpy.allclose(haz_bbox, expected_bbox), \
+                msg % (expected_bbox, haz_bbox)
+            assert numpy.allclose(exp_bbox, expected_bbox), \
+                msg % (expected_bbox, exp_bbox)
+
+            # Bounding boxes without valid data are left as they are
+            empty_bbox = [100.0, -8.0, 102.0, -5.0]
+            haz_bbox, exp_bbox = shrink_to_valid_hazard(index, empty_bbox,
+                                                        empty_bbox)
+            assert haz_bbox == empty_bbox
+            assert exp_bbox == empty_bbox
+
+            # Recorded indices only apply to the data they were made for
+            tile_index_dir = storage.TILE_INDEX_DIR
+            storage.TILE_INDEX_DIR = os.path.join(dirname, 'tile_index')
+            try:
+                index['checksum'] = get_file_checksum(filename)
+                save_tile_index('geonode:sparse', index)
+
+                metadata = {'keywords': {'checksum': index['checksum']},
+                            'native_geotransform': geotransform}
+                loaded = load_tile_index('geonode:sparse', metadata)
+                assert numpy.all(loaded['valid'] == index['valid'])
+                assert loaded['checksum'] == index['checksum']
+
+                metadata['native_geotransform'] = (100.0, 0.2, 0.0,
+                                                   -5.0, 0.0, -0.2)
+                assert load_tile_index('geonode:sparse', metadata) is None
+                assert load_tile_index('geonode:sparse') is not None
+
+                metadata = {'keywords': {'checksum': 'replaced'},
+                            'native_geotransform': geotransform}
+                assert load_tile_index('geonode:sparse', metadata) is None
+            finally:
+                storage.TILE_INDEX_DIR = tile_index_dir
+
+        # but only if no total would depend on the areas left out
+        class Function:
+            additive_keywords = ['total_affected', 'total_population']
+
+        assert not can_skip_empty_hazard(Function)
+        Function.hazard_keywords = ['total_affected']
+        assert not can_skip_empty_hazard(Function)
+        Function.hazard_keywords.append('total_population')
+        assert can_skip_empty_hazard(Function)
+        assert not can_skip_empty_hazard(TestStorage)
+
+    def test_layer_version(self):
+        """Layer versions change when data is replaced on the same grid
+        """
+
+        filename = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        R = read_layer(filename)
+        A = R.get_data(nan=False)
+
+        with scratch_dir('test') as dirname:
+            # Same grid, keywords and values, but in other places
+            metadata = []
+            for data in [A, A[::-1, :]]:
+                tif_filename = os.path.join(tempfile.mkdtemp(dir=dirname),
+                                            'replaced_flood.tif')
+                write_raster_data(data, R.get_projection(),
+                                  R.get_geotransform(), tif_filename,
+                                  keywords=R.get_keywords())
+                layer = save_to_geonode(tif_filename, user=self.user,
+                                        overwrite=True)
+                layer_name = '%s:%s' % (layer.workspace, layer.name)
+                metadata.append(get_metadata(INTERNAL_SERVER_URL,
+                                             layer_name))
+
+        old, new = metadata
+        for name in ['bounding_box', 'geotransform', 'native_crs']:
+            assert old[name] == new[name]
+
+        keywords = dict(old['keywords'])
+        assert keywords.pop('checksum') != new['keywords']['checksum']
+        assert keywords == dict([(key, value)
+                                 for key, value in new['keywords'].items()
+                                 if key != 'checksum'])
+
+        # Neither hot layers nor cached downloads of the old data are used
+        assert hotlayers.layer_version(old) != hotlayers.layer_version(new)
+        assert (hotlayers.entry_key(INTERNAL_SERVER_URL, layer_name, old) !=
+                hotlayers.entry_key(INTERNAL_SERVER_URL, layer_name, new))
+        assert (cache.cache_key(INTERNAL_SERVER_URL, layer_name, old) !=
+                cache.cache_key(INTERNAL_SERVER_URL, layer_name, new))
+
+    def test_hot_layer_store(self):
+        """Hot layers are shared read-only and evicted when unused
+        """
+
+        filename = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        R = read_layer(filename)
+        A = R.get_data(nan=True)
+
+        builds = []
+
+        def build(dirname):
+            builds.append(dirname)
+            hotlayers.write_entry(dirname, A, R.get_projection(),
+                                  R.get_geotransform(), R.get_keywords())
+
+        store_dir = hotlayers.HOT_LAYER_DIR
+        with scratch_dir('test') as dirname:
+            hotlayers.HOT_LAYER_DIR = dirname
+            try:
+                metadata = {'bounding_box': R.get_bounding_box(),
+                            'geotransform': R.get_geotransform(),
+                            'keywords': R.get_keywords()}
+                key = hotlayers.entry_key(INTERNAL_SERVER_URL,
+                                          'geonode:jakarta', metadata)
+
+                # Entry is built once and referenced by each user
+                entry = hotlayers.get_entry(key, build)
+                assert hotlayers.get_entry(key, build) == entry
+                assert len(builds) == 1
+                refs = hotlayers.read_refs(entry)
+                assert refs == {os.getpid(): 2}, refs
+
+                # Data is shared read-only
+                B, info = hotlayers.read_entry(entry)
+                assert isinstance(B, numpy.memmap)
+                assert nanallclose(A, B)
+                assert info['geotransform'] == R.get_geotransform()
+                try:
+                    B[0, 0] = 1
+                except (ValueError, RuntimeError):
+                    pass
+                else:
+                    msg = 'Data of hot layer store should be read-only'
+                    raise Exception(msg)
+
+                # References are given back when views are released
+                view = B[10:20, 10:20]
+                hotlayers.hold_view(view, entry)
+                del view
+                hotlayers.release_entry(entry)
+                assert hotlayers.read_refs(entry) == {}
+
+                # Entries in use are never evicted
+                hotlayers.get_entry(key, build)
+                assert hotlayers.evict_entries(max_size=0) == []
+                hotlayers.release_entry(entry)
+                assert hotlayers.evict_entries(max_size=0) == [key]
+                assert not os.path.exists(entry)
+
+                # A new version of the layer gets a new entry
+                metadata['keywords'] = {'category': 'hazard',
+                                        'subcategory': 'flood'}
+                assert hotlayers.entry_key(INTERNAL_SERVER_URL,
+                                           'geonode:jakarta',
+                                           metadata) != key
+            finally:
+                hotlayers.HOT_LAYER_DIR = store_dir
+
+    def test_spatial_index_cache(self):
+        """Downloads are cached together with a spatial index of features
+        """
+
+        filename = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        boxes = get_feature_envelopes(filename)
+        assert len(boxes) == len(read_layer(filename))
+
+        # Queries agree with a scan of all features
+        tree = build_str_tree(boxes, node_size=4)
+        west, south, east, north = get_bounding_box(filename)
+        bbox = [west, south, (west + east) / 2, (south + north) / 2]
+        expected = numpy.flatnonzero((boxes[:, 0] <= bbox[2]) &
+                                     (boxes[:, 2] >= bbox[0]) &
+                                     (boxes[:, 1] <= bbox[3]) &
+                                     (boxes[:, 3] >= bbox[1]))
+        found = query_str_tree(tree, bbox)
+        assert 0 < len(found) < len(boxes)
+        assert numpy.all(found == expected)
+
+        cache_dir = cache.CACHE_DIR
+        with scratch_dir('test') as dirname:
+            cache.CACHE_DIR = dirname
+            try:
+                metadata = {'bounding_box': [west, south, east, north],
+                            'keywords': {'category': 'exposure'}}
+                key = cache.cache_key(INTERNAL_SERVER_URL, 'geonode:osm',
+                                      metadata, bbox=bbox)
+                assert cache.get_cached_file(key) is None
+
+                # File is stored with its companions
+                cached_filename = cache.add_to_cache(key, filename)
+                assert cache.get_cached_file(key) == cached_filename
+                for ext in ['.shp', '.shx', '.dbf', '.prj']:
+                    assert os.path.isfile(
+                        os.path.splitext(cached_filename)[0] + ext)
+
+                # and with its index once that has been built
+                assert cache.load_spatial_index(cached_filename) is None
+                cached_tree = cache.get_spatial_index(cached_filename)
+                assert numpy.all(query_str_tree(cached_tree, bbox) ==
+                                 expected)
+                cached_tree = cache.load_spatial_index(cached_filename)
+                assert numpy.all(query_str_tree(cached_tree, bbox) ==
+                                 expected)
+
+                # Indices of other files are not stored
+                assert numpy.all(query_str_tree(
+                    cache.get_spatial_index(filename), bbox) == expected)
+                assert cache.load_spatial_index(filename) is None
+
+                # Other downloads of the layer have other keys
+                assert cache.cache_key(INTERNAL_SERVER_URL, 'geonode:osm',
+                                       metadata, bbox=None) != key
+
+                # Recently used entries are kept
+                assert cache.evict_cache(max_size=0) == []
+            finally:
+                cache.CACHE_DIR = cache_dir
+
+    def test_density_grids(self):
+        """Vector exposure can be summarised in grids counting features
+        """
+
+        filename = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        number_of_features = len(read_layer(filename))
+
+        with scratch_dir('test') as dirname:
+            for resolution in [0.001, 0.01]:
+                tif_filename = os.path.join(dirname,
+                                            'density_%g.tif' % resolution)
+                bbox = rasterize_feature_counts(filename, resolution,
+                                                tif_filename)
+
+                # Grid covers the layer and lines up with other grids
+                layer_bbox = get_bounding_box(filename)
+                assert bbox[0] <= layer_bbox[0] and bbox[1] <= layer_bbox[1]
+                assert bbox[2] >= layer_bbox[2] and bbox[3] >= layer_bbox[3]
+                for x in bbox:
+                    assert numpy.allclose(x / resolution,
+                                          round(x / resolution))
+
+                # Every feature is counted once
+                R = read_layer(tif_filename)
+                A = R.get_data()
+                msg = ('Expected %i features in grid, got %f'
+                       % (number_of_features, numpy.nansum(A)))
+                assert numpy.allclose(numpy.nansum(A),
+                                      number_of_features), msg
+                assert numpy.allclose(R.get_geotransform()[1], resolution)
+
+    def test_density_grid_selection(self):
+        """Finest admissible density grid within pixel budget is selected
+        """
+
+        (impact_function_name,) = [
+            name for name, function in get_admissible_plugins().items()
+            if function is TiledSumFunction]
+
+        haz_metadata = {'layertype': 'raster',
+                        'keywords': {'category': 'hazard',
+                                     'subcategory': 'tiled_sum_test'}}
+        keywords = {'category': 'exposure',
+                    'subcategory': 'tiled_sum_test',
+                    'datatype': 'count',
+                    'density_of': 'density_test'}
+        grids = [('geonode:%s' % get_density_grid_name('density_test', res),
+                  {'layertype': 'raster',
+                   'resolution': (res, res),
+                   'keywords': keywords})
+                 for res in [0.001, 0.01]]
+
+        # One degree square has 1e6 cells at the finer and 1e4 at the
+        # coarser resolution
+        bbox = [106.0, -7.0, 107.0, -6.0]
+        for max_pixels, expected in [(None, grids[0]),
+                                     (2.0e6, grids[0]),
+                                     (1.0e5, grids[1]),
+                                     (1.0e4, grids[1]),
+                                     (1.0e3, None)]:
+            grid = select_density_grid(haz_metadata, grids,
+                                       impact_function_name, bbox,
+                                       max_pixels)
+            msg = ('Expected grid %s for %s pixels, got %s'
+                   % (expected, max_pixels, grid))
+            assert grid == expected, msg
+
+        # Grids are not used by functions not accepting them
+        grid = select_density_grid(haz_metadata, grids,
+                                   'Not A Function', bbox)
+        assert grid is None
+
+        haz_metadata['keywords']['subcategory'] = 'flood'
+        grid = select_density_grid(haz_metadata, grids,
+                                   impact_function_name, bbox)
+        assert grid is None
+
+    def test_density_grid_calculation(self):
+        """Calculations switch to density grids of vector exposure
+        """
+
+        (impact_function_name,) = [
+            name for name, function in get_admissible_plugins().items()
+            if function is TiledSumFunction]
+
+        resolution = 0.01
+        with scratch_dir('test') as dirname:
+            # Buildings as exposure to the test impact function
+            basename = os.path.join(UNITDATA, 'exposure',
+                                    'buildings_osm_4326')
+            exp_filename = os.path.join(dirname, 'density_test.shp')
+            for ext in ['.shp', '.shx', '.dbf', '.prj']:
+                shutil.copy(basename + ext,
+                            os.path.splitext(exp_filename)[0] + ext)
+            write_keywords({'category': 'exposure',
+                            'subcategory': 'tiled_sum_test'},
+                           os.path.join(dirname, 'density_test.keywords'))
+
+            density_resolutions = storage.DENSITY_RESOLUTIONS
+            storage.DENSITY_RESOLUTIONS = [resolution]
+            try:
+                layer = save_to_geonode(exp_filename, user=self.user,
+                                        overwrite=True, density_grids=True)
+            finally:
+                storage.DENSITY_RESOLUTIONS = density_resolutions
+            exposure_name = '%s:%s' % (layer.workspace, layer.name)
+
+            # Hazard everywhere on the grid covering the buildings
+            bbox = get_bounding_box(exp_filename)
+            west = numpy.floor(bbox[0] / resolution) * resolution
+            north = numpy.ceil(bbox[3] / resolution) * resolution
+            nx = int(numpy.ceil((bbox[2] - west) / resolution))
+            ny = int(numpy.ceil((north - bbox[1]) / resolution))
+            R = read_layer(os.path.join(UNITDATA, 'hazard',
+                                        'jakarta_flood_design.tif'))
+            haz_filename = os.path.join(dirname, 'density_test_hazard.tif')
+            write_raster_data(numpy.ones((ny, nx)), R.get_projection(),
+                              (west, resolution, 0, north, 0, -resolution),
+                              haz_filename,
+                              keywords={'category': 'hazard',
+                                        'subcategory': 'tiled_sum_test'})
+            layer = save_to_geonode(haz_filename, user=self.user,
+                                    overwrite=True)
+            hazard_name = '%s:%s' % (layer.workspace, layer.name)
+
+        grids = get_density_grids(INTERNAL_SERVER_URL, exposure_name,
+                                  [resolution])
+        assert len(grids) == 1, grids
+        grid_name = grids[0][0]
+
+        # Viewports wider than the extent use the grid
+        calculation = Calculation(user=self.user,
+                                  run_date=datetime.datetime.now(),
+                                  hazard_server=INTERNAL_SERVER_URL,
+                                  hazard_layer=hazard_name,
+                                  exposure_server=INTERNAL_SERVER_URL,
+                                  exposure_layer=exposure_name,
+                                  impact_function=impact_function_name,
+                                  success=False)
+        result, _, _ = run_calculation(calculation,
+                                       bboxlist2string(bbox),
+                                       save_to_geonode,
+                                       density_min_extent=0)
+        msg = ('Calculation used exposure %s, expected density grid %s'
+               % (calculation.exposure_layer, grid_name))
+        assert calculation.exposure_layer == grid_name, msg
+        assert calculation.success
+
+        metadata = get_metadata(INTERNAL_SERVER_URL,
+                                '%s:%s' % (result.workspace, result.name))
+        total = float(metadata['keywords']['total_exposed'])
+        msg = 'Expected buildings to be counted, got total %f' % total
+        assert total > 0, msg
+
+    def test_linked_layers(self):
+        """Layers linked through the associates keyword are found
+        """
+
+        metadata = {'keywords': {'category': 'exposure'}}
+        assert get_linked_layers('geonode:population_yogya', metadata) == []
+
+        metadata['keywords']['associates'] = 'female_pct_yogya'
+        linked = get_linked_layers('geonode:population_yogya', metadata)
+        assert linked == ['geonode:female_pct_yogya'], linked
+
+        # Several names, other workspaces, duplicates and self references
+        metadata['keywords']['associates'] = ('female_pct_yogya; '
+                                              'other.age_yogya '
+                                              'female_pct_yogya '
+                                              'population_yogya')
+        linked = get_linked_layers('geonode:population_yogya', metadata)
+        assert linked == ['geonode:female_pct_yogya',
+                          'other:age_yogya'], linked
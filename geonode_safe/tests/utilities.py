@@ -1,6 +1,10 @@
+import os
 import time
 import types
+import shutil
 import numpy
+from osgeo import ogr
+from geonode_safe.utilities import create_shapefile_like
 from django.conf import settings
 from urlparse import urljoin
 
@@ -109,3 +113,46 @@ def combine_coordinates(x, y):
     points = numpy.array(points)
 
     return points
+
+
+def add_id_attribute(filename, id_filename, name='gid'):
+    """Write copy of shapefile with features numbered in an attribute
+
+    Input
+        filename: Name of shapefile to copy
+        id_filename: Name of shapefile to create. Its keywords are those
+                     of the original.
+        name: Name of integer attribute holding the feature numbers
+              0, 1, 2, ... in the order of the features
+
+    Output
+        number_of_features: Number of features written
+    """
+
+    src = ogr.Open(filename)
+    src_layer = src.GetLayer()
+    dst, dst_layer = create_shapefile_like(src_layer, id_filename)
+    dst_layer.CreateField(ogr.FieldDefn(name, ogr.OFTInteger))
+
+    dst_defn = dst_layer.GetLayerDefn()
+    number_of_features = 0
+    src_layer.ResetReading()
+    feature = src_layer.GetNextFeature()
+    while feature is not None:
+        new_feature = ogr.Feature(dst_defn)
+        new_feature.SetFrom(feature)
+        new_feature.SetField(name, number_of_features)
+        dst_layer.CreateFeature(new_feature)
+        new_feature.Destroy()
+        number_of_features += 1
+        feature = src_layer.GetNextFeature()
+
+    dst.Destroy()
+    src.Destroy()
+
+    keywords_filename = os.path.splitext(filename)[0] + '.keywords'
+    if os.path.isfile(keywords_filename):
+        shutil.copy(keywords_filename,
+                    os.path.splitext(id_filename)[0] + '.keywords')
+
+    return number_of_features
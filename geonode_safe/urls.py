@@ -8,6 +8,7 @@ urlpatterns = patterns('',
 
 urlpatterns += patterns('geonode_safe.views',
                        url(r'^api/v1/calculate/$', 'calculate', name='safe-calculate'),
+                       url(r'^api/v1/calculation/(?P<calculation_id>\d+)/$', 'calculation_status', name='safe-calculation-status'),
                        url(r'^api/v1/questions/$', 'questions', name='safe-questions'),
                        url(r'^api/v1/debug/$', 'debug', name='safe-debug'),
 )
@@ -5,10 +5,17 @@ import os
 import copy
 import numpy
 import math
+import hashlib
 import logging
+import threading
+
+from collections import OrderedDict
 
 from osgeo import ogr
-from tempfile import mkstemp
+from osgeo import gdal
+from osgeo import osr
+from osgeo import gdal_array
+from tempfile import mkdtemp
 from urllib2 import urlopen
 from safe.api import read_layer
 
@@ -37,31 +44,63 @@ TYPE_MAP = {type(None): ogr.OFTString,  # What else should this be?
 # Templates for downloading layers through rest
 WCS_TEMPLATE = '%s?version=1.0.0' + \
     '&service=wcs&request=getcoverage&format=GeoTIFF&' + \
-    'store=false&coverage=%s&crs=EPSG:4326&bbox=%s' + \
+    'store=false&coverage=%s&crs=%s&bbox=%s' + \
     '&resx=%s&resy=%s'
 
+# Names under which servers advertise WGS84 geographic coordinates
+GEOGRAPHIC_CRS = ['EPSG:4326', 'CRS:84',
+                  'URN:OGC:DEF:CRS:OGC:1.3:CRS84',
+                  'URN:OGC:DEF:CRS:EPSG::4326']
+
 WFS_TEMPLATE = '%s?service=WFS&version=1.0.0' + \
     '&request=GetFeature&typeName=%s' + \
     '&outputFormat=SHAPE-ZIP&bbox=%s'
 
+# Number of features within bounding box (GeoServer reads bbox as lon/lat
+# when the crs is given as EPSG:4326)
+WFS_HITS_TEMPLATE = '%s?service=WFS&version=1.1.0' + \
+    '&request=GetFeature&typeName=%s' + \
+    '&resultType=hits&bbox=%s,EPSG:4326'
+
+# Schema of vector layer
+WFS_DESCRIBE_TEMPLATE = '%s?service=WFS&version=1.0.0' + \
+    '&request=DescribeFeatureType&typeName=%s'
+
+# Attributes to download appended to WFS_TEMPLATE
+WFS_PROPERTY_TEMPLATE = '&propertyName=%s'
+
+# Download of vector layer in pages. Pages are only well defined if the
+# features are sorted, which needs WFS 1.1.0. Coordinates are asked for
+# as EPSG:4326 which GeoServer reads and writes as lon/lat.
+WFS_SORTED_TEMPLATE = '%s?service=WFS&version=1.1.0' + \
+    '&request=GetFeature&typeName=%s' + \
+    '&outputFormat=SHAPE-ZIP&bbox=%s,EPSG:4326' + \
+    '&srsName=EPSG:4326&sortBy=%s'
+
+# Paging parameters appended to WFS_SORTED_TEMPLATE
+WFS_PAGE_TEMPLATE = '&startIndex=%i'
+WFS_PAGE_SIZE_TEMPLATE = '&maxFeatures=%i'
+
 
 # Miscellaneous auxiliary functions
-def unique_filename(**kwargs):
+def unique_filename(suffix='', prefix='tmp', dir=None):
     """Create new filename guaranteed not to exist previoously
 
-    Use mkstemp to create the file, then remove it and return the name
+    Input
+        suffix, prefix, dir: As for tempfile.mkdtemp
+
+    Output
+        filename: Name prefix + suffix in a new directory made with mkdtemp.
+                  Nobody else can obtain the same name, so the file can be
+                  created without racing other processes. Files with the
+                  same basename and other extensions, e.g. the parts of a
+                  shapefile, go in the same directory.
 
     See http://docs.python.org/library/tempfile.html for details.
     """
 
-    _, filename = mkstemp(**kwargs)
-
-    try:
-        os.remove(filename)
-    except:
-        pass
-
-    return filename
+    dirname = mkdtemp(prefix=prefix, dir=dir)
+    return os.path.join(dirname, prefix + suffix)
 
 
 # GeoServer utility functions
@@ -158,13 +197,52 @@ def extract_WGS84_geotransform(layer):
 
     # Get bounding box in WGS84 geographic coordinates
     bbox = layer.boundingBoxWGS84
+    return grid2geotransform(bbox, layer.grid)
+
+
+def extract_native_geotransform(layer):
+    """Extract native coordinate reference system and geotransform
+
+    Input
+        layer: Raster layer object e.g. obtained from WebCoverageService
+
+    Output:
+        crs: Native coordinate reference system, e.g. 'EPSG:32750'
+        geotransform: GDAL geotransform in native coordinates
+        bbox: Bounding box [W, S, E, N] in native coordinates
+
+    Layers stored in WGS84 geographic coordinates give the same result
+    as extract_WGS84_geotransform with crs 'EPSG:4326'.
+    """
+
+    crs = 'EPSG:4326'
+    bbox = layer.boundingBoxWGS84
+    for envelope in getattr(layer, 'boundingboxes', []):
+        if not is_geographic(envelope['nativeSrs']):
+            crs = envelope['nativeSrs']
+            bbox = envelope['bbox']
+            break
+
+    return crs, grid2geotransform(bbox, layer.grid), list(bbox)
+
+
+def grid2geotransform(bbox, grid):
+    """Derive geotransform from bounding box and grid of OWS layer object
+
+    Input
+        bbox: Bounding box of grid with format [W, S, E, N]
+        grid: Grid object with highlimits, e.g. layer.grid
+
+    Output:
+        geotransform: GDAL geotransform with rotation 0
+    """
+
     top_left_x = bbox[0]
     top_left_y = bbox[3]
     bottom_right_x = bbox[2]
     bottom_right_y = bbox[1]
 
     # Get number of rows and columns
-    grid = layer.grid
     ncols = int(grid.highlimits[0]) + 1
     nrows = int(grid.highlimits[1]) + 1
 
@@ -231,12 +309,14 @@ def bbox_intersection(*args):
     Output
         result: The minimal common bounding box
 
+    Coordinates need not be geographic, but all boxes must be in the
+    same coordinate reference system.
     """
 
     msg = 'Function bbox_intersection must take at least 2 arguments.'
     assert len(args) > 1, msg
 
-    result = [-180, -90, 180, 90]
+    result = [-numpy.inf, -numpy.inf, numpy.inf, numpy.inf]
     for a in args:
         msg = ('Bounding box expected to be a list of the '
                'form [W, S, E, N]. '
@@ -323,6 +403,235 @@ def buffered_bounding_box(bbox, resolution):
     return bbox
 
 
+def align_bounding_box(bbox, geotransform, rtol=1.0e-6):
+    """Grow bounding box outward to the pixel boundaries of a raster grid
+
+    Input
+        bbox: Bounding box with format [W, S, E, N]
+        geotransform: GDAL geotransform (6-tuple) of the grid
+        rtol: Fraction of a pixel by which a border may miss a pixel
+              boundary and still be considered on it
+
+    Output
+        Bounding box [W, S, E, N] whose borders fall on pixel boundaries of
+        the grid and which contains the given bounding box.
+
+    Requesting an aligned bounding box at native resolution allows a
+    server to return a window of the grid without resampling it.
+    """
+
+    x0 = geotransform[0]
+    dx = geotransform[1]
+    y0 = geotransform[3]
+    dy = -geotransform[5]
+
+    west = x0 + math.floor((bbox[0] - x0) / dx + rtol) * dx
+    east = x0 + math.ceil((bbox[2] - x0) / dx - rtol) * dx
+    north = y0 - math.floor((y0 - bbox[3]) / dy + rtol) * dy
+    south = y0 - math.ceil((y0 - bbox[1]) / dy - rtol) * dy
+
+    return [west, south, east, north]
+
+
+def is_native_resolution(resolution, metadata):
+    """Determine if resolution is the native resolution of raster layer
+
+    Input
+        resolution: (resx, resy) or None meaning native resolution
+        metadata: Layer metadata
+
+    Output
+        True or False
+    """
+
+    if metadata['layertype'] != 'raster':
+        return False
+
+    if resolution is None:
+        return True
+
+    return numpy.allclose(resolution, metadata['resolution'],
+                          rtol=1.0e-9, atol=0)
+
+
+def align_to_layer(bbox, metadata, native=False):
+    """Align bounding box to native pixel grid of raster layer
+
+    Input
+        bbox: Bounding box with format [W, S, E, N]
+        metadata: Raster layer metadata with geotransform and bounding box
+        native: If True, bbox is in the native coordinate reference system
+                of the layer and is aligned with its native grid.
+                If False (default), bbox is in WGS84 geographic coordinates.
+
+    Output
+        Aligned bounding box clipped to the extent of the layer (which is
+        itself aligned) or bbox unchanged if it does not overlap the layer.
+    """
+
+    if native:
+        geotransform = metadata['native_geotransform']
+        layer_bbox = metadata['native_bounding_box']
+    else:
+        geotransform = metadata['geotransform']
+        layer_bbox = metadata['bounding_box']
+
+    aligned = align_bounding_box(bbox, geotransform)
+    clipped = bbox_intersection(aligned, layer_bbox)
+    if clipped is None:
+        return list(bbox)
+    else:
+        return clipped
+
+
+def is_geographic(crs):
+    """Determine if coordinate reference system is WGS84 geographic
+
+    Input
+        crs: Name of coordinate reference system, e.g. 'EPSG:4326' or None
+
+    Output
+        True if crs is None or one of the names in GEOGRAPHIC_CRS
+    """
+
+    if crs is None:
+        return True
+
+    return crs.upper() in GEOGRAPHIC_CRS
+
+
+def transform_bounding_box(bbox, source_crs, target_crs, points_per_edge=11):
+    """Transform bounding box between coordinate reference systems
+
+    Input
+        bbox: Bounding box with format [W, S, E, N] in source_crs
+        source_crs: Coordinate reference system of bbox, e.g. 'EPSG:4326'
+        target_crs: Coordinate reference system to transform to
+        points_per_edge: Number of points transformed along each edge
+
+    Output
+        Smallest bounding box in target_crs containing the transformed
+        points. Points along the edges are included as straight edges
+        generally become curved under the transformation.
+    """
+
+    source = osr.SpatialReference()
+    source.SetFromUserInput(str(source_crs))
+    target = osr.SpatialReference()
+    target.SetFromUserInput(str(target_crs))
+
+    # Keep coordinates in x, y (lon, lat) order with GDAL 3 and later
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    transform = osr.CoordinateTransformation(source, target)
+
+    xs = numpy.linspace(bbox[0], bbox[2], points_per_edge)
+    ys = numpy.linspace(bbox[1], bbox[3], points_per_edge)
+    points = ([(x, bbox[1]) for x in xs] + [(x, bbox[3]) for x in xs] +
+              [(bbox[0], y) for y in ys] + [(bbox[2], y) for y in ys])
+
+    transformed = numpy.array([transform.TransformPoint(x, y)[:2]
+                               for x, y in points])
+
+    return [min(transformed[:, 0]), min(transformed[:, 1]),
+            max(transformed[:, 0]), max(transformed[:, 1])]
+
+
+def get_common_native_crs(haz_metadata, exp_metadata, linked_metadata=None):
+    """Get projected coordinate reference system shared by raster layers
+
+    Input
+        haz_metadata: Metadata for hazard layer
+        exp_metadata: Metadata for exposure layer
+        linked_metadata: Optional list of metadata for layers linked to
+                         hazard or exposure (see get_linked_layers)
+
+    Output
+        crs: Native coordinate reference system of all layers if they
+             are rasters stored in the same projected system, else None
+    """
+
+    if linked_metadata is None:
+        linked_metadata = []
+
+    crs = haz_metadata.get('native_crs')
+    if is_geographic(crs):
+        return None
+
+    for metadata in [haz_metadata, exp_metadata] + linked_metadata:
+        if (metadata['layertype'] != 'raster' or
+            metadata.get('native_crs') != crs):
+            return None
+
+    return crs
+
+
+def get_native_download(haz_metadata, exp_metadata, bbox,
+                        raster_resolution=None, linked_metadata=None):
+    """Get bounding box and resolution for downloads in native projection
+
+    Input
+        haz_metadata: Metadata for hazard layer
+        exp_metadata: Metadata for exposure layer
+        bbox: Bounding box of impact in WGS84 geographic coordinates
+        raster_resolution: Common resolution as obtained from
+                           get_common_resolution. If it is coarser than
+                           the finest layer, the native resolution is
+                           coarsened by the same factor.
+        linked_metadata: Optional list of metadata for layers linked to
+                         hazard or exposure. They are downloaded on the
+                         same grid.
+
+    Output
+        native_bbox: Bounding box [W, S, E, N] in the native coordinate
+                     reference system shared by the layers (see
+                     get_common_native_crs) aligned with the grid of
+                     the finest layer if used at its native resolution
+        native_resolution: Common resolution in native units (resx, resy)
+    """
+
+    if linked_metadata is None:
+        linked_metadata = []
+    layers = [haz_metadata, exp_metadata] + linked_metadata
+
+    crs = get_common_native_crs(haz_metadata, exp_metadata, linked_metadata)
+    msg = ('Layers %s do not share a projected coordinate reference '
+           'system' % ', '.join([metadata['title'] for metadata in layers]))
+    assert crs is not None, msg
+
+    native_bbox = transform_bounding_box(bbox, 'EPSG:4326', crs)
+    native_bbox = bbox_intersection(native_bbox,
+                                    *[metadata['native_bounding_box']
+                                      for metadata in layers])
+    msg = ('Bounding box %s does not overlap layers %s in native '
+           'coordinates' % (bbox, ', '.join([metadata['title']
+                                             for metadata in layers])))
+    assert native_bbox is not None, msg
+
+    # Use the finest native resolution
+    finest = None
+    for metadata in layers:
+        res = geotransform2resolution(metadata['native_geotransform'])
+        if finest is None or res[0] * res[1] < finest[0] * finest[1]:
+            finest = res
+            finest_metadata = metadata
+
+    # Apply any coarsening of the geographic resolution
+    factor = 1
+    if raster_resolution is not None:
+        geographic_res = min([metadata['resolution'][0]
+                              for metadata in layers])
+        factor = max(1, int(round(raster_resolution[0] / geographic_res)))
+
+    if factor == 1:
+        native_bbox = align_to_layer(native_bbox, finest_metadata,
+                                     native=True)
+
+    return native_bbox, (finest[0] * factor, finest[1] * factor)
+
+
 def is_sequence(x):
     """Determine if x behaves like a true sequence but not a string
 
@@ -453,46 +762,115 @@ def nanallclose(x, y, rtol=1.0e-5, atol=1.0e-8):
     return numpy.allclose(x, y, rtol=rtol, atol=atol)
 
 
-def get_common_resolution(haz_metadata, exp_metadata):
+def get_common_resolution(haz_metadata, exp_metadata,
+                          req_bbox=None, max_pixels=None,
+                          linked_metadata=None):
     """Determine common resolution for raster layers
 
     Input
         haz_metadata: Metadata for hazard layer
         exp_metadata: Metadata for exposure layer
+        req_bbox: Optional requested bounding box (string or list)
+        max_pixels: Optional maximal number of pixels in each raster.
+                    If the common bounding box of the layers and req_bbox
+                    would hold more pixels at the finest resolution, the
+                    resolution is coarsened by the smallest power of two
+                    that brings the number within budget.
+        linked_metadata: Optional list of metadata for layers linked to
+                         hazard or exposure (see get_linked_layers).
+                         Linked rasters share the common resolution.
 
     Output
-        raster_resolution: Common resolution or None (in case of vector layers)
+        raster_resolution: Common resolution or None (in case of vector layers
+                           used with native raster resolution)
     """
 
-    # Determine resolution in case of raster layers
-    haz_res = exp_res = None
-    if haz_metadata['layertype'] == 'raster':
-        haz_res = haz_metadata['resolution']
+    if linked_metadata is None:
+        linked_metadata = []
 
-    if exp_metadata['layertype'] == 'raster':
-        exp_res = exp_metadata['resolution']
+    # Determine resolution in case of raster layers
+    resolutions = [metadata['resolution']
+                   for metadata in [haz_metadata, exp_metadata] +
+                   linked_metadata
+                   if metadata['layertype'] == 'raster']
 
-    # Determine common resolution in case of two raster layers
-    if haz_res is None or exp_res is None:
+    # Determine common resolution in case of two or more raster layers
+    if len(resolutions) < 2:
         # This means native resolution will be used
         raster_resolution = None
     else:
         # Take the minimum
-        resx = min(haz_res[0], exp_res[0])
-        resy = min(haz_res[1], exp_res[1])
+        resx = min([res[0] for res in resolutions])
+        resy = min([res[1] for res in resolutions])
 
         raster_resolution = (resx, resy)
 
+    # Enforce pixel budget
+    if max_pixels is not None and req_bbox is not None:
+        if raster_resolution is not None:
+            res = raster_resolution
+        elif len(resolutions) > 0:
+            res = resolutions[0]
+        else:
+            # No rasters involved
+            return raster_resolution
+
+        if isinstance(req_bbox, basestring):
+            req_bbox = bboxstring2list(req_bbox)
+
+        bbox = bbox_intersection(req_bbox,
+                                 haz_metadata['bounding_box'],
+                                 exp_metadata['bounding_box'],
+                                 *[metadata['bounding_box']
+                                   for metadata in linked_metadata])
+        if bbox is None:
+            # No overlap. This is reported by get_bounding_boxes.
+            return raster_resolution
+
+        factor = get_coarsening_factor(bbox, res, max_pixels)
+        if factor > 1:
+            raster_resolution = (res[0] * factor, res[1] * factor)
+
     return raster_resolution
 
 
-def get_bounding_boxes(haz_metadata, exp_metadata, req_bbox):
+def get_coarsening_factor(bbox, resolution, max_pixels):
+    """Get power of two by which to coarsen resolution to fit pixel budget
+
+    Input
+        bbox: Bounding box with format [W, S, E, N]
+        resolution: (resx, resy)
+        max_pixels: Maximal number of pixels
+
+    Output
+        factor: Smallest power of two such that the bounding box holds no
+                more than max_pixels pixels at resolution times factor
+    """
+
+    ncols = (bbox[2] - bbox[0]) / resolution[0]
+    nrows = (bbox[3] - bbox[1]) / resolution[1]
+
+    factor = 1
+    while (ncols / factor) * (nrows / factor) > max_pixels:
+        factor *= 2
+
+    return factor
+
+
+def get_bounding_boxes(haz_metadata, exp_metadata, req_bbox,
+                       raster_resolution=None, linked_metadata=None):
     """Check and get appropriate bounding boxes for input layers
 
     Input
         haz_metadata: Metadata for hazard layer
         exp_metadata: Metadata for exposure layer
         req_bbox: Bounding box (string as requested by HTML POST, or list)
+        raster_resolution: Resolution used for raster layers as returned by
+                           get_common_resolution. None means native.
+        linked_metadata: Optional list of metadata for layers linked to
+                         hazard or exposure. Only data they all cover is
+                         used and linked rasters share the grid of the
+                         other rasters (see get_linked_bounding_box).
 
     Output
         haz_bbox: Bounding box to be used for hazard layer.
@@ -518,13 +896,18 @@ def get_bounding_boxes(haz_metadata, exp_metadata, req_bbox):
                'It must be a string or a list' % (str(req_bbox), type(req_bbox)))
         raise Exception(msg)
 
+    if linked_metadata is None:
+        linked_metadata = []
+
     # Get bounding boxes for layers
     haz_bbox = haz_metadata['bounding_box']
     exp_bbox = exp_metadata['bounding_box']
+    linked_bboxes = [metadata['bounding_box'] for metadata in linked_metadata]
 
     # New bounding box for data common to hazard, exposure and viewport
     # Download only data within this intersection
-    intersection_bbox = bbox_intersection(vpt_bbox, haz_bbox, exp_bbox)
+    intersection_bbox = bbox_intersection(vpt_bbox, haz_bbox, exp_bbox,
+                                          *linked_bboxes)
     if intersection_bbox is None:
         # Bounding boxes did not overlap
         msg = ('Bounding boxes of hazard data [%s], exposure data [%s] '
@@ -534,6 +917,10 @@ def get_bounding_boxes(haz_metadata, exp_metadata, req_bbox):
                % (bboxlist2string(haz_bbox, decimals=3),
                   bboxlist2string(exp_bbox, decimals=3),
                   bboxlist2string(vpt_bbox, decimals=3)))
+        if len(linked_bboxes) > 0:
+            msg += (' Linked layers cover [%s].'
+                    % '], ['.join([bboxlist2string(bbox, decimals=3)
+                                   for bbox in linked_bboxes]))
         logger.info(msg)
         raise Exception(msg)
 
@@ -542,7 +929,9 @@ def get_bounding_boxes(haz_metadata, exp_metadata, req_bbox):
     if (haz_metadata['layertype'] == 'raster' and
         exp_metadata['layertype'] == 'vector'):
 
-        haz_res = haz_metadata['resolution']
+        haz_res = raster_resolution
+        if haz_res is None:
+            haz_res = haz_metadata['resolution']
         haz_bbox = buffered_bounding_box(intersection_bbox, haz_res)
     else:
         haz_bbox = intersection_bbox
@@ -550,9 +939,58 @@ def get_bounding_boxes(haz_metadata, exp_metadata, req_bbox):
     # Usually the intersection bbox is used for both exposure layer and result
     exp_bbox = imp_bbox = intersection_bbox
 
+    # Snap bounding boxes outward to the native pixel grid of a raster layer
+    # that is used at native resolution. The server can then serve a window
+    # of its grid without resampling. When both layers are rasters they
+    # must share the same grid, so both are snapped to the same one.
+    # Linked rasters are downloaded on that grid too.
+    rasters = [metadata for metadata in [haz_metadata, exp_metadata] +
+               linked_metadata if metadata['layertype'] == 'raster']
+    native = [metadata for metadata in rasters
+              if is_native_resolution(raster_resolution, metadata)]
+    if len(native) > 0:
+        if (haz_metadata['layertype'] == 'raster' and
+            exp_metadata['layertype'] == 'raster'):
+            haz_bbox = exp_bbox = imp_bbox = align_to_layer(
+                intersection_bbox, native[0])
+        elif haz_metadata['layertype'] == 'raster':
+            haz_bbox = align_to_layer(haz_bbox, native[0])
+        elif exp_metadata['layertype'] == 'raster':
+            exp_bbox = imp_bbox = align_to_layer(exp_bbox, native[0])
+        else:
+            # Only linked layers are rasters
+            haz_bbox = exp_bbox = imp_bbox = align_to_layer(
+                intersection_bbox, native[0])
+
     return haz_bbox, exp_bbox, imp_bbox
 
 
+def get_linked_bounding_box(haz_metadata, exp_metadata, linked_metadata,
+                            haz_bbox, exp_bbox, bbox):
+    """Get bounding box to download linked layer with
+
+    Input
+        haz_metadata: Metadata for hazard layer
+        exp_metadata: Metadata for exposure layer
+        linked_metadata: Metadata for the linked layer
+        haz_bbox, exp_bbox: Bounding boxes of hazard and exposure layer
+                            as obtained from get_bounding_boxes
+        bbox: Bounding box of the layer it is linked to
+
+    Output
+        Bounding box of the hazard or exposure raster if the linked layer
+        is a raster so that all rasters share one grid, otherwise bbox
+    """
+
+    if linked_metadata['layertype'] == 'raster':
+        if haz_metadata['layertype'] == 'raster':
+            return haz_bbox
+        elif exp_metadata['layertype'] == 'raster':
+            return exp_bbox
+
+    return bbox
+
+
 def check_bbox_string(bbox_string):
     """Check that bbox string is valid
     """
@@ -672,6 +1110,12 @@ def bboxlist2string(bbox, decimals=6):
     return template % tuple(bbox)
 
 
+# Bounding boxes of recently inspected files keyed by (filename, mtime)
+BOUNDING_BOX_CACHE_SIZE = 256
+bounding_box_cache = OrderedDict()
+bounding_box_cache_lock = threading.Lock()
+
+
 def get_bounding_box(filename):
     """Get bounding box for specified raster or vector file
 
@@ -680,9 +1124,1478 @@ def get_bounding_box(filename):
 
     Output:
         bounding box as python list of numbers [West, South, East, North]
+
+    The bounding box is read from the file header (raster geotransform and
+    size or vector layer extent) without reading any data. Results are
+    cached by filename and modification time so repeated calls are free.
+    Formats that can not be handled this way fall back to read_layer.
+    """
+
+    try:
+        key = (os.path.abspath(filename), os.path.getmtime(filename))
+    except OSError:
+        # Not a regular file, e.g. a GDAL virtual file. Don't cache.
+        key = None
+
+    if key is not None:
+        with bounding_box_cache_lock:
+            if key in bounding_box_cache:
+                # Move to most recently used position
+                bbox = bounding_box_cache.pop(key)
+                bounding_box_cache[key] = bbox
+                return list(bbox)
+
+    bbox = get_bounding_box_from_header(filename)
+    if bbox is None:
+        layer = read_layer(filename)
+        bbox = layer.get_bounding_box()
+
+    if key is not None:
+        with bounding_box_cache_lock:
+            bounding_box_cache[key] = list(bbox)
+            while len(bounding_box_cache) > BOUNDING_BOX_CACHE_SIZE:
+                bounding_box_cache.popitem(last=False)
+
+    return list(bbox)
+
+
+def get_bounding_box_from_header(filename):
+    """Get bounding box from raster or vector file header
+
+    Input:
+        filename
+
+    Output:
+        bounding box as python list of numbers [West, South, East, North]
+        or None if the file could not be opened by OGR or GDAL
+    """
+
+    _, extension = os.path.splitext(filename)
+    if extension in ['.shp', '.gml']:
+        fid = ogr.Open(filename)
+        if fid is None:
+            return None
+
+        minx, maxx, miny, maxy = fid.GetLayer(0).GetExtent()
+        return [minx, miny, maxx, maxy]
+
+    fid = gdal.Open(filename, gdal.GA_ReadOnly)
+    if fid is None:
+        return None
+
+    geotransform = fid.GetGeoTransform()
+    west = geotransform[0]
+    north = geotransform[3]
+    east = west + fid.RasterXSize * geotransform[1]
+    south = north + fid.RasterYSize * geotransform[5]
+
+    return [min(west, east), min(south, north),
+            max(west, east), max(south, north)]
+
+
+def geotiff_creation_options(compression='DEFLATE', blocksize=256):
+    """Get GDAL creation options for tiled and compressed GeoTIFF files
+
+    Input
+        compression: GeoTIFF compression scheme, e.g. DEFLATE or LZW.
+                     If None, the file is written uncompressed.
+        blocksize: Width and height of internal tiles in pixels
+
+    Output
+        options: List of GDAL creation options
+    """
+
+    options = ['TILED=YES',
+               'BLOCKXSIZE=%i' % blocksize,
+               'BLOCKYSIZE=%i' % blocksize]
+    if compression is not None:
+        options.append('COMPRESS=%s' % compression)
+
+    return options
+
+
+def is_optimized_geotiff(filename):
+    """Determine if GeoTIFF file is tiled, compressed and has overviews
+
+    Input
+        filename: Name of GeoTIFF file
+
+    Output
+        True or False
+    """
+
+    fid = gdal.Open(filename, gdal.GA_ReadOnly)
+    if fid is None:
+        return False
+
+    band = fid.GetRasterBand(1)
+    blockxsize, blockysize = band.GetBlockSize()
+    tiled = blockxsize < fid.RasterXSize and blockysize > 1
+    compressed = 'COMPRESSION' in fid.GetMetadata('IMAGE_STRUCTURE')
+    has_overviews = band.GetOverviewCount() > 0
+
+    return tiled and compressed and has_overviews
+
+
+def convert_to_geotiff(filename, tif_filename, rows_per_block=256,
+                       compression='DEFLATE', dtype=None):
+    """Convert raster file to tiled and compressed GeoTIFF
+
+    Input
+        filename: Name of any raster file readable by GDAL. In case of
+                  AAIGrid ASCII files (.asc) projection is taken from the
+                  accompanying .prj file.
+        tif_filename: Name of GeoTIFF file to create
+        rows_per_block: Number of grid rows converted at a time
+        compression: GeoTIFF compression scheme, e.g. DEFLATE or LZW
+        dtype: Optional numpy data type to store values as, e.g. 'float32'.
+               If None (default) the native data type is retained.
+               See can_cast_raster for checking that values survive.
+
+    Rows are streamed from the source into the GeoTIFF so memory use
+    is proportional to rows_per_block times the number of columns rather
+    than to the size of the grid. The nodata value of the grid is retained.
+    """
+
+    src = gdal.Open(filename, gdal.GA_ReadOnly)
+    if src is None:
+        msg = 'Could not open raster file %s' % filename
+        raise Exception(msg)
+
+    src_band = src.GetRasterBand(1)
+    ncols = src.RasterXSize
+    nrows = src.RasterYSize
+
+    if dtype is None:
+        datatype = src_band.DataType
+    else:
+        datatype = gdal_array.NumericTypeCodeToGDALTypeCode(
+            numpy.dtype(dtype).type)
+
+    driver = gdal.GetDriverByName(DRIVER_MAP['.tif'])
+    options = geotiff_creation_options(compression=compression)
+    dst = driver.Create(tif_filename, ncols, nrows, 1, datatype, options)
+    if dst is None:
+        msg = 'Could not create GeoTIFF file %s' % tif_filename
+        raise Exception(msg)
+
+    dst.SetGeoTransform(src.GetGeoTransform())
+    dst.SetProjection(src.GetProjection())
+
+    dst_band = dst.GetRasterBand(1)
+    nodata = src_band.GetNoDataValue()
+    if nodata is not None:
+        dst_band.SetNoDataValue(nodata)
+
+    # Stream blocks of rows from source to destination
+    for row in range(0, nrows, rows_per_block):
+        n = min(rows_per_block, nrows - row)
+        A = src_band.ReadAsArray(0, row, ncols, n)
+        if dtype is not None:
+            A = A.astype(dtype)
+        dst_band.WriteArray(A, 0, row)
+
+    # Close datasets to flush everything to disk
+    dst_band.FlushCache()
+    dst_band = dst = None
+    src_band = src = None
+
+
+def write_geotiff(A, projection, geotransform, filename):
+    """Write grid to GeoTIFF file in its own data type
+
+    Input
+        A: Numpy array with grid data
+        projection: WKT projection information
+        geotransform: GDAL geotransform (6-tuple)
+        filename: Name of GeoTIFF file to create
+
+    The file is written uncompressed in strips like those of
+    Raster.write_to_file, but without converting to double precision.
+    """
+
+    nrows, ncols = A.shape
+    datatype = gdal_array.NumericTypeCodeToGDALTypeCode(A.dtype.type)
+
+    driver = gdal.GetDriverByName(DRIVER_MAP['.tif'])
+    dst = driver.Create(filename, ncols, nrows, 1, datatype)
+    if dst is None:
+        msg = 'Could not create GeoTIFF file %s' % filename
+        raise Exception(msg)
+
+    dst.SetProjection(str(projection))
+    dst.SetGeoTransform(geotransform)
+    dst.GetRasterBand(1).WriteArray(A)
+
+    # Close dataset to flush everything to disk
+    dst = None
+
+
+def is_narrower_float(dtype, other):
+    """Determine if dtype is a floating point type narrower than other
+    """
+
+    dtype = numpy.dtype(dtype)
+    other = numpy.dtype(other)
+    return (dtype.kind == 'f' and other.kind == 'f' and
+            dtype.itemsize < other.itemsize)
+
+
+def cast_floats(A, dtype, rtol=1.0e-6, atol=0.0):
+    """Cast floating point array to narrower type if values survive
+
+    Input
+        A: Numpy array
+        dtype: Floating point type to cast to, e.g. 'float32'
+        rtol, atol: Tolerances within which all values must be represented
+                    by dtype. These are passed on to nanallclose.
+
+    Output
+        A cast to dtype if it is of a wider floating point type and all
+        values are within tolerance, otherwise A itself
+    """
+
+    if not is_narrower_float(dtype, A.dtype):
+        return A
+
+    B = A.astype(dtype)
+    if not nanallclose(B, A, rtol=rtol, atol=atol):
+        return A
+
+    return B
+
+
+def can_cast_raster(filename, dtype, rtol=1.0e-6, atol=0.0,
+                    rows_per_block=256):
+    """Determine if raster values can be stored in narrower floating point type
+
+    Input
+        filename: Name of raster file readable by GDAL
+        dtype: Floating point type, e.g. 'float32'
+        rtol, atol: Tolerances within which all values must be represented
+                    by dtype (see cast_floats)
+        rows_per_block: Number of grid rows checked at a time
+
+    Output
+        True if the file holds a wider floating point type than dtype
+        and all values are represented within tolerance, otherwise False
     """
 
-    layer = read_layer(filename)
-    return layer.get_bounding_box()
+    src = gdal.Open(filename, gdal.GA_ReadOnly)
+    if src is None:
+        msg = 'Could not open raster file %s' % filename
+        raise Exception(msg)
+
+    band = src.GetRasterBand(1)
+    native = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+    if not is_narrower_float(dtype, native):
+        return False
+
+    ncols = src.RasterXSize
+    nrows = src.RasterYSize
+    for row in range(0, nrows, rows_per_block):
+        n = min(rows_per_block, nrows - row)
+        A = band.ReadAsArray(0, row, ncols, n)
+        if cast_floats(A, dtype, rtol=rtol, atol=atol) is A:
+            return False
+
+    return True
 
 
+def build_overviews(filename, resampling='NEAREST', min_size=256):
+    """Build internal overview pyramid for GeoTIFF file
+
+    Input
+        filename: Name of GeoTIFF file. It is updated in place.
+        resampling: GDAL overview resampling method, e.g. NEAREST or AVERAGE
+        min_size: Overviews are added by successive factors of two until
+                  the smallest dimension of the overview would fall below
+                  this number of pixels.
+
+    Output
+        levels: List of decimation factors that were built
+    """
+
+    fid = gdal.Open(filename, gdal.GA_Update)
+    if fid is None:
+        msg = 'Could not open raster file %s for update' % filename
+        raise Exception(msg)
+
+    levels = []
+    factor = 2
+    while min(fid.RasterXSize, fid.RasterYSize) / factor >= min_size:
+        levels.append(factor)
+        factor *= 2
+
+    if len(levels) > 0:
+        fid.BuildOverviews(resampling, levels)
+
+    fid = None
+    return levels
+
+
+def _valid_blocks(band, rows_per_block=256):
+    """Generate valid values from raster band block by block
+
+    Input
+        band: GDAL raster band
+        rows_per_block: Number of grid rows read at a time
+
+    Output
+        Generator of flat numpy arrays with values that are neither NaN
+        nor equal to the nodata value of the band
+    """
+
+    nodata = band.GetNoDataValue()
+    ncols = band.XSize
+    nrows = band.YSize
+    for row in range(0, nrows, rows_per_block):
+        n = min(rows_per_block, nrows - row)
+        A = band.ReadAsArray(0, row, ncols, n).ravel()
+
+        mask = numpy.isnan(A)
+        if nodata is not None:
+            mask |= (A == nodata)
+
+        yield A[~mask]
+
+
+def get_file_checksum(filename, chunk_size=1048576):
+    """Get checksum of the data of a raster or vector file
+
+    Input
+        filename: Name of raster file or shapefile
+        chunk_size: Number of bytes read at a time
+
+    Output
+        checksum: MD5 hex digest of the file and, in case of shapefiles,
+                  of the attributes in the accompanying .dbf file
+    """
+
+    filenames = [filename]
+    basename, extension = os.path.splitext(filename)
+    if extension == '.shp' and os.path.isfile(basename + '.dbf'):
+        filenames.append(basename + '.dbf')
+
+    md5 = hashlib.md5()
+    for name in filenames:
+        f = open(name, 'rb')
+        try:
+            data = f.read(chunk_size)
+            while data:
+                md5.update(data)
+                data = f.read(chunk_size)
+        finally:
+            f.close()
+
+    return md5.hexdigest()
+
+
+def get_raster_statistics(filename, bins=16, rows_per_block=256):
+    """Compute summary statistics for raster file block by block
+
+    Input
+        filename: Name of raster file readable by GDAL
+        bins: Number of histogram bins
+        rows_per_block: Number of grid rows read at a time
+
+    Output
+        statistics: Dictionary with keys minimum, maximum, mean,
+                    nodata_fraction and histogram. The histogram is a list
+                    of pixel counts in bins equally spaced between minimum
+                    and maximum. If the raster has no valid pixels,
+                    minimum, maximum and mean are None and the histogram
+                    is empty.
+
+    Only a block of rows is held in memory at any time.
+    """
+
+    fid = gdal.Open(filename, gdal.GA_ReadOnly)
+    if fid is None:
+        msg = 'Could not open raster file %s' % filename
+        raise Exception(msg)
+
+    band = fid.GetRasterBand(1)
+    npixels = band.XSize * band.YSize
+
+    # First pass: Extrema, sum and number of valid pixels
+    minimum = maximum = None
+    total = 0.0
+    count = 0
+    for values in _valid_blocks(band, rows_per_block):
+        if len(values) == 0:
+            continue
+
+        block_min = float(numpy.min(values))
+        block_max = float(numpy.max(values))
+        if minimum is None:
+            minimum = block_min
+            maximum = block_max
+        else:
+            minimum = min(minimum, block_min)
+            maximum = max(maximum, block_max)
+
+        total += numpy.sum(values, dtype=numpy.float64)
+        count += len(values)
+
+    # Second pass: Histogram between extrema
+    histogram = []
+    if count > 0:
+        counts = numpy.zeros(bins, dtype=numpy.int64)
+        for values in _valid_blocks(band, rows_per_block):
+            counts += numpy.histogram(values, bins=bins,
+                                      range=(minimum, maximum))[0]
+        histogram = [int(x) for x in counts]
+
+    statistics = {'minimum': minimum,
+                  'maximum': maximum,
+                  'mean': None,
+                  'nodata_fraction': 1.0 - float(count) / npixels,
+                  'histogram': histogram}
+    if count > 0:
+        statistics['mean'] = total / count
+
+    return statistics
+
+
+def statistics2keywords(statistics):
+    """Convert raster statistics to list of keywords
+
+    Input
+        statistics: Dictionary as returned by get_raster_statistics
+
+    Output
+        keywords: List of strings of the form key:value
+
+    Keywords may not contain commas or colons, so the histogram is stored
+    as space separated percentages of the valid pixels. This also keeps
+    it short enough to be stored as a layer keyword.
+    """
+
+    keywords = []
+    for key in ['minimum', 'maximum', 'mean', 'nodata_fraction']:
+        if statistics[key] is not None:
+            keywords.append('%s:%.12g' % (key, statistics[key]))
+
+    counts = statistics['histogram']
+    if len(counts) > 0:
+        total = float(sum(counts))
+        percentages = [int(round(100 * x / total)) for x in counts]
+        keywords.append('histogram:%s' % ' '.join([str(x)
+                                                    for x in percentages]))
+
+    return keywords
+
+
+def keywords2statistics(keywords):
+    """Extract raster statistics from keywords dictionary
+
+    Input
+        keywords: Dictionary of keyword, value pairs as stored in layer
+                  metadata
+
+    Output
+        statistics: Dictionary with keys minimum, maximum, mean,
+                    nodata_fraction and histogram (in percent) or None if
+                    no statistics were stored with the layer.
+    """
+
+    if 'minimum' not in keywords:
+        return None
+
+    statistics = {}
+    for key in ['minimum', 'maximum', 'mean', 'nodata_fraction']:
+        if keywords.get(key) is None:
+            statistics[key] = None
+        else:
+            statistics[key] = float(keywords[key])
+
+    histogram = keywords.get('histogram')
+    if histogram is None:
+        statistics['histogram'] = []
+    else:
+        statistics['histogram'] = [int(x) for x in histogram.split()]
+
+    return statistics
+
+
+def hilbert_index(x, y, order=16):
+    """Compute position of grid cells along a Hilbert curve
+
+    Input
+        x, y: Numpy arrays of integer cell indices in [0, 2**order)
+        order: Number of bits used in each direction
+
+    Output
+        d: Numpy array with the distance of each cell along the curve
+
+    Cells that are close along the curve are also close in space, so
+    sorting features by this index makes them spatially coherent.
+    See http://en.wikipedia.org/wiki/Hilbert_curve
+    """
+
+    n = 2 ** order
+    x = numpy.array(x, dtype=numpy.int64)
+    y = numpy.array(y, dtype=numpy.int64)
+    d = numpy.zeros(x.shape, dtype=numpy.int64)
+
+    s = n // 2
+    while s > 0:
+        rx = ((x & s) > 0).astype(numpy.int64)
+        ry = ((y & s) > 0).astype(numpy.int64)
+        d += s * s * ((3 * rx) ^ ry)
+
+        # Rotate quadrant
+        swap = ry == 0
+        flip = swap & (rx == 1)
+        x = numpy.where(flip, n - 1 - x, x)
+        y = numpy.where(flip, n - 1 - y, y)
+        x, y = numpy.where(swap, y, x), numpy.where(swap, x, y)
+
+        s //= 2
+
+    return d
+
+
+def get_feature_order(filename, order=16):
+    """Get feature ids of vector file ordered along a Hilbert curve
+
+    Input
+        filename: Name of vector file readable by OGR
+        order: Number of bits used in each direction for the curve
+
+    Output
+        fids: Numpy array of feature ids sorted by the Hilbert index of
+              the centre of each feature envelope.
+    """
+
+    fid = ogr.Open(filename)
+    if fid is None:
+        msg = 'Could not open vector file %s' % filename
+        raise Exception(msg)
+
+    layer = fid.GetLayer(0)
+    minx, maxx, miny, maxy = layer.GetExtent()
+
+    # Collect envelope centres one feature at a time
+    fids = []
+    centres = []
+    layer.ResetReading()
+    feature = layer.GetNextFeature()
+    while feature is not None:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            centres.append((minx, miny))
+        else:
+            west, east, south, north = geometry.GetEnvelope()
+            centres.append(((west + east) / 2, (south + north) / 2))
+        fids.append(feature.GetFID())
+        feature = layer.GetNextFeature()
+
+    fids = numpy.array(fids, dtype=numpy.int64)
+    if len(fids) == 0:
+        return fids
+
+    # Map centres to integer grid spanning the layer extent
+    centres = numpy.array(centres, dtype=numpy.float64)
+    n = 2 ** order - 1
+    dx = max(maxx - minx, 1.0e-12)
+    dy = max(maxy - miny, 1.0e-12)
+    x = numpy.clip((centres[:, 0] - minx) / dx * n, 0, n).astype(numpy.int64)
+    y = numpy.clip((centres[:, 1] - miny) / dy * n, 0, n).astype(numpy.int64)
+
+    return fids[numpy.argsort(hilbert_index(x, y, order=order),
+                              kind='mergesort')]
+
+
+def create_shapefile_like(src_layer, filename, fields=None):
+    """Create empty shapefile with the schema of an OGR layer
+
+    Input
+        src_layer: OGR layer whose fields, geometry type and projection
+                   are to be used
+        filename: Name of shapefile to create
+        fields: Optional list of names of fields to include.
+                If None (default) all fields are included.
+
+    Output
+        dst: OGR data source. Call Destroy() on it when done.
+        dst_layer: Empty OGR layer of the new shapefile
+    """
+
+    driver = ogr.GetDriverByName(DRIVER_MAP['.shp'])
+    dst = driver.CreateDataSource(filename)
+    if dst is None:
+        msg = 'Could not create vector file %s' % filename
+        raise Exception(msg)
+
+    src_defn = src_layer.GetLayerDefn()
+    layer_name = os.path.splitext(os.path.basename(filename))[0]
+    dst_layer = dst.CreateLayer(layer_name,
+                                srs=src_layer.GetSpatialRef(),
+                                geom_type=src_defn.GetGeomType())
+    for i in range(src_defn.GetFieldCount()):
+        field_defn = src_defn.GetFieldDefn(i)
+        if fields is None or field_defn.GetName() in fields:
+            dst_layer.CreateField(field_defn)
+
+    return dst, dst_layer
+
+
+def sort_features_spatially(filename, sorted_filename):
+    """Write copy of shapefile with features ordered along a Hilbert curve
+
+    Input
+        filename: Name of shapefile to sort
+        sorted_filename: Name of shapefile to create
+
+    Attributes, geometries and projection are copied unchanged. Only the
+    order of the features differs which makes the records of any small
+    region lie close together on disk.
+    """
+
+    order = get_feature_order(filename)
+
+    src = ogr.Open(filename)
+    src_layer = src.GetLayer(0)
+    dst, dst_layer = create_shapefile_like(src_layer, sorted_filename)
+
+    dst_defn = dst_layer.GetLayerDefn()
+    for fid in order:
+        src_feature = src_layer.GetFeature(int(fid))
+        feature = ogr.Feature(dst_defn)
+        feature.SetFrom(src_feature)
+        dst_layer.CreateFeature(feature)
+        feature.Destroy()
+        src_feature.Destroy()
+
+    # Close datasets to flush everything to disk
+    dst.Destroy()
+    src.Destroy()
+
+
+def build_spatial_index(filename):
+    """Create quadtree spatial index (.qix) for shapefile
+
+    Input
+        filename: Name of shapefile
+
+    Output
+        qix_filename: Name of spatial index file
+    """
+
+    fid = ogr.Open(filename, 1)
+    if fid is None:
+        msg = 'Could not open shapefile %s for update' % filename
+        raise Exception(msg)
+
+    layer_name = fid.GetLayer(0).GetName()
+    fid.ExecuteSQL('CREATE SPATIAL INDEX ON %s' % layer_name)
+    fid.Destroy()
+
+    return os.path.splitext(filename)[0] + '.qix'
+
+
+def merge_shapefiles(filenames, merged_filename):
+    """Merge shapefiles with identical attributes into one
+
+    Input
+        filenames: List of shapefiles. All must have the same fields,
+                   geometry type and projection.
+        merged_filename: Name of shapefile to create
+
+    Features are copied one at a time in the order of the input files.
+    """
+
+    msg = 'Function merge_shapefiles must be given at least one file.'
+    assert len(filenames) > 0, msg
+
+    driver = ogr.GetDriverByName(DRIVER_MAP['.shp'])
+    dst = driver.CreateDataSource(merged_filename)
+    if dst is None:
+        msg = 'Could not create vector file %s' % merged_filename
+        raise Exception(msg)
+
+    # Take schema and features of first file
+    layer_name = os.path.splitext(os.path.basename(merged_filename))[0]
+    src = ogr.Open(filenames[0])
+    dst_layer = dst.CopyLayer(src.GetLayer(0), layer_name)
+    src.Destroy()
+
+    # Append features of the others
+    dst_defn = dst_layer.GetLayerDefn()
+    for filename in filenames[1:]:
+        src = ogr.Open(filename)
+        if src is None:
+            msg = 'Could not open vector file %s' % filename
+            raise Exception(msg)
+
+        src_layer = src.GetLayer(0)
+        src_feature = src_layer.GetNextFeature()
+        while src_feature is not None:
+            feature = ogr.Feature(dst_defn)
+            feature.SetFrom(src_feature)
+            dst_layer.CreateFeature(feature)
+            feature.Destroy()
+            src_feature.Destroy()
+            src_feature = src_layer.GetNextFeature()
+        src.Destroy()
+
+    # Close dataset to flush everything to disk
+    dst.Destroy()
+
+
+def is_simplifiable(filename):
+    """Determine if vector file has line or polygon geometries
+    """
+
+    fid = ogr.Open(filename)
+    if fid is None:
+        return False
+
+    g_type = fid.GetLayer(0).GetGeomType()
+    name = geometrytype2string(g_type)
+    return 'Polygon' in name or 'LineString' in name
+
+
+def simplify_shapefile(filename, simplified_filename, tolerance):
+    """Write copy of shapefile with simplified line or polygon geometries
+
+    Input
+        filename: Name of shapefile with line or polygon geometries
+        simplified_filename: Name of shapefile to create
+        tolerance: Maximal distance in the units of the projection (e.g.
+                   decimal degrees) between original and simplified
+                   geometries
+
+    Each geometry is simplified with the Douglas-Peucker algorithm in
+    the variant that preserves its topology, i.e. polygons stay valid and
+    rings do not collapse. Geometries that would become empty are kept.
+    Attributes, projection and feature order are copied unchanged.
+    """
+
+    src = ogr.Open(filename)
+    if src is None:
+        msg = 'Could not open vector file %s' % filename
+        raise Exception(msg)
+
+    src_layer = src.GetLayer(0)
+    dst, dst_layer = create_shapefile_like(src_layer, simplified_filename)
+
+    dst_defn = dst_layer.GetLayerDefn()
+    src_feature = src_layer.GetNextFeature()
+    while src_feature is not None:
+        feature = ogr.Feature(dst_defn)
+        feature.SetFrom(src_feature)
+
+        geometry = src_feature.GetGeometryRef()
+        if geometry is not None:
+            simplified = geometry.SimplifyPreserveTopology(tolerance)
+            if simplified is not None and not simplified.IsEmpty():
+                feature.SetGeometry(simplified)
+
+        dst_layer.CreateFeature(feature)
+        feature.Destroy()
+        src_feature.Destroy()
+        src_feature = src_layer.GetNextFeature()
+
+    # Close datasets to flush everything to disk
+    dst.Destroy()
+    src.Destroy()
+
+
+def get_crs(filename):
+    """Get coordinate reference system of raster or vector file
+
+    Input
+        filename: Name of raster or vector file
+
+    Output
+        crs: Authority and code, e.g. 'EPSG:4326' or None if the file
+             could not be opened or its projection not be identified
+    """
+
+    _, extension = os.path.splitext(filename)
+    if extension in ['.shp', '.gml']:
+        fid = ogr.Open(filename)
+        if fid is None:
+            return None
+
+        srs = fid.GetLayer(0).GetSpatialRef()
+        if srs is not None:
+            # Keep it valid after the file is closed
+            srs = srs.Clone()
+        fid.Destroy()
+    else:
+        fid = gdal.Open(filename, gdal.GA_ReadOnly)
+        if fid is None:
+            return None
+
+        wkt = fid.GetProjection()
+        fid = None
+        if wkt:
+            srs = osr.SpatialReference(wkt)
+        else:
+            srs = None
+
+    if srs is None:
+        return None
+
+    try:
+        srs.AutoIdentifyEPSG()
+    except RuntimeError:
+        # Not identifiable. Any existing authority is used.
+        pass
+
+    name = srs.GetAuthorityName(None)
+    code = srs.GetAuthorityCode(None)
+    if name is None or code is None:
+        return None
+
+    return '%s:%s' % (name, code)
+
+
+def extract_raster_window(filename, bbox, tif_filename, rows_per_block=256):
+    """Copy window of raster file covering bounding box to GeoTIFF file
+
+    Input
+        filename: Name of raster file readable by GDAL
+        bbox: Bounding box [W, S, E, N] in the coordinates of the file
+        tif_filename: Name of GeoTIFF file to create
+        rows_per_block: Number of grid rows copied at a time
+
+    The window consists of the whole pixels touched by bbox, clipped to
+    the extent of the grid. Only the window is read from the source and
+    values, data type, nodata value and projection are kept as they are.
+    """
+
+    src = gdal.Open(filename, gdal.GA_ReadOnly)
+    if src is None:
+        msg = 'Could not open raster file %s' % filename
+        raise Exception(msg)
+
+    geotransform = src.GetGeoTransform()
+    bbox = align_bounding_box(bbox, geotransform)
+
+    # Window in pixel coordinates clipped to the grid
+    x0 = max(0, int(round((bbox[0] - geotransform[0]) / geotransform[1])))
+    x1 = min(src.RasterXSize,
+             int(round((bbox[2] - geotransform[0]) / geotransform[1])))
+    y0 = max(0, int(round((bbox[3] - geotransform[3]) / geotransform[5])))
+    y1 = min(src.RasterYSize,
+             int(round((bbox[1] - geotransform[3]) / geotransform[5])))
+
+    msg = ('Bounding box %s does not overlap raster file %s'
+           % (bbox, filename))
+    assert x1 > x0 and y1 > y0, msg
+
+    src_band = src.GetRasterBand(1)
+    ncols = x1 - x0
+    nrows = y1 - y0
+
+    driver = gdal.GetDriverByName(DRIVER_MAP['.tif'])
+    dst = driver.Create(tif_filename, ncols, nrows, 1, src_band.DataType)
+    if dst is None:
+        msg = 'Could not create GeoTIFF file %s' % tif_filename
+        raise Exception(msg)
+
+    dst.SetGeoTransform((geotransform[0] + x0 * geotransform[1],
+                         geotransform[1], geotransform[2],
+                         geotransform[3] + y0 * geotransform[5],
+                         geotransform[4], geotransform[5]))
+    dst.SetProjection(src.GetProjection())
+
+    dst_band = dst.GetRasterBand(1)
+    nodata = src_band.GetNoDataValue()
+    if nodata is not None:
+        dst_band.SetNoDataValue(nodata)
+
+    # Stream blocks of rows of the window
+    for row in range(0, nrows, rows_per_block):
+        n = min(rows_per_block, nrows - row)
+        A = src_band.ReadAsArray(x0, y0 + row, ncols, n)
+        dst_band.WriteArray(A, 0, row)
+
+    # Close datasets to flush everything to disk
+    dst_band.FlushCache()
+    dst_band = dst = None
+    src_band = src = None
+
+
+def extract_vector_window(filename, bbox, shp_filename, attributes=None):
+    """Copy features of vector file within bounding box to shapefile
+
+    Input
+        filename: Name of vector file readable by OGR
+        bbox: Bounding box [W, S, E, N] in the coordinates of the file
+        shp_filename: Name of shapefile to create
+        attributes: Optional list of attribute names to copy.
+                    Names the file doesn't have are ignored.
+                    If None (default) all attributes are copied.
+
+    Features whose geometry intersects bbox are copied. A spatial index
+    (.qix) next to the source file, if any, is used to find them.
+    """
+
+    src = ogr.Open(filename)
+    if src is None:
+        msg = 'Could not open vector file %s' % filename
+        raise Exception(msg)
+
+    src_layer = src.GetLayer(0)
+    src_layer.SetSpatialFilterRect(bbox[0], bbox[1], bbox[2], bbox[3])
+
+    dst, dst_layer = create_shapefile_like(src_layer, shp_filename,
+                                           fields=attributes)
+
+    dst_defn = dst_layer.GetLayerDefn()
+    src_feature = src_layer.GetNextFeature()
+    while src_feature is not None:
+        feature = ogr.Feature(dst_defn)
+        feature.SetFrom(src_feature)
+        dst_layer.CreateFeature(feature)
+        feature.Destroy()
+        src_feature.Destroy()
+        src_feature = src_layer.GetNextFeature()
+
+    # Close datasets to flush everything to disk
+    dst.Destroy()
+    src.Destroy()
+
+
+def extract_vector_features(filename, fids, shp_filename):
+    """Copy given features of vector file to shapefile
+
+    Input
+        filename: Name of vector file readable by OGR
+        fids: Feature ids to copy, e.g. as found with query_str_tree
+        shp_filename: Name of shapefile to create
+    """
+
+    src = ogr.Open(filename)
+    if src is None:
+        msg = 'Could not open vector file %s' % filename
+        raise Exception(msg)
+
+    src_layer = src.GetLayer(0)
+    dst, dst_layer = create_shapefile_like(src_layer, shp_filename)
+
+    dst_defn = dst_layer.GetLayerDefn()
+    for fid in fids:
+        src_feature = src_layer.GetFeature(int(fid))
+        feature = ogr.Feature(dst_defn)
+        feature.SetFrom(src_feature)
+        dst_layer.CreateFeature(feature)
+        feature.Destroy()
+        src_feature.Destroy()
+
+    # Close datasets to flush everything to disk
+    dst.Destroy()
+    src.Destroy()
+
+
+def split_bounding_box(bbox, resolution, tile_size):
+    """Split bounding box into tiles of a given number of pixels
+
+    Input
+        bbox: Bounding box with format [W, S, E, N]
+        resolution: (resx, resy) of the grid
+        tile_size: Maximal width and height of tiles in pixels
+
+    Output
+        tiles: List of bounding boxes [W, S, E, N] covering bbox without
+               overlap, ordered row by row from the north west corner.
+               Internal borders fall on the pixel grid anchored at the
+               north west corner of bbox.
+    """
+
+    resx, resy = resolution
+    ncols = int(math.ceil((bbox[2] - bbox[0]) / resx - 1.0e-6))
+    nrows = int(math.ceil((bbox[3] - bbox[1]) / resy - 1.0e-6))
+
+    tiles = []
+    for row in range(0, nrows, tile_size):
+        north = bbox[3] - row * resy
+        south = max(bbox[1], north - tile_size * resy)
+        for col in range(0, ncols, tile_size):
+            west = bbox[0] + col * resx
+            east = min(bbox[2], west + tile_size * resx)
+            tiles.append([west, south, east, north])
+
+    return tiles
+
+
+def mosaic_rasters(filenames, tiles, bbox, resolution, mosaic_filename):
+    """Mosaic raster tiles into one GeoTIFF file
+
+    Input
+        filenames: Names of raster files with the same projection, data
+                   type and resolution, e.g. results for each tile
+        tiles: Bounding box [W, S, E, N] of the part of each file to use.
+               Files may extend beyond these, e.g. by an overlap, and need
+               not cover all of bbox. Uncovered areas are set to nodata.
+        bbox: Bounding box [W, S, E, N] of the mosaic
+        resolution: (resx, resy) of the mosaic
+        mosaic_filename: Name of GeoTIFF file to create
+
+    Only one tile is held in memory at a time.
+    """
+
+    msg = 'Expected one bounding box per file, got %i for %i files'
+    assert len(tiles) == len(filenames), msg % (len(tiles), len(filenames))
+
+    resx, resy = resolution
+    ncols = int(round((bbox[2] - bbox[0]) / resx))
+    nrows = int(round((bbox[3] - bbox[1]) / resy))
+
+    first = gdal.Open(filenames[0], gdal.GA_ReadOnly)
+    if first is None:
+        msg = 'Could not open raster file %s' % filenames[0]
+        raise Exception(msg)
+    first_band = first.GetRasterBand(1)
+
+    driver = gdal.GetDriverByName(DRIVER_MAP['.tif'])
+    options = geotiff_creation_options(compression=None)
+    dst = driver.Create(mosaic_filename, ncols, nrows, 1,
+                        first_band.DataType, options)
+    if dst is None:
+        msg = 'Could not create GeoTIFF file %s' % mosaic_filename
+        raise Exception(msg)
+
+    dst.SetGeoTransform((bbox[0], resx, 0.0, bbox[3], 0.0, -resy))
+    dst.SetProjection(first.GetProjection())
+
+    # Areas not covered by any tile have no data
+    dst_band = dst.GetRasterBand(1)
+    nodata = first_band.GetNoDataValue()
+    if nodata is not None:
+        dst_band.SetNoDataValue(nodata)
+        dst_band.Fill(nodata)
+    elif first_band.DataType in [gdal.GDT_Float32, gdal.GDT_Float64]:
+        dst_band.Fill(numpy.nan)
+    first_band = first = None
+
+    for filename, tile in zip(filenames, tiles):
+        src = gdal.Open(filename, gdal.GA_ReadOnly)
+        if src is None:
+            msg = 'Could not open raster file %s' % filename
+            raise Exception(msg)
+
+        # Window of tile in source and destination pixel coordinates
+        geotransform = src.GetGeoTransform()
+        x0 = int(round((tile[0] - geotransform[0]) / geotransform[1]))
+        y0 = int(round((tile[3] - geotransform[3]) / geotransform[5]))
+        nx = int(round((tile[2] - tile[0]) / resx))
+        ny = int(round((tile[3] - tile[1]) / resy))
+        col = int(round((tile[0] - bbox[0]) / resx))
+        row = int(round((bbox[3] - tile[3]) / resy))
+
+        A = src.GetRasterBand(1).ReadAsArray(x0, y0, nx, ny)
+        dst_band.WriteArray(A, col, row)
+        src = None
+
+    # Close dataset to flush everything to disk
+    dst_band.FlushCache()
+    dst_band = dst = None
+
+
+def get_memmap_layout(filename):
+    """Get layout of raster data that can be memory mapped
+
+    Input
+        filename: Name of GeoTIFF file
+
+    Output
+        offset: Position of the first pixel in the file in bytes
+        dtype: Numpy data type of pixels including byte order
+        shape: (rows, columns) of the grid
+
+        or None if the file is compressed, tiled, has more than one band or
+        is not a GeoTIFF with all rows stored contiguously in order.
+    """
+
+    fid = gdal.Open(filename, gdal.GA_ReadOnly)
+    if fid is None or fid.GetDriver().ShortName != DRIVER_MAP['.tif']:
+        return None
+
+    if fid.RasterCount != 1:
+        return None
+
+    if 'COMPRESSION' in fid.GetMetadata('IMAGE_STRUCTURE'):
+        return None
+
+    band = fid.GetRasterBand(1)
+    ncols = fid.RasterXSize
+    nrows = fid.RasterYSize
+    blockxsize, blockysize = band.GetBlockSize()
+    if blockxsize != ncols:
+        # Tiles are not stored row by row
+        return None
+
+    dtype = numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(
+        band.DataType))
+    strip_size = blockysize * ncols * dtype.itemsize
+
+    # Strips must follow each other without gaps
+    offset = None
+    for i in range(int(math.ceil(nrows / float(blockysize)))):
+        value = band.GetMetadataItem('BLOCK_OFFSET_0_%i' % i, 'TIFF')
+        if value is None:
+            return None
+
+        if offset is None:
+            offset = int(value)
+        elif int(value) != offset + i * strip_size:
+            return None
+
+    band = fid = None
+
+    # Byte order is given by the first two bytes of the file
+    f = open(filename, 'rb')
+    try:
+        byteorder = f.read(2)
+    finally:
+        f.close()
+
+    if byteorder == 'II':
+        dtype = dtype.newbyteorder('<')
+    elif byteorder == 'MM':
+        dtype = dtype.newbyteorder('>')
+    else:
+        return None
+
+    return offset, dtype, (nrows, ncols)
+
+
+def memmap_raster(filename):
+    """Memory map raster data of uncompressed GeoTIFF file
+
+    Input
+        filename: Name of GeoTIFF file
+
+    Output
+        A: Copy-on-write numpy.memmap of the grid or None if the layout of
+           the file does not allow it (see get_memmap_layout)
+
+    Pages of the file are read on demand when they are first accessed and
+    are shared through the page cache with all processes mapping the same
+    file. Changes made to A are private and never written to the file.
+    """
+
+    layout = get_memmap_layout(filename)
+    if layout is None:
+        return None
+
+    offset, dtype, shape = layout
+    return numpy.memmap(filename, dtype=dtype, mode='c',
+                        offset=offset, shape=shape)
+
+
+def get_tile_index(filename, tile_size=256):
+    """Record which tiles of raster file contain valid data
+
+    Input
+        filename: Name of raster file
+        tile_size: Width and height of tiles in pixels
+
+    Output
+        index: Dictionary with entries
+               valid: Boolean array with one element per tile which is True
+                      if any pixel of the tile is neither NaN nor nodata
+               geotransform: Geotransform of the grid
+               shape: (rows, columns) of the grid
+               tile_size: Width and height of tiles in pixels
+               crs: Coordinate reference system of the grid (see get_crs)
+
+    The file is read one row of tiles at a time.
+    """
+
+    src = gdal.Open(filename, gdal.GA_ReadOnly)
+    if src is None:
+        msg = 'Could not open raster file %s' % filename
+        raise Exception(msg)
+
+    band = src.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    ncols = src.RasterXSize
+    nrows = src.RasterYSize
+    starts = numpy.arange(0, ncols, tile_size)
+
+    valid = []
+    for row in range(0, nrows, tile_size):
+        n = min(tile_size, nrows - row)
+        A = band.ReadAsArray(0, row, ncols, n)
+
+        mask = numpy.isnan(A)
+        if nodata is not None:
+            mask |= (A == nodata)
+
+        # Columns with valid data then tiles with valid data
+        columns = (~mask).any(axis=0)
+        valid.append(numpy.logical_or.reduceat(columns, starts))
+
+    index = {'valid': numpy.array(valid, dtype=bool),
+             'geotransform': src.GetGeoTransform(),
+             'shape': (nrows, ncols),
+             'tile_size': tile_size,
+             'crs': get_crs(filename)}
+    band = src = None
+
+    return index
+
+
+def valid_data_bounding_box(index, bbox):
+    """Shrink bounding box to the tiles of a raster that have valid data
+
+    Input
+        index: Tile index as obtained from get_tile_index
+        bbox: Bounding box [W, S, E, N] in the coordinates of the grid
+
+    Output
+        Smallest part of bbox holding all valid tiles of the grid within
+        bbox or None if there are none. Borders that are moved fall on
+        tile boundaries and hence on pixel boundaries of the grid.
+    """
+
+    x0, dx, _, y0, _, dy = index['geotransform']
+    dy = -dy
+    nrows, ncols = index['shape']
+    size = index['tile_size']
+    valid = index['valid']
+
+    # Range of tiles overlapping bbox
+    j0 = max(0, int(math.floor((bbox[0] - x0) / (size * dx))))
+    j1 = min(valid.shape[1], int(math.ceil((bbox[2] - x0) / (size * dx))))
+    i0 = max(0, int(math.floor((y0 - bbox[3]) / (size * dy))))
+    i1 = min(valid.shape[0], int(math.ceil((y0 - bbox[1]) / (size * dy))))
+    if j1 <= j0 or i1 <= i0:
+        return None
+
+    window = valid[i0:i1, j0:j1]
+    rows = numpy.flatnonzero(window.any(axis=1))
+    cols = numpy.flatnonzero(window.any(axis=0))
+    if len(rows) == 0:
+        return None
+
+    # Extent of valid tiles (the last ones may be partial)
+    west = x0 + (j0 + cols[0]) * size * dx
+    east = x0 + min((j0 + cols[-1] + 1) * size, ncols) * dx
+    north = y0 - (i0 + rows[0]) * size * dy
+    south = y0 - min((i0 + rows[-1] + 1) * size, nrows) * dy
+
+    return bbox_intersection(bbox, [west, south, east, north])
+
+
+def get_feature_envelopes(filename):
+    """Get bounding boxes of the features of vector file
+
+    Input
+        filename: Name of vector file readable by OGR
+
+    Output
+        boxes: Numpy array with one row [W, S, E, N] per feature in the
+               order in which they are read. Rows of features without
+               geometry are NaN.
+    """
+
+    fid = ogr.Open(filename)
+    if fid is None:
+        msg = 'Could not open vector file %s' % filename
+        raise Exception(msg)
+
+    layer = fid.GetLayer(0)
+    boxes = []
+    layer.ResetReading()
+    feature = layer.GetNextFeature()
+    while feature is not None:
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            boxes.append((numpy.nan,) * 4)
+        else:
+            west, east, south, north = geometry.GetEnvelope()
+            boxes.append((west, south, east, north))
+        feature.Destroy()
+        feature = layer.GetNextFeature()
+    fid.Destroy()
+
+    return numpy.array(boxes, dtype=numpy.float64).reshape(-1, 4)
+
+
+def build_str_tree(boxes, node_size=16):
+    """Build packed R-tree over bounding boxes by Sort-Tile-Recursive
+
+    Input
+        boxes: Array with one row [W, S, E, N] per item
+        node_size: Number of children of each node
+
+    Output
+        tree: Dictionary of numpy arrays which can be stored with
+              numpy.savez and queried with query_str_tree:
+              ids: Item numbers in the order of the leaves
+              boxes: Boxes of leaves followed by those of the nodes of
+                     each level above, the root being last
+              level_bounds: Position of the first box of each level in
+                            boxes followed by the total number of boxes
+              node_size: Number of children of each node
+
+    Leaves are sorted into vertical slabs by the centre of their boxes and
+    within each slab from south to north. Nodes cover consecutive runs of
+    node_size boxes of the level below.
+    """
+
+    boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1, 4)
+    n = len(boxes)
+
+    # Sort leaves into slabs by x then by y within each slab
+    centres = (boxes[:, :2] + boxes[:, 2:]) / 2
+    number_of_nodes = int(math.ceil(n / float(node_size)))
+    number_of_slabs = max(1, int(math.ceil(math.sqrt(number_of_nodes))))
+    slab_size = number_of_slabs * node_size
+    by_x = numpy.argsort(centres[:, 0], kind='mergesort')
+    ids = []
+    for start in range(0, n, slab_size):
+        slab = by_x[start:start + slab_size]
+        ids.append(slab[numpy.argsort(centres[slab, 1], kind='mergesort')])
+
+    if n > 0:
+        ids = numpy.concatenate(ids)
+    else:
+        ids = numpy.zeros(0, dtype=numpy.int64)
+
+    # Build levels bottom up
+    level = boxes[ids]
+    levels = [level]
+    while len(level) > 1:
+        starts = numpy.arange(0, len(level), node_size)
+        level = numpy.column_stack(
+            [numpy.fmin.reduceat(level[:, 0], starts),
+             numpy.fmin.reduceat(level[:, 1], starts),
+             numpy.fmax.reduceat(level[:, 2], starts),
+             numpy.fmax.reduceat(level[:, 3], starts)])
+        levels.append(level)
+
+    level_bounds = numpy.cumsum([0] + [len(nodes) for nodes in levels])
+
+    return {'ids': ids,
+            'boxes': numpy.concatenate(levels),
+            'level_bounds': level_bounds,
+            'node_size': node_size}
+
+
+def query_str_tree(tree, bbox):
+    """Find items whose bounding box intersects given bounding box
+
+    Input
+        tree: Tree as built by build_str_tree
+        bbox: Bounding box [W, S, E, N]
+
+    Output
+        ids: Sorted numpy array of the numbers of matching items
+    """
+
+    boxes = tree['boxes']
+    level_bounds = tree['level_bounds']
+    node_size = int(tree['node_size'])
+    west, south, east, north = bbox
+
+    # Descend from the root one level at a time keeping nodes that
+    # intersect bbox. Comparisons with NaN boxes are always False.
+    level = len(level_bounds) - 2
+    if level < 0 or level_bounds[-1] == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    nodes = numpy.arange(level_bounds[level + 1] - level_bounds[level])
+    while True:
+        B = boxes[level_bounds[level] + nodes]
+        hit = ((B[:, 0] <= east) & (B[:, 2] >= west) &
+               (B[:, 1] <= north) & (B[:, 3] >= south))
+        nodes = nodes[hit]
+        if level == 0:
+            break
+
+        children = (nodes[:, numpy.newaxis] * node_size +
+                    numpy.arange(node_size)).ravel()
+        level -= 1
+        nodes = children[children < level_bounds[level + 1] -
+                         level_bounds[level]]
+
+    return numpy.sort(tree['ids'][nodes])
+
+
+def rasterize_feature_counts(filename, resolution, tif_filename, bbox=None):
+    """Count features of vector file in the cells of a regular grid
+
+    Input
+        filename: Name of vector file in WGS84 geographic coordinates
+        resolution: Width and height of grid cells in decimal degrees
+        tif_filename: Name of GeoTIFF file to create
+        bbox: Optional bounding box [W, S, E, N] of the grid. If None,
+              the extent of the layer is used. Borders are moved outwards
+              to multiples of resolution so that grids of the same
+              resolution line up.
+
+    Output
+        bbox: Bounding box of the grid
+
+    Each feature is counted in the cell containing the centre of its
+    envelope. Features are read one at a time.
+    """
+
+    fid = ogr.Open(filename)
+    if fid is None:
+        msg = 'Could not open vector file %s' % filename
+        raise Exception(msg)
+
+    layer = fid.GetLayer(0)
+    if bbox is None:
+        minx, maxx, miny, maxy = layer.GetExtent()
+        bbox = [minx, miny, maxx, maxy]
+
+    bbox = [math.floor(bbox[0] / resolution) * resolution,
+            math.floor(bbox[1] / resolution) * resolution,
+            math.ceil(bbox[2] / resolution) * resolution,
+            math.ceil(bbox[3] / resolution) * resolution]
+    ncols = max(1, int(round((bbox[2] - bbox[0]) / resolution)))
+    nrows = max(1, int(round((bbox[3] - bbox[1]) / resolution)))
+    bbox[2] = bbox[0] + ncols * resolution
+    bbox[3] = bbox[1] + nrows * resolution
+
+    centres = []
+    layer.ResetReading()
+    feature = layer.GetNextFeature()
+    while feature is not None:
+        geometry = feature.GetGeometryRef()
+        if geometry is not None:
+            west, east, south, north = geometry.GetEnvelope()
+            centres.append(((west + east) / 2, (south + north) / 2))
+        feature.Destroy()
+        feature = layer.GetNextFeature()
+
+    srs = layer.GetSpatialRef()
+    if srs is None:
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+    projection = srs.ExportToWkt()
+    fid.Destroy()
+
+    # Count centres in each cell with rows running from north to south
+    centres = numpy.array(centres, dtype=numpy.float64).reshape(-1, 2)
+    counts, _, _ = numpy.histogram2d(
+        centres[:, 1], centres[:, 0], bins=(nrows, ncols),
+        range=[[bbox[1], bbox[3]], [bbox[0], bbox[2]]])
+    counts = counts[::-1, :].astype(numpy.float32)
+
+    driver = gdal.GetDriverByName(DRIVER_MAP['.tif'])
+    dst = driver.Create(tif_filename, ncols, nrows, 1, gdal.GDT_Float32,
+                        geotiff_creation_options())
+    if dst is None:
+        msg = 'Could not create GeoTIFF file %s' % tif_filename
+        raise Exception(msg)
+
+    dst.SetGeoTransform((bbox[0], resolution, 0.0,
+                         bbox[3], 0.0, -resolution))
+    dst.SetProjection(projection)
+    dst.GetRasterBand(1).WriteArray(counts)
+    dst = None
+
+    return bbox
@@ -25,15 +25,39 @@ from __future__ import division
 
 import sys
 import inspect
+import logging
 import datetime
+import threading
+
+from multiprocessing.pool import ThreadPool
 
 from geonode_safe.storage import download
 from geonode_safe.storage import get_metadata
 from geonode_safe.storage import save_file_to_geonode
+from geonode_safe.storage import SIMPLIFICATION_FACTOR
+from geonode_safe.storage import MAX_PIXELS
+from geonode_safe.storage import PREVIEW_MAX_PIXELS
+from geonode_safe.storage import CALCULATION_HEARTBEAT, CALCULATION_TIMEOUT
+from geonode_safe.storage import NATIVE_CRS_DOWNLOADS
+from geonode_safe.storage import SKIP_EMPTY_TILES
+from geonode_safe.storage import load_tile_index
+from geonode_safe.storage import INTERNAL_SERVER_URL
+from geonode_safe.storage import DENSITY_MIN_EXTENT
+from geonode_safe.storage import get_density_grids
+from geonode_safe.storage import get_linked_layers
+from geonode_safe.storage import DOWNLOAD_THREADS
 from geonode_safe.models import Calculation, Workspace
-from geonode_safe.utilities import bboxlist2string
+from geonode_safe.models import get_duration
+from geonode_safe.scratch import make_scratch_dir, remove_scratch_dir
+from geonode_safe.calculations import is_tileable, calculate_tiled
+from geonode_safe.calculations import is_batchable, calculate_batched
+from geonode_safe.calculations import can_skip_empty_hazard
+from geonode_safe.calculations import shrink_to_valid_hazard
+from geonode_safe.utilities import bboxlist2string, bboxstring2list
 from geonode_safe.utilities import titelize
 from geonode_safe.utilities import get_common_resolution, get_bounding_boxes
+from geonode_safe.utilities import get_common_native_crs, get_native_download
+from geonode_safe.utilities import get_linked_bounding_box
 
 from safe.api import get_admissible_plugins
 from safe.api import calculate_impact
@@ -41,13 +65,17 @@ from safe.api import calculate_impact
 from geonode.layers.utils import get_valid_user
 
 from django.utils import simplejson as json
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
+from django.db import connection
+from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.cache import cache_page
 
 from urlparse import urljoin
 
+logger = logging.getLogger(__name__)
+
 
 def exception_format(e):
     """Convert an exception object into a string,
@@ -89,59 +117,159 @@ def get_servers(user):
     return geoservers
 
 
-@csrf_exempt
-def calculate(request, save_output=save_file_to_geonode):
-    start = datetime.datetime.now()
+def select_density_grid(haz_metadata, grids, impact_function_name, bbox,
+                        max_pixels=None):
+    """Choose density grid to use in place of vector exposure
 
-    if request.method == 'GET':
-        # FIXME: Add a basic form here to be able to generate the POST request.
-        return HttpResponse('This should be accessed by robots, not humans.'
-                            'In other words using HTTP POST instead of GET.')
-    elif request.method == 'POST':
-        data = request.POST
-        impact_function_name = data['impact_function']
-        hazard_server = data['hazard_server']
-        hazard_layer = data['hazard']
-        exposure_server = data['exposure_server']
-        exposure_layer = data['exposure']
-        requested_bbox = data['bbox']
-        keywords = data['keywords']
+    Input
+        haz_metadata: Metadata for hazard layer
+        grids: List of (layer_name, metadata) of density grids of the
+               exposure layer, finest first, as from get_density_grids
+        impact_function_name: Name of impact function as in
+                              get_admissible_plugins
+        bbox: Bounding box [W, S, E, N] of the viewport
+        max_pixels: Optional maximal number of grid cells in bbox
 
-    if request.user.is_anonymous():
-        theuser = get_valid_user()
-    else:
-        theuser = request.user
+    Output
+        Finest (layer_name, metadata) the impact function accepts with no
+        more than max_pixels cells in bbox or None if there is none
+    """
 
-    # Create entry in database
-    calculation = Calculation(user=theuser,
-                              run_date=start,
-                              hazard_server=hazard_server,
-                              hazard_layer=hazard_layer,
-                              exposure_server=exposure_server,
-                              exposure_layer=exposure_layer,
-                              impact_function=impact_function_name,
-                              success=False)
+    for layer_name, metadata in grids:
+        keywords = dict(metadata['keywords'])
+        keywords['layertype'] = metadata['layertype']
+        haz_keywords = dict(haz_metadata['keywords'])
+        haz_keywords['layertype'] = haz_metadata['layertype']
+
+        plugins = get_admissible_plugins(keywords=[haz_keywords, keywords])
+        if impact_function_name not in plugins:
+            continue
+
+        resx, resy = metadata['resolution']
+        pixels = ((bbox[2] - bbox[0]) / resx) * ((bbox[3] - bbox[1]) / resy)
+        if max_pixels is None or pixels <= max_pixels:
+            return layer_name, metadata
+
+    return None
+
+
+def run_calculation(calculation, requested_bbox, save_output,
+                    max_pixels=MAX_PIXELS,
+                    density_min_extent=DENSITY_MIN_EXTENT,
+                    preview=False):
+    """Calculate impact and upload it
+
+    Input
+        calculation: Calculation object naming the layers, impact function
+                     and user
+        requested_bbox: Bounding box string of the viewport
+        save_output: Function uploading the impact file such as
+                     save_file_to_geonode
+        max_pixels: Maximal number of pixels in each raster
+                    (see get_common_resolution). None means no limit.
+        density_min_extent: Viewports wider or taller than this number of
+                            degrees use density grids of vector exposure
+                            where available. None means never.
+        preview: Flag marking a coarse pass ahead of the full calculation.
+                 If True and the coarse pass would cost as much as the
+                 full one, because vector exposure is not replaced by a
+                 density grid and rasters are not coarsened, nothing is
+                 calculated and result is None.
+
+    Output
+        result: Uploaded impact layer
+        raster_resolution: Resolution used for raster layers
+                           (None means native)
+        download_crs: Coordinate reference system layers were downloaded
+                      in or None for EPSG:4326
+
+    The calculation is saved along the way and records the impact layer
+    on success. Exceptions are passed on to the caller.
+    """
 
-    # Wrap main computation loop in try except to catch and present
-    # messages and stack traces in the application
+    start = calculation.run_date
+    theuser = calculation.user
+    hazard_server = calculation.hazard_server
+    hazard_layer = calculation.hazard_layer
+    exposure_server = calculation.exposure_server
+    exposure_layer = calculation.exposure_layer
+    impact_function_name = calculation.impact_function
+
+    workdir = None
     try:
+        # All downloaded files go in a scratch directory for this calculation
+        workdir = make_scratch_dir('calculation')
+
         # Get metadata
         haz_metadata = get_metadata(hazard_server, hazard_layer)
         exp_metadata = get_metadata(exposure_server, exposure_layer)
 
+        # Use grid counting exposure features for large viewports
+        grid = None
+        if (density_min_extent is not None and
+            exp_metadata['layertype'] == 'vector'):
+            viewport = bboxstring2list(requested_bbox)
+            if max(viewport[2] - viewport[0],
+                   viewport[3] - viewport[1]) > density_min_extent:
+                grid = select_density_grid(
+                    haz_metadata,
+                    get_density_grids(exposure_server, exposure_layer),
+                    impact_function_name, viewport, max_pixels)
+                if grid is not None:
+                    exposure_layer, exp_metadata = grid
+                    calculation.exposure_layer = exposure_layer
+
+        # Get layers linked to hazard or exposure through their keywords.
+        # They are reconciled with hazard and exposure so that linked
+        # rasters share their grid and coordinate reference system.
+        linked_layers = []
+        for server, layer_name, metadata, category in [
+            (hazard_server, hazard_layer, haz_metadata, 'hazard'),
+            (exposure_server, exposure_layer, exp_metadata, 'exposure')]:
+            for linked_name in get_linked_layers(layer_name, metadata):
+                linked_layers.append((category, server, linked_name,
+                                      get_metadata(server, linked_name)))
+
+        linked_metadata = [metadata for _, _, _, metadata in linked_layers]
+
         # Determine common resolution in case of raster layers
-        raster_resolution = get_common_resolution(haz_metadata, exp_metadata)
+        # coarsened if needed to stay within the pixel budget
+        raster_resolution = get_common_resolution(haz_metadata, exp_metadata,
+                                                  requested_bbox, max_pixels,
+                                                  linked_metadata)
+
+        # Leave the preview to the full calculation if there is nothing
+        # to coarsen. Vector exposure costs the same at any resolution.
+        if preview:
+            full_resolution = get_common_resolution(haz_metadata,
+                                                    exp_metadata,
+                                                    requested_bbox,
+                                                    MAX_PIXELS,
+                                                    linked_metadata)
+            if (exp_metadata['layertype'] == 'vector' or
+                (grid is None and raster_resolution == full_resolution)):
+                return None, raster_resolution, None
 
         # Get reconciled bounding boxes
         haz_bbox, exp_bbox, imp_bbox = get_bounding_boxes(haz_metadata,
                                                           exp_metadata,
-                                                          requested_bbox)
-
-        # Record layers to download
-        download_layers = [(hazard_server, hazard_layer, haz_bbox),
-                           (exposure_server, exposure_layer, exp_bbox)]
-
-        # Add linked layers if any FIXME: STILL TODO!
+                                                          requested_bbox,
+                                                          raster_resolution,
+                                                          linked_metadata)
+
+        # Download rasters sharing a projected coordinate reference system
+        # in that system so the server does not have to reproject them.
+        # The impact layer is stored in the same system.
+        download_crs = None
+        if NATIVE_CRS_DOWNLOADS:
+            download_crs = get_common_native_crs(haz_metadata, exp_metadata,
+                                                 linked_metadata)
+
+        if download_crs is not None:
+            native_bbox, raster_resolution = get_native_download(
+                haz_metadata, exp_metadata, imp_bbox, raster_resolution,
+                linked_metadata)
+            haz_bbox = exp_bbox = native_bbox
 
         # Get selected impact function
         plugins = get_admissible_plugins()
@@ -153,6 +281,47 @@ def calculate(request, save_output=save_file_to_geonode):
         impact_function = plugins.get(impact_function_name)
         impact_function_source = inspect.getsource(impact_function)
 
+        # Attributes of vector layers used by the impact function, if
+        # declared as e.g. required_attributes = {'exposure': ['TYPE']}.
+        # Layers not mentioned are downloaded with all attributes.
+        required_attributes = getattr(impact_function,
+                                      'required_attributes', {})
+
+        # Leave out areas where the hazard layer has no valid data if
+        # recorded for hazard layers of the internal GeoServer
+        tile_index = None
+        if (SKIP_EMPTY_TILES and hazard_server == INTERNAL_SERVER_URL and
+            can_skip_empty_hazard(impact_function)):
+            tile_index = load_tile_index(hazard_layer, haz_metadata)
+            if (tile_index is not None and
+                tile_index['crs'] != (download_crs or 'EPSG:4326')):
+                tile_index = None
+
+        if tile_index is not None:
+            haz_bbox, exp_bbox = shrink_to_valid_hazard(tile_index, haz_bbox,
+                                                        exp_bbox,
+                                                        raster_resolution)
+            if download_crs is None:
+                imp_bbox = exp_bbox
+
+        # Record layers to download
+        download_layers = [('hazard', hazard_server, hazard_layer,
+                            haz_metadata, haz_bbox),
+                           ('exposure', exposure_server, exposure_layer,
+                            exp_metadata, exp_bbox)]
+
+        # Add layers linked to hazard or exposure. Linked rasters are
+        # downloaded on the grid of the other rasters so that all line up.
+        for category, server, linked_name, metadata in linked_layers:
+            if category == 'hazard':
+                bbox = haz_bbox
+            else:
+                bbox = exp_bbox
+            bbox = get_linked_bounding_box(haz_metadata, exp_metadata,
+                                           metadata, haz_bbox, exp_bbox, bbox)
+            download_layers.append(('linked', server, linked_name,
+                                    metadata, bbox))
+
         # Record information calculation object and save it
         calculation.impact_function_source = impact_function_source
 
@@ -163,42 +332,99 @@ def calculate(request, save_output=save_file_to_geonode):
         msg = 'Performing requested calculation'
         #logger.info(msg)
 
-        # Download selected layer objects
-        layers = []
-        for server, layer_name, bbox in download_layers:
-            msg = ('- Downloading layer %s from %s'
-                   % (layer_name, server))
+        # Simplify vector exposure to the effective hazard resolution
+        simplify_tolerance = None
+        if (SIMPLIFICATION_FACTOR is not None and
+            haz_metadata['layertype'] == 'raster' and
+            exp_metadata['layertype'] == 'vector'):
+            haz_res = raster_resolution
+            if haz_res is None:
+                haz_res = haz_metadata['resolution']
+            simplify_tolerance = SIMPLIFICATION_FACTOR * min(haz_res)
+
+        # Tiles and batches only hold hazard and exposure
+        impact_filename = None
+        if (len(linked_layers) == 0 and
+            is_tileable(impact_function, haz_metadata, exp_metadata,
+                        haz_bbox, raster_resolution)):
+            # Calculate large raster impacts tile by tile in parallel
+            msg = ('- Calculating impact in tiles using %s'
+                   % impact_function_name)
             #logger.info(msg)
-            L = download(server, layer_name, bbox, raster_resolution)
-            layers.append(L)
 
-        # Calculate result using specified impact function
-        msg = ('- Calculating impact using %s' % impact_function_name)
-        #logger.info(msg)
-        impact_file = calculate_impact(layers=layers,
+            impact_filename = calculate_tiled(
+                impact_function_name,
+                [(server, layer_name) for _, server, layer_name, _, _
+                 in download_layers],
+                haz_bbox, raster_resolution, workdir, crs=download_crs,
+                tile_index=tile_index)
+        elif (len(linked_layers) == 0 and
+              is_batchable(impact_function, haz_metadata, exp_metadata)):
+            # Calculate impact on vector exposure a batch at a time
+            msg = ('- Calculating impact in batches using %s'
+                   % impact_function_name)
+            #logger.info(msg)
+            impact_filename = calculate_batched(
+                impact_function_name,
+                (hazard_server, hazard_layer),
+                (exposure_server, exposure_layer),
+                haz_metadata, haz_bbox, exp_bbox, raster_resolution,
+                workdir, attributes=required_attributes,
+                simplify_tolerance=simplify_tolerance)
+
+        if impact_filename is None:
+            # Download selected layer objects
+            def download_layer(args):
+                category, server, layer_name, metadata, bbox = args
+                logger.info('- Downloading layer %s from %s'
+                            % (layer_name, server))
+                if category == 'exposure':
+                    tolerance = simplify_tolerance
+                else:
+                    tolerance = None
+
+                # Resolution only applies to rasters
+                if metadata['layertype'] == 'raster':
+                    resolution = raster_resolution
+                else:
+                    resolution = None
+
+                return download(server, layer_name, bbox, resolution,
+                                scratch_dir=workdir,
+                                attributes=required_attributes.get(category),
+                                simplify_tolerance=tolerance,
+                                crs=download_crs)
+
+            # All layers are fetched at the same time. Layers are
+            # returned in order with hazard and exposure first.
+            pool = ThreadPool(min(DOWNLOAD_THREADS, len(download_layers)))
+            try:
+                layers = pool.map(download_layer, download_layers)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+            # Calculate result using specified impact function
+            msg = ('- Calculating impact using %s' % impact_function_name)
+            #logger.info(msg)
+            impact_file = calculate_impact(layers=layers,
                                            impact_fcn=impact_function)
+            impact_filename = impact_file.filename
 
         # Upload result to internal GeoServer
-        msg = ('- Uploading impact layer %s' % impact_file.name)
+        msg = ('- Uploading impact layer %s' % impact_filename)
 
         #logger.info(msg)
-        result = save_output(impact_file.filename,
+        result = save_output(impact_filename,
                              title='output_%s' % start.isoformat(),
                              user=theuser)
-    except Exception, e:
-        # FIXME: Reimplement error saving for calculation.
-        # FIXME (Ole): Why should we reimplement?
-        # This is dangerous. Try to raise an exception
-        # e.g. in get_metadata_from_layer. Things will silently fail.
-        # See issue #170
-        #logger.error(e)
-        errors = e.__str__()
-        trace = exception_format(e)
-        calculation.errors = errors
-        calculation.stacktrace = trace
-        calculation.save()
-        jsondata = json.dumps({'errors': errors, 'stacktrace': trace})
-        return HttpResponse(jsondata, mimetype='application/json')
+    finally:
+        # Clean up downloads on completion and failure alike
+        if workdir is not None:
+            remove_scratch_dir(workdir)
 
     msg = ('- Result available at %s.' % result.get_absolute_url())
     #logger.info(msg)
@@ -207,6 +433,22 @@ def calculate(request, save_output=save_file_to_geonode):
     calculation.success = True
     calculation.save()
 
+    return result, raster_resolution, download_crs
+
+
+def calculation_output(calculation, result, raster_resolution=None,
+                       download_crs=None):
+    """Get description of successful calculation for the HTTP API
+
+    Input
+        calculation: Calculation object
+        result: Uploaded impact layer
+        raster_resolution, download_crs: As returned by run_calculation
+
+    Output
+        output: Dictionary that can be serialised with json.dumps
+    """
+
     output = calculation.__dict__
 
     # json.dumps does not like datetime objects,
@@ -217,6 +459,11 @@ def calculate(request, save_output=save_file_to_geonode):
     ows_server_url = settings.GEOSERVER_BASE_URL + 'ows',
     output['ows_server_url'] = ows_server_url
 
+    # Report resolution used for raster layers (None means native)
+    # in units of the coordinate reference system they were downloaded in
+    output['resolution'] = raster_resolution
+    output['crs'] = download_crs or 'EPSG:4326'
+
     # json.dumps does not like django users
     output['user'] = calculation.user.username
     output['pretty_function_source'] = calculation.pretty_function_source()
@@ -246,6 +493,260 @@ def calculate(request, save_output=save_file_to_geonode):
     if output['success'] and len(output['errors']) == 0:
         output['errors'] = None
 
+    return output
+
+
+@csrf_exempt
+def calculate(request, save_output=save_file_to_geonode):
+    start = datetime.datetime.now()
+
+    if request.method == 'GET':
+        # FIXME: Add a basic form here to be able to generate the POST request.
+        return HttpResponse('This should be accessed by robots, not humans.'
+                            'In other words using HTTP POST instead of GET.')
+    elif request.method == 'POST':
+        data = request.POST
+        impact_function_name = data['impact_function']
+        hazard_server = data['hazard_server']
+        hazard_layer = data['hazard']
+        exposure_server = data['exposure_server']
+        exposure_layer = data['exposure']
+        requested_bbox = data['bbox']
+        keywords = data['keywords']
+
+        # Answer quickly with a coarse calculation and run the full one
+        # in the background if asked to
+        preview = data.get('preview', '').lower() in ['true', '1', 'yes']
+
+    if request.user.is_anonymous():
+        theuser = get_valid_user()
+    else:
+        theuser = request.user
+
+    # Create entry in database
+    calculation = Calculation(user=theuser,
+                              run_date=start,
+                              hazard_server=hazard_server,
+                              hazard_layer=hazard_layer,
+                              exposure_server=exposure_server,
+                              exposure_layer=exposure_layer,
+                              impact_function=impact_function_name,
+                              success=False)
+
+    # Wrap main computation loop in try except to catch and present
+    # messages and stack traces in the application
+    try:
+        if preview:
+            # Coarse rasters and density grids at any viewport
+            if DENSITY_MIN_EXTENT is None:
+                preview_min_extent = None
+            else:
+                preview_min_extent = 0
+            result, raster_resolution, download_crs = run_calculation(
+                calculation, requested_bbox, save_output,
+                max_pixels=PREVIEW_MAX_PIXELS,
+                density_min_extent=preview_min_extent,
+                preview=True)
+
+            # Answer with the full calculation if it is no slower
+            if result is None:
+                preview = False
+
+        if not preview:
+            result, raster_resolution, download_crs = run_calculation(
+                calculation, requested_bbox, save_output)
+    except Exception, e:
+        # FIXME: Reimplement error saving for calculation.
+        # FIXME (Ole): Why should we reimplement?
+        # This is dangerous. Try to raise an exception
+        # e.g. in get_metadata_from_layer. Things will silently fail.
+        # See issue #170
+        #logger.error(e)
+        errors = e.__str__()
+        trace = exception_format(e)
+        calculation.errors = errors
+        calculation.stacktrace = trace
+        calculation.save()
+        jsondata = json.dumps({'errors': errors, 'stacktrace': trace})
+        return HttpResponse(jsondata, mimetype='application/json')
+
+    output = calculation_output(calculation, result, raster_resolution,
+                                download_crs)
+
+    if preview:
+        # Full calculation replacing the preview when it completes
+        full_calculation = Calculation(user=theuser,
+                                       run_date=datetime.datetime.now(),
+                                       hazard_server=hazard_server,
+                                       hazard_layer=hazard_layer,
+                                       exposure_server=exposure_server,
+                                       exposure_layer=exposure_layer,
+                                       impact_function=impact_function_name,
+                                       success=False)
+        full_calculation.save()
+        run_in_background(full_calculation, requested_bbox, save_output,
+                          preview_calculation=calculation,
+                          preview_layer=result)
+
+        output['preview'] = True
+        output['calculation_id'] = full_calculation.id
+        output['status_url'] = reverse('safe-calculation-status',
+                                       args=[full_calculation.id])
+
+    jsondata = json.dumps(output)
+    return HttpResponse(jsondata, mimetype='application/json')
+
+
+def run_in_background(calculation, requested_bbox, save_output,
+                      preview_calculation=None, preview_layer=None):
+    """Run calculation in a thread of its own
+
+    Input
+        calculation: Saved Calculation object
+        requested_bbox, save_output: See run_calculation
+        preview_calculation: Optional calculation previewing this one.
+                             It is pointed to the full impact layer once
+                             that is uploaded.
+        preview_layer: Optional impact layer of the preview. It is deleted
+                       once the full impact layer is uploaded.
+
+    Output
+        thread: The thread running the calculation. Errors are recorded
+                with the calculation which can be polled through
+                calculation_status.
+
+    The calculation is saved every SAFE_CALCULATION_HEARTBEAT seconds
+    while it runs so that calculations lost with the process running them
+    can be told apart from those still running (see is_stale).
+    """
+
+    done = threading.Event()
+
+    def beat():
+        try:
+            while not done.wait(CALCULATION_HEARTBEAT):
+                # Only run_duration is updated so as not to overwrite
+                # what the calculation records meanwhile
+                Calculation.objects.filter(
+                    id=calculation.id, success=False).update(
+                    run_duration=get_duration(calculation.run_date))
+        finally:
+            connection.close()
+
+    def run():
+        try:
+            run_calculation(calculation, requested_bbox, save_output)
+        except Exception, e:
+            calculation.errors = e.__str__()
+            calculation.stacktrace = exception_format(e)
+            calculation.save()
+        else:
+            if preview_calculation is not None:
+                Calculation.objects.filter(
+                    id=preview_calculation.id).update(
+                    layer=calculation.layer)
+
+            if preview_layer is not None:
+                try:
+                    preview_layer.delete()
+                except Exception, e:
+                    # The full result is there regardless
+                    logger.warning('Could not delete preview layer %s: %s'
+                                   % (preview_layer, e))
+        finally:
+            done.set()
+
+            # Each thread has a database connection of its own
+            connection.close()
+
+    heartbeat = threading.Thread(target=beat,
+                                 name='geonode_safe-heartbeat-%i'
+                                 % calculation.id)
+    heartbeat.daemon = True
+    heartbeat.start()
+
+    thread = threading.Thread(target=run,
+                              name='geonode_safe-calculation-%i'
+                              % calculation.id)
+    thread.daemon = True
+    thread.start()
+
+    return thread
+
+
+def is_stale(calculation, timeout=None):
+    """Determine if unfinished calculation is no longer running
+
+    Input
+        calculation: Calculation object
+        timeout: Number of seconds after which calculations that were not
+                 saved are considered lost, e.g. because the worker
+                 process running them was recycled.
+                 If None, SAFE_CALCULATION_TIMEOUT is used.
+
+    Output
+        True if the calculation neither completed nor failed and was last
+        saved longer than timeout ago, False otherwise
+
+    Calculations record when they were last saved in run_duration, which
+    run_in_background keeps up to date while they run.
+    """
+
+    if timeout is None:
+        timeout = CALCULATION_TIMEOUT
+
+    if calculation.success or len(calculation.errors) > 0:
+        return False
+
+    last_saved = calculation.run_date + datetime.timedelta(
+        seconds=calculation.run_duration or 0)
+    return (datetime.datetime.now() - last_saved >
+            datetime.timedelta(seconds=timeout))
+
+
+def calculation_status(request, calculation_id):
+    """Get status of calculation
+
+    e.g. /safe/api/v1/calculation/42/ returns
+
+    {"id": 42, "status": "running", "layer": null, "errors": null, ...}
+
+    where status is one of running, complete or failed and layer is the
+    url of the impact layer once complete.
+    """
+
+    try:
+        calculation = Calculation.objects.get(id=calculation_id)
+    except Calculation.DoesNotExist:
+        raise Http404
+
+    # Calculations lost with the process running them never finish.
+    # Only errors are recorded so that nothing the calculation recorded
+    # meanwhile is overwritten, and only if it still hasn't completed.
+    if is_stale(calculation):
+        errors = ('Calculation stopped running without completing. It '
+                  'may have been interrupted by a restart of the server.')
+        Calculation.objects.filter(id=calculation.id,
+                                   success=False).update(errors=errors)
+        calculation = Calculation.objects.get(id=calculation_id)
+
+    if calculation.success:
+        status = 'complete'
+    elif len(calculation.errors) > 0:
+        status = 'failed'
+    else:
+        status = 'running'
+
+    output = {'id': calculation.id,
+              'status': status,
+              'layer': calculation.layer,
+              'hazard_layer': calculation.hazard_layer,
+              'exposure_layer': calculation.exposure_layer,
+              'run_date': 'new Date("%s")' % calculation.run_date,
+              'run_duration': calculation.run_duration,
+              'errors': calculation.errors or None,
+              'stacktrace': calculation.stacktrace}
+
     jsondata = json.dumps(output)
     return HttpResponse(jsondata, mimetype='application/json')
 